@@ -0,0 +1,76 @@
+"""
+Benchmark cloning a large file that already exists locally, which is what `bitbox clone` does when
+another clone of the same remote file is up to date. Each copy method is timed on its own, followed
+by `syncinfo.copySync` as a whole, which picks the cheapest method that works.
+
+Run it on the file system you want to measure, since reflinks only work on some (btrfs, XFS):
+
+  python benchmarks/clone_existing.py --dir /mnt/btrfs/tmp --size 1024
+"""
+import argparse
+import tempfile
+import time
+import json
+import sys
+import os
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--dir", default=tempfile.gettempdir(), help="Directory to benchmark in")
+  parser.add_argument("--size", type=int, default=256, help="Size of the file to clone, in MiB")
+  parser.add_argument("--repeat", type=int, default=3, help="Number of times to time each method")
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory(dir=args.dir, prefix="bitbox-bench-") as workdir:
+    # Point bitbox at a throwaway config folder before it is imported
+    configFolder = os.path.join(workdir, "config")
+    os.makedirs(os.path.join(configFolder, "syncs"))
+    os.environ["BITBOX_CONFIG_FOLDER"] = configFolder
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import bitbox.cli.bitbox.fastcopy as fastcopy
+    import bitbox.cli.bitbox.syncinfo as syncinfo
+
+    # Create the file, and track it the way `bitbox add` would
+    source = os.path.join(workdir, "source.bin")
+    with open(source, "wb") as f:
+      chunk = os.urandom(1024 ** 2)
+      for _ in range(args.size):
+        f.write(chunk)
+      os.fsync(f.fileno())
+    with open(syncinfo.BITBOX_SYNCINFO_PATH, "w") as f:
+      json.dump([], f)
+    syncinfo.createSync("bench", "hash", source)
+    syncId = syncinfo.lookupSync(source).syncId
+
+    # Time each copy method on its own
+    print(f"Cloning a {args.size} MiB file in {args.dir}\n")
+    print(f"{'Method':<20}{'Best (s)':>12}{'MiB/s':>12}")
+    for name, method in fastcopy.COPY_METHODS:
+      times = []
+      for i in range(args.repeat):
+        destination = os.path.join(workdir, f"{name}-{i}.bin")
+        start = time.perf_counter()
+        try:
+          fastcopy.copyFile(source, destination, [(name, method)])
+        except OSError as e:
+          times = None
+          print(f"{name:<20}{'unsupported':>12}  ({os.strerror(e.errno) if e.errno else e})")
+          break
+        times.append(time.perf_counter() - start)
+        os.unlink(destination)
+      if times is not None:
+        best = min(times)
+        print(f"{name:<20}{best:>12.4f}{args.size / max(best, 1e-9):>12.0f}")
+
+    # Time copySync end to end
+    times = []
+    for i in range(args.repeat):
+      destination = os.path.join(workdir, f"clone-{i}.bin")
+      start = time.perf_counter()
+      syncinfo.copySync(syncId, destination)
+      times.append(time.perf_counter() - start)
+    best = min(times)
+    print(f"{'copySync':<20}{best:>12.4f}{args.size / max(best, 1e-9):>12.0f}")
+
+if __name__ == "__main__":
+  main()
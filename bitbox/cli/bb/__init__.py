@@ -1,5 +1,7 @@
 from bitbox.cli.bb.clip import clip
 from bitbox.cli.bb.paste import paste
+from bitbox.cli.bb.history import history
+from bitbox.cli.bb.prefetch import prefetch
 from bitbox.cli.bb.authorize import authorize
 from bitbox.cli.bb.login import login
 from bitbox.cli.bb.main import main
@@ -1,36 +1,100 @@
 from bitbox.cli.bb.common import *
 from bitbox.cli import *
+from bitbox.lib.stream import hashFileobj
 import bitbox.lib as lib
 
 #
 # Clip command
 #
 
-@app.command(short_help="Send a file to your clipboard")
+@app.command(short_help="Send files or directories to your clipboard")
 def clip(
-  file: str = typer.Argument(..., help="Name of the file to send to your clipboard.")
+  files: List[str] = typer.Argument(..., help="Names of the files or directories to send to your clipboard. Use '-' to send standard input."),
+  compress: str = typer.Option("none", "--compress", "-z", help=f"Compress the clip, with one of {', '.join(CLIP_COMPRESSIONS)}."),
+  name: str = typer.Option("stdin", "--name", help="Name to paste standard input as, when it is sent with '-'."),
+  slot: int = typer.Option(None, "--slot", help="Replace the clip at this position in `bb history`, instead of the oldest clip once the clipboard is full.")
 ):
   # Get user info and try to establish a session
   authInfo = config.load()
+  client = lib.Client(authInfo)
 
-  # Confirm that the local file exists and is not a directory
-  confirmLocalFileExists(file)
-
-  # Read the contents of the file
-  with open(file, "rb") as f:
-    fileContents = f.read()
-  
-  # Create a blob
-  blob = clipToBlob(Clip(filename=file, content=fileContents))
-  
-  # Upload the file to the server as a file called "clipped"
+  # Check the arguments
+  if files == ["-"]:
+    if compress != "none":
+      error("Standard input can't be compressed. Compress it before piping it to `bb clip -` instead.")
+    if name in ["", ".", ".."] or "/" in name:
+      error(f"Invalid name '{name}'. It can't contain a slash.")
+  elif "-" in files:
+    error("Standard input can't be sent together with other files.")
+  else:
+    for file in files:
+      if not os.path.exists(file):
+        error(f"Local file '{file}' does not exist.")
+    if compress not in CLIP_COMPRESSIONS:
+      error(f"Unknown compression '{compress}'. Use one of {', '.join(CLIP_COMPRESSIONS)}.")
+
+  # Find the slot to put the clip in
+  clipboard = Clipboard(client)
   try:
-    lib.upload(blob, "&clipped", authInfo, overwrite=True)
-  except lib.FileTooLargeException:
-    error("The file you are trying to send is too large. Remember that you have a 1 GiB storage limit.")
+    target = clipboard.nextSlot(slot)
+  except ClipException as e:
+    error(e.message)
+
+  # Standard input is uploaded as it is read, without waiting for it to end, so it can't be compared
+  # with the other clips first
+  if files == ["-"]:
+    try:
+      with PrefixedReader(f"{name}\0".encode("utf-8"), sys.stdin.buffer) as blob:
+        client.upload_stream(blob, slotName(target), overwrite=True, filesInfo=clipboard.filesInfo)
+    except lib.FileTooLargeException:
+      error("The input you are trying to send is too large. Remember that you have a 1 GiB storage limit.")
+    success("Standard input has been sent to your clipboard.")
+    config.setSession(authInfo.session)
+    return
+
+  # Reject clips that can't fit in the user's storage before reading them. Compressed clips can't be
+  # sized in advance, so they are only checked once they have been packed
+  if compress == "none":
+    item = lib.PlanItem(key=None, remote=slotName(target), bytes=framedLength(clipSize(files)))
+    if len(lib.planTransfers([item], clipboard.filesInfo, client.username).rejected) > 0:
+      error("The files you are trying to send are too large. Remember that you have a 1 GiB storage limit.")
+
+  # Open the clip as a stream, packing several files or directories into an archive
+  try:
+    blob = openClip(files, compress)
+  except OSError as e:
+    error(f"An error occurred reading local file '{e.filename}': {e.strerror}")
+  if len(files) == 1 and os.path.isfile(files[0]):
+    description = f"File '{files[0]}' has"
+  else:
+    description = f"{', '.join(repr(file) for file in files)} have"
+
+  with blob:
+    # If the clip is already on the clipboard, just move it to the front
+    blob, blobHash, _ = hashFileobj(blob)
+    existing = clipboard.find(blobHash)
+    if existing is not None and slot is None:
+      clipboard.promote(existing)
+      success(f"{description} been sent to your clipboard.")
+      config.setSession(authInfo.session)
+      return
+
+    # Otherwise, replace the contents of the slot in place, encrypting them as they are sent, which
+    # also moves it to the front unless it already had them. The segments of the previous clip in
+    # the slot are deleted, if it was sent from standard input
+    try:
+      if target in clipboard.slots:
+        if not client.update_fileobj(blob, slotName(target), filesInfo=clipboard.filesInfo):
+          clipboard.promote(target)
+      else:
+        client.upload_fileobj(blob, slotName(target), overwrite=True, filesInfo=clipboard.filesInfo)
+    except lib.FileTooLargeException:
+      error("The file you are trying to send is too large. Remember that you have a 1 GiB storage limit.")
+    except lib.FileNotReadyException:
+      error("Your clipboard is being modified elsewhere. Please try again later.")
 
   # Print a success message
-  success(f"File '{file}' has been sent to your clipboard.")
+  success(f"{description} been sent to your clipboard.")
 
   # Save the session
   config.setSession(authInfo.session)
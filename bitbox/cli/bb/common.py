@@ -1,6 +1,10 @@
 from bitbox.cli.common import *
+from bitbox.lib.stream import STREAM_CHUNK_SIZE, isSeekable
 import typer
-from dataclasses import dataclass
+from typing import BinaryIO, Dict
+import threading
+import tempfile
+import tarfile
 import os
 
 #
@@ -9,6 +13,20 @@ import os
 
 BB_CONFIG_FOLDER = os.environ.get("BB_CONFIG_FOLDER") or os.path.join(os.path.expanduser("~"), ".bb")
 
+# Clips of a single file start with the name of the file, which never contains a slash, so this
+# name marks clips that hold a tar archive instead
+CLIP_ARCHIVE_FILENAME = "/tar"
+CLIP_COMPRESSIONS = ["none", "gz", "bz2", "xz"]
+CLIP_MAX_HEADER_LENGTH = 4096
+
+# The clipboard keeps this many clips. The newest is in slot 1 when nothing has been clipped yet,
+# which is the file older versions of `bb` paste from
+CLIPBOARD_SLOTS = int(os.environ.get("BB_CLIPBOARD_SLOTS") or 5)
+CLIPBOARD_INDEX = "&clipboard"
+
+# Archives are kept in memory up to this size, and on disk beyond it, until they are uploaded
+CLIP_SPOOL_MAX_MEMORY = 16 * 1024 ** 2
+
 #
 # Global variables
 #
@@ -17,19 +35,337 @@ app = typer.Typer()
 config = Config(BB_CONFIG_FOLDER)
 
 #
-# Utility functions
+# Exceptions
+#
+
+class ClipException(Exception):
+  def __init__(self, message: str):
+    self.message = message
+
+#
+# Streaming clips
+#
+# A clip is uploaded as a stream, so large files are never read into memory. A single file is sent
+# as its name followed by its contents, which older versions of `bb` can also paste; several files,
+# directories and compressed clips are sent as a tar archive.
 #
 
-@dataclass
-class Clip:
-  filename: str
-  content: bytes
+class PrefixedReader:
+  """
+  A readable stream of some bytes followed by the contents of a file, which can be seeked if the
+  file can.
+  """
+  __prefix: bytes
+  __fileobj: BinaryIO
+  __position: int
+
+  def __init__(self, prefix: bytes, fileobj: BinaryIO):
+    self.__prefix = prefix
+    self.__fileobj = fileobj
+    self.__position = 0
+
+  def __enter__(self) -> "PrefixedReader":
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.close()
+
+  def seekable(self) -> bool:
+    return isSeekable(self.__fileobj)
+
+  def tell(self) -> int:
+    return self.__position
+
+  def seek(self, position: int) -> int:
+    self.__position = position
+    self.__fileobj.seek(max(0, position - len(self.__prefix)))
+    return position
+
+  def read(self, size: int = -1) -> bytes:
+    data = b""
+    if self.__position < len(self.__prefix):
+      data = self.__prefix[self.__position:] if size < 0 else self.__prefix[self.__position:self.__position + size]
+    if size < 0 or len(data) < size:
+      data += self.__fileobj.read(-1 if size < 0 else size - len(data))
+    self.__position += len(data)
+    return data
+
+  def close(self) -> None:
+    self.__fileobj.close()
+
+def openClip(paths: List[str], compression: str = "none") -> BinaryIO:
+  """
+  Open the blob for a clip of local files and directories as a readable binary stream. A single
+  file is read straight from the disk. Anything else is packed into a tar archive as it is read,
+  which is spooled to a temporary file, since the server needs the hash of the blob before it can
+  be uploaded.
+  """
+  # Send a single file as it is, unless it should be compressed
+  if len(paths) == 1 and os.path.isfile(paths[0]) and compression == "none":
+    header = f"{os.path.basename(paths[0])}\0".encode("utf-8")
+    return PrefixedReader(header, open(paths[0], "rb"))
+
+  # Otherwise, pack everything into an archive, naming each path by its base name
+  spool = tempfile.SpooledTemporaryFile(max_size=CLIP_SPOOL_MAX_MEMORY)
+  spool.write(f"{CLIP_ARCHIVE_FILENAME}\0".encode("utf-8"))
+  with tarfile.open(fileobj=spool, mode="w|" if compression == "none" else f"w|{compression}") as tar:
+    for path in paths:
+      tar.add(path, arcname=os.path.basename(os.path.abspath(path)))
+  spool.seek(0)
+  return spool
+
+def clipSize(paths: List[str]) -> int:
+  """
+  Estimate the size of the blob for a clip of local files and directories from their sizes on the
+  disk, without reading them. Archives are assumed to be uncompressed, and the estimate leaves out
+  the extended headers that some members get, so it is never larger than the real size.
+  """
+  if len(paths) == 1 and os.path.isfile(paths[0]):
+    return len(f"{os.path.basename(paths[0])}\0".encode("utf-8")) + os.path.getsize(paths[0])
+
+  # Every member of an archive has a header block, and the contents of files are padded to whole
+  # blocks
+  def memberSize(path: str) -> int:
+    if os.path.islink(path) or not os.path.isfile(path):
+      return tarfile.BLOCKSIZE
+    return tarfile.BLOCKSIZE + -(-os.path.getsize(path) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+  # The archive ends with two empty blocks, and is padded to a whole record
+  size = 2 * tarfile.BLOCKSIZE
+  for path in paths:
+    size += memberSize(path)
+    for directory, directories, filenames in os.walk(path):
+      size += sum(memberSize(os.path.join(directory, name)) for name in directories + filenames)
+  return len(f"{CLIP_ARCHIVE_FILENAME}\0".encode("utf-8")) + -(-size // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+def extractArchive(fileobj: BinaryIO, directory: str) -> None:
+  """
+  Extract a tar archive from a stream, in the order it is read, refusing any member that would end
+  up outside the directory.
+
+  :raises ClipException: If the archive is not valid or has unsafe members.
+  """
+  try:
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+      if hasattr(tarfile, "data_filter"):
+        tar.extractall(directory, filter="data")
+        return
+      for member in tar:
+        parts = member.name.split("/")
+        if os.path.isabs(member.name) or ".." in parts or not (member.isfile() or member.isdir()):
+          raise ClipException(f"The clip contains an unsafe path '{member.name}'.")
+        tar.extract(member, directory)
+  except (tarfile.TarError, EOFError) as e:
+    raise ClipException(f"The clip is not a valid archive: {e}")
+
+class ClipWriter:
+  """
+  A writable stream that unpacks a clip into a directory as it is downloaded. Archives are
+  extracted by a background thread, fed through a pipe, so only a bounded amount of the clip is
+  ever in memory. Call `finish` once the download is complete, after which `names` lists what was
+  unpacked. Use it with `with`, so that the thread is stopped if the download fails.
+
+  If an output stream is given instead of a directory, the contents of the clip are written to it
+  as they are, without unpacking archives.
+  """
+  directory: Optional[str]
+  output: Optional[BinaryIO]
+  names: List[str]
+  __header: Optional[bytearray]
+  __sink: Optional[BinaryIO]
+  __thread: Optional[threading.Thread]
+  __error: Optional[ClipException]
+
+  def __init__(self, directory: Optional[str] = None, output: Optional[BinaryIO] = None):
+    self.directory = directory
+    self.output = output
+    self.names = []
+    self.__header = bytearray()
+    self.__sink = None
+    self.__thread = None
+    self.__error = None
+
+  def __enter__(self) -> "ClipWriter":
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.close()
+
+  def write(self, data: bytes) -> None:
+    # Read the header, which names the file or marks an archive
+    if self.__header is not None:
+      self.__header += data
+      end = self.__header.find(b"\0")
+      if end == -1:
+        if len(self.__header) > CLIP_MAX_HEADER_LENGTH:
+          raise ClipException("The clip is corrupted.")
+        return
+      name = self.__header[:end].decode("utf-8", errors="replace")
+      data = bytes(self.__header[end + 1:])
+      self.__header = None
+      self.__open(name)
+
+    # Pass everything after the header along. If the extracting thread has stopped, it has already
+    # recorded why
+    try:
+      self.__sink.write(data)
+    except BrokenPipeError:
+      if self.__sink is self.output:
+        raise
+
+  def finish(self) -> None:
+    """
+    :raises ClipException: If the clip is not valid.
+    """
+    if self.__header is not None:
+      raise ClipException("The clip is corrupted.")
+    self.close()
+    if self.__error is not None:
+      raise self.__error
+    if self.__thread is not None:
+      self.names = sorted(os.listdir(self.directory))
+
+  def close(self) -> None:
+    if self.__sink is not None and self.__sink is not self.output:
+      try:
+        self.__sink.close()
+      except BrokenPipeError:
+        pass
+      self.__sink = None
+    if self.__thread is not None:
+      self.__thread.join()
+
+  def __open(self, name: str) -> None:
+    if self.output is not None:
+      # Write the contents straight to the output
+      self.names = [name]
+      self.__sink = self.output
+    elif name == CLIP_ARCHIVE_FILENAME:
+      # Extract archives in the background, reading from a pipe
+      readFd, writeFd = os.pipe()
+      reader = os.fdopen(readFd, "rb")
+      self.__sink = os.fdopen(writeFd, "wb")
+      self.__thread = threading.Thread(target=self.__extract, args=(reader,), daemon=True)
+      self.__thread.start()
+    else:
+      # Files are named by their base name, so they can only be written into the directory
+      if name in ["", ".", ".."] or "/" in name or os.sep in name:
+        raise ClipException(f"The clip contains an unsafe filename '{name}'.")
+      self.names = [name]
+      self.__sink = open(os.path.join(self.directory, name), "wb")
+
+  def __extract(self, reader: BinaryIO) -> None:
+    try:
+      extractArchive(reader, self.directory)
+    except ClipException as e:
+      self.__error = e
+    finally:
+      # Read whatever is left, so the download never blocks on a full pipe
+      while reader.read(STREAM_CHUNK_SIZE):
+        pass
+      reader.close()
+
+#
+# Clipboard history
+#
+# Each clip is kept in a slot, which is a remote file of its own. Clips are ordered from the newest
+# to the oldest by when their slots were last modified, so new clips replace the contents of the
+# oldest slot in place and need nothing else written. Clipping something that is already in a slot
+# only moves that slot to the front, which a small index file records: it lists the order of the
+# slots as of when it was written, and slots modified since then go in front of it.
+#
+
+def slotName(slot: int) -> str:
+  return "&clipped" if slot == 1 else f"&clipped.{slot}"
+
+class Clipboard:
+  """
+  The slots of the user's clipboard, read from a single listing of their files. The index is only
+  downloaded when the order of the slots depends on it.
+  """
+  client: lib.Client
+  filesInfo: List[FileInfo]
+  slots: Dict[int, FileInfo]
+  index: Optional[FileInfo]
+  __order: Optional[List[int]]
+
+  def __init__(self, client: lib.Client):
+    self.client = client
+    self.filesInfo = [fileInfo for fileInfo in client.filesInfo() if fileInfo.owner == client.username]
+    names = { slotName(slot): slot for slot in range(1, CLIPBOARD_SLOTS + 1) }
+    self.slots = { names[fileInfo.name]: fileInfo for fileInfo in self.filesInfo if fileInfo.name in names }
+    self.index = next((fileInfo for fileInfo in self.filesInfo if fileInfo.name == CLIPBOARD_INDEX), None)
+    self.__order = None
+
+  @property
+  def order(self) -> List[int]:
+    """
+    The slots from the newest clip to the oldest.
+    """
+    if self.__order is None:
+      self.__order = self.readOrder()
+    return self.__order
+
+  def readOrder(self) -> List[int]:
+    # Slots modified since the index was written are newer than anything it lists
+    newest = lambda slots: sorted(slots, key=lambda slot: -self.slots[slot].lastModified)
+    recent = [slot for slot in self.slots if self.index is None or self.slots[slot].lastModified > self.index.lastModified]
+    rest = [slot for slot in self.slots if slot not in recent]
+    if len(rest) == 0:
+      return newest(recent)
+
+    # The other slots are in the order the index lists them in. Slots it doesn't list go after it
+    try:
+      order = json.loads(self.client.download(CLIPBOARD_INDEX, self.client.username).decode("utf-8"))["order"]
+      order = [slot for slot in order if slot in rest]
+    except (lib.FileNotFoundException, lib.DownloadException, ValueError, KeyError, TypeError):
+      order = []
+    return newest(recent) + order + newest(slot for slot in rest if slot not in order)
+
+  def entry(self, position: int) -> int:
+    """
+    :returns: The slot of the clip at a position in the history, counting from 1 for the newest.
+
+    :raises ClipException: If there is no clip at that position.
+    """
+    # The newest clip doesn't need the index, unless it was written after every slot
+    if position == 1 and self.__order is None and len(self.slots) > 0:
+      latest = max(self.slots, key=lambda slot: self.slots[slot].lastModified)
+      if self.index is None or self.slots[latest].lastModified > self.index.lastModified:
+        return latest
+    if position < 1 or position > len(self.order):
+      raise ClipException(f"There is no clip {position} on your clipboard. It has {len(self.order)} clips.")
+    return self.order[position - 1]
+
+  def find(self, blobHash: str) -> Optional[int]:
+    """
+    :returns: The slot holding a clip with the given hash, if any.
+    """
+    for slot, fileInfo in self.slots.items():
+      if fileInfo.hash == blobHash:
+        return slot
+    return None
 
-def clipToBlob(clip: Clip) -> bytes:
-  return f"{os.path.basename(clip.filename)}\0".encode("utf-8") + clip.content
+  def nextSlot(self, position: Optional[int] = None) -> int:
+    """
+    :returns: The slot to put a new clip in: the slot at a position in the history if one is given,
+      otherwise a free slot, or the slot of the oldest clip if every slot is used.
+    """
+    if position is not None:
+      return self.entry(position)
+    free = [slot for slot in range(1, CLIPBOARD_SLOTS + 1) if slot not in self.slots]
+    return free[0] if len(free) > 0 else self.order[-1]
 
-def blobToClip(blob: bytes) -> Clip:
-  sepIndex = blob.index(b"\0")
-  filename = blob[:sepIndex].decode("utf-8")
-  content = blob[sepIndex+1:]
-  return Clip(filename=filename, content=content)
+  def promote(self, slot: int) -> None:
+    """
+    Move a slot to the front of the history without changing its contents, by saving the index.
+    Slots that have just been written to are at the front already.
+    """
+    if self.entry(1) == slot:
+      return
+    self.__order = [slot] + [other for other in self.order if other != slot]
+    index = json.dumps({ "order": self.__order }).encode("utf-8")
+    if self.index is not None:
+      self.client.update(index, CLIPBOARD_INDEX)
+    else:
+      self.client.upload(index, CLIPBOARD_INDEX, overwrite=True)
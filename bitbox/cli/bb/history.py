@@ -0,0 +1,58 @@
+from bitbox.cli.bb.common import *
+from bitbox.cli import *
+import bitbox.lib as lib
+
+#
+# Utility functions
+#
+
+def describeClip(client: lib.Client, filename: str) -> Tuple[str, int]:
+  """
+  Read the name of a clip from the start of its blob, which is all that is downloaded unless the
+  clip is cached.
+
+  :returns: A tuple of the name of the clip and the size of its contents.
+  """
+  head = client.read_range(filename, client.username, 0, CLIP_MAX_HEADER_LENGTH)
+  end = head.find(b"\0")
+  if end == -1:
+    raise ClipException("The clip is corrupted.")
+  name = head[:end].decode("utf-8", errors="replace")
+  size = client.size(filename, client.username) - end - 1
+  return ("(several files)" if name == CLIP_ARCHIVE_FILENAME else name), size
+
+#
+# History command
+#
+
+@app.command(short_help="List the clips on your clipboard, newest first")
+def history():
+  # Get user info and try to establish a session
+  authInfo = config.load()
+  client = lib.Client(authInfo)
+
+  # Find the slots of the clipboard
+  clipboard = Clipboard(client)
+  if len(clipboard.order) == 0:
+    console.print("There is nothing on your clipboard.")
+    config.setSession(authInfo.session)
+    return
+
+  # List the clips in the order they would be pasted
+  table = Table()
+  table.add_column("#")
+  table.add_column("Name")
+  table.add_column("Size")
+  table.add_column("Clipped")
+  for position, slot in enumerate(clipboard.order, start=1):
+    fileInfo = clipboard.slots[slot]
+    try:
+      name, size = describeClip(client, slotName(slot))
+      renderedSize = humanReadableFilesize(size)
+    except (lib.FileNotReadyException, lib.DownloadException, ClipException):
+      name, renderedSize = "(unavailable)", ""
+    table.add_row(str(position), name, renderedSize, humanReadableJSTimestamp(fileInfo.lastModified))
+  console.print(table)
+
+  # Save the session back onto the disk
+  config.setSession(authInfo.session)
@@ -7,10 +7,15 @@ from rich.prompt import Prompt, Confirm
 from random_username.generate import generate_username
 
 @app.callback(invoke_without_command=True)
-def main(ctx: typer.Context):
+def main(
+  ctx: typer.Context,
+  limitRate: str = typer.Option(None, "--limit-rate", help="Bandwidth for all transfers, in bytes per second with an optional suffix of 'k', 'M' or 'G' (e.g. '2M'), or a schedule like '09:00-18:00=512k,4M'. Overrides `BITBOX_LIMIT_RATE`.")):
   # Get the key info
   keyInfo = config.getKeyInfo()
 
+  # Limit the bandwidth of transfers
+  limitTransfers(limitRate or BITBOX_LIMIT_RATE)
+
   # # Log that a command has been invoked
   try:
     server.logCommand(" ".join(sys.argv[1:]), "" if keyInfo is None else keyInfo.username)
@@ -2,40 +2,107 @@ from bitbox.cli.bb.common import *
 from bitbox.cli import *
 import bitbox.lib as lib
 from rich.prompt import Confirm
+import tempfile
+import shutil
 import os
 
 #
-# Paste command
+# Utility functions
 #
 
-@app.command(short_help="Paste the file currently on your clipboard")
-def paste():
-  # Get user info and try to establish a session
-  authInfo = config.load()
-
-  # Download the blob
+def downloadClip(client: lib.Client, fileInfo: FileInfo, writer: ClipWriter) -> None:
+  # Copy the clip from the cache if `bb prefetch` has downloaded it, which the hash in the listing
+  # tells without asking the server for a download link. Otherwise, download it into the writer,
+  # which unpacks it as it arrives
   try:
-    blob = lib.download("&clipped", authInfo.keyInfo.username, authInfo)
+    if not client.blobCache.getInto(fileInfo.hash, writer):
+      client.download_fileobj(fileInfo.name, client.username, writer)
+    writer.finish()
   except lib.FileNotFoundException:
     console.print("There is nothing on your clipboard.")
-    typer.Exit(1)
+    raise typer.Exit(1)
   except lib.FileNotReadyException:
     error("Your clipped content is not ready to download yet. Please try again later.")
+  except lib.DownloadException:
+    error("An error occurred downloading your clipboard, or it does not match its hash. It may have been tampered with.")
+  except ClipException as e:
+    error(e.message)
+
+#
+# Paste command
+#
+
+@app.command(short_help="Paste the files currently on your clipboard")
+def paste(
+  position: str = typer.Argument(None, help="Position of the clip to paste in `bb history`, counting from 1 for the newest clip."),
+  output: str = typer.Argument(None, help="Use '-' to write the clip to standard output as it is downloaded, instead of saving it.")
+):
+  # Get user info and try to establish a session
+  authInfo = config.load()
+  client = lib.Client(authInfo)
+
+  # Parse the arguments, either of which may be left out
+  arguments = [argument for argument in [position, output] if argument is not None]
+  output = arguments.pop() if len(arguments) > 0 and arguments[-1] == "-" else None
+  if len(arguments) > 1:
+    error(f"Unknown output '{arguments[1]}'. Use '-' to write the clip to standard output.")
+  if len(arguments) == 1 and not arguments[0].isdigit():
+    error(f"Invalid position '{arguments[0]}'. Use the number of a clip in `bb history`.")
+  position = int(arguments[0]) if len(arguments) == 1 else 1
+
+  # Find the slot holding the clip. The newest clip is found from the listing alone
+  clipboard = Clipboard(client)
+  if len(clipboard.slots) == 0:
+    console.print("There is nothing on your clipboard.")
+    raise typer.Exit(1)
+  try:
+    fileInfo = clipboard.slots[clipboard.entry(position)]
+  except ClipException as e:
+    error(e.message)
+
+  # Write the contents of the clip to standard output as they arrive. They can't be checked against
+  # the hash until the end, so a tampered clip is only reported once it has been written
+  if output is not None:
+    if output != "-":
+      error(f"Unknown output '{output}'. Use '-' to write the clip to standard output.")
+    try:
+      with ClipWriter(output=sys.stdout.buffer) as writer:
+        downloadClip(client, fileInfo, writer)
+      sys.stdout.buffer.flush()
+    except BrokenPipeError:
+      # Whatever reads the output has stopped, so there is no one to tell
+      os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    config.setSession(authInfo.session)
+    return
+
+  # Unpack the clip into a staging directory as it is downloaded, so that nothing is moved into
+  # place until the download has been checked against its hash
+  staging = tempfile.mkdtemp(dir=".", prefix=".bb-paste-")
+  try:
+    with ClipWriter(staging) as writer:
+      downloadClip(client, fileInfo, writer)
+
+    # Move each file into place, checking first if it already exists
+    pasted = []
+    for name in writer.names:
+      if os.path.lexists(name):
+        overwrite = Confirm.ask(f"File '{name}' already exists. Overwrite?", default=False)
+        if not overwrite:
+          continue
+        if os.path.isdir(name) and not os.path.islink(name):
+          shutil.rmtree(name)
+        else:
+          os.unlink(name)
+      os.replace(os.path.join(staging, name), name)
+      pasted.append(name)
+  finally:
+    shutil.rmtree(staging, ignore_errors=True)
 
-  # Parse the blob
-  clip = blobToClip(blob)
-  filename = clip.filename
-  fileContents = clip.content
-
-  # Check if file already exists
-  if os.path.exists(filename):
-    overwrite = Confirm.ask(f"File '{filename}' already exists. Overwrite?", default=False)
-    if not overwrite:
-      typer.Exit(1)
-
-  # Write the file to disk
-  with open(filename, "wb") as f:
-    f.write(fileContents)
-  
   # Print a success message
-  success(f"File '{filename}' has been saved to disk.")
+  if len(pasted) == 1:
+    success(f"File '{pasted[0]}' has been saved to disk.")
+  elif len(pasted) > 1:
+    success(f"{', '.join(repr(name) for name in pasted)} have been saved to disk.")
+
+  # Save the session
+  config.setSession(authInfo.session)
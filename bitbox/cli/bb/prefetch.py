@@ -0,0 +1,100 @@
+from bitbox.cli.bb.common import *
+from bitbox.cli import *
+import bitbox.lib as lib
+import tempfile
+import time
+
+#
+# Parameters
+#
+
+DEFAULT_PREFETCH_MIN_INTERVAL = 2.0
+DEFAULT_PREFETCH_MAX_INTERVAL = 60.0
+
+#
+# Prefetcher
+#
+
+class Prefetcher:
+  """
+  Polls the server for new clips and downloads them into the local cache before they are pasted,
+  so that `bb paste` only has to copy them from the disk. Each poll is a single listing of every
+  file, which covers every slot of the clipboard, and polls back off while nothing changes.
+  """
+  client: lib.Client
+  minInterval: float
+  maxInterval: float
+  interval: float
+  lastHashes: Dict[int, str]
+
+  def __init__(self, client: lib.Client, minInterval: float, maxInterval: float):
+    self.client = client
+    self.minInterval = minInterval
+    self.maxInterval = max(minInterval, maxInterval)
+    self.interval = minInterval
+    self.lastHashes = {}
+
+  def poll(self) -> bool:
+    """
+    Check whether any slot of the clipboard has changed, and download the new clips that aren't
+    cached yet.
+
+    :returns: Whether the clipboard changed.
+    """
+    # Find the slots in the listing
+    names = { slotName(slot): slot for slot in range(1, CLIPBOARD_SLOTS + 1) }
+    slots = { names[fileInfo.name]: fileInfo for fileInfo in self.client.filesInfo() if fileInfo.name in names and fileInfo.owner == self.client.username }
+    changed = [fileInfo for slot, fileInfo in slots.items() if self.lastHashes.get(slot) != fileInfo.hash]
+    self.lastHashes = { slot: fileInfo.hash for slot, fileInfo in slots.items() }
+
+    # Download each new clip unless it is already cached, or too large to cache
+    blobCache = self.client.blobCache
+    for fileInfo in changed:
+      if os.path.exists(blobCache.path(fileInfo.hash)):
+        continue
+      if fileInfo.bytes > blobCache.maxSize:
+        warning("A new clip is too large for the download cache, so it will be downloaded when it is pasted.")
+        continue
+
+      # Download it next to the cache, which keeps a copy once it has been verified
+      os.makedirs(blobCache.directory, mode=0o700, exist_ok=True)
+      with tempfile.TemporaryDirectory(dir=blobCache.directory, prefix=".prefetch-") as directory:
+        self.client.download_file(fileInfo.name, self.client.username, os.path.join(directory, "clipped"))
+      console.print("A new clip has been downloaded and is ready to paste.")
+    return len(changed) > 0
+
+  def run(self) -> None:
+    while True:
+      try:
+        changed = self.poll()
+      except (lib.FileNotFoundException, lib.FileNotReadyException):
+        # The clip is being replaced, so check again soon
+        changed = True
+      except (lib.DownloadException, requests.RequestException):
+        warning("An error occurred checking your clipboard. Trying again later.")
+        changed = False
+      self.interval = self.minInterval if changed else min(self.interval * 2, self.maxInterval)
+      time.sleep(self.interval)
+
+#
+# Prefetch command
+#
+
+@app.command(short_help="Download new clips in the background, so pasting them is instant")
+def prefetch(
+  minInterval: float = typer.Option(DEFAULT_PREFETCH_MIN_INTERVAL, "--min-interval", help="Shortest time in seconds between checks for new clips"),
+  maxInterval: float = typer.Option(DEFAULT_PREFETCH_MAX_INTERVAL, "--max-interval", help="Longest time in seconds between checks for new clips, reached when nothing changes")):
+  # Get user info and try to establish a session
+  authInfo = config.load()
+  client = lib.Client(authInfo)
+  if not client.blobCache.enabled:
+    error("The download cache is turned off, so there is nowhere to keep prefetched clips. Unset `BITBOX_CACHE_MAX_SIZE` to turn it on.")
+
+  # Poll until interrupted
+  success("Watching your clipboard for new clips. Press Ctrl+C to stop.")
+  try:
+    Prefetcher(client, minInterval, maxInterval).run()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    config.setSession(authInfo.session)
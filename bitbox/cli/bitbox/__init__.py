@@ -1,11 +1,18 @@
 from bitbox.cli.bitbox.setup import setup
 from bitbox.cli.bitbox.add import add
 from bitbox.cli.bitbox.clone import clone
+from bitbox.cli.bitbox.mirror import mirror
 from bitbox.cli.bitbox.update import update
 from bitbox.cli.bitbox.sync import sync
+from bitbox.cli.bitbox.watch import watch
 from bitbox.cli.bitbox.share import share
 from bitbox.cli.bitbox.delete import delete
 from bitbox.cli.bitbox.otc import otc
 from bitbox.cli.bitbox.files import files
+from bitbox.cli.bitbox.cat import cat
+from bitbox.cli.bitbox.daemon import daemon
+from bitbox.cli.bitbox.enqueue import enqueue
+from bitbox.cli.bitbox.jobs import jobs
+from bitbox.cli.bitbox.throttle import throttle
 from bitbox.cli.bitbox.main import main
 from bitbox.cli.bitbox.common import app as bitbox_app
\ No newline at end of file
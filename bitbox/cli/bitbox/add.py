@@ -1,77 +1,355 @@
 from bitbox.cli.bitbox.common import *
 from bitbox.cli import *
 import bitbox.cli.bitbox.syncinfo as syncinfo
+import bitbox.cli.bitbox.walk as walk
 import bitbox.server as server
+from bitbox.lib.stream import hashFileobj, EncryptingReader
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from cryptography.fernet import Fernet
-import binascii
+from typing import BinaryIO, Tuple
+import glob
+import mmap
+
+#
+# Parameters
+#
+
+DEFAULT_ADD_JOBS = 8
+DEFAULT_PACK_MEMBER_MAX_SIZE = 64 * 1024
+
+#
+# Exceptions
+#
+
+class AddException(Exception):
+  def __init__(self, message: str):
+    self.message = message
+
+#
+# Utility functions
+#
+
+def collectLocalFiles(paths: List[str], recursive: bool) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+  """
+  Expand the paths given on the command line into a list of local files and the remote names they
+  should be added under. Globs are expanded, and directories are walked if recursive = True, skipping paths excluded by `.bitboxignore` files. Files
+  inside a directory are named by their path relative to the directory's parent, so adding `src`
+  creates remotes like `src/main.py`.
+
+  :returns: A tuple of the (local file, remote name) pairs to add and the (path, message) pairs
+    that could not be added.
+  """
+  files = []
+  failures = []
+  seenInodes = set()
+
+  def addCandidate(local: str, remote: str):
+    # The same file may be reached through several paths or hard links; only add it once
+    inode = os.stat(local).st_ino
+    if inode not in seenInodes:
+      seenInodes.add(inode)
+      files.append((local, remote))
+
+  for path in paths:
+    # Expand globs that the shell did not expand
+    matches = sorted(glob.glob(path, recursive=True)) if glob.has_magic(path) else [path]
+    if len(matches) == 0:
+      failures.append((path, f"No local files match '{path}'."))
+
+    for match in matches:
+      if os.path.isfile(match):
+        addCandidate(match, os.path.basename(match))
+      elif os.path.isdir(match):
+        if not recursive:
+          failures.append((match, f"Local file '{match}' is a directory, whereas file was expected. Use `--recursive` to add the files inside it."))
+          continue
+        base = os.path.dirname(os.path.abspath(match))
+        for entry in walk.walkFiles(match):
+          remote = os.path.relpath(os.path.abspath(entry.path), base).replace(os.sep, "/")
+          addCandidate(entry.path, remote)
+      else:
+        failures.append((match, f"Local file '{match}' does not exist."))
+
+  return files, failures
+
+def checkRemote(client: lib.Client, filesInfo: List[FileInfo], bytes: int, blobHash: str, remote: str, description: str, renameFlag: str) -> None:
+  """
+  Check that a blob can be added under a remote name from a listing of the user's files, before
+  anything is encrypted.
+
+  :raises AddException: If the name is taken or the blob would not fit in the user's storage.
+  """
+  try:
+    client.precheck(remote, bytes, blobHash, filesInfo=filesInfo)
+  except lib.FileTooLargeException:
+    raise AddException(f"{description} is too large to upload. Run `bitbox` to check how much space you have.")
+  except lib.FileExistsException:
+    raise AddException(f"A remote file named '@{client.username}/{remote}' already exists. Use the `{renameFlag}` flag to specify a different name for the remote file.")
+
+def uploadBlob(client: lib.Client, filesInfo: List[FileInfo], blob: bytes, remote: str, description: str, renameFlag: str) -> Tuple[str, str]:
+  """
+  Encrypt and upload a blob as a new remote file. The blob is only encrypted once the server has
+  accepted it.
+
+  :param filesInfo: A listing of the user's files, to check the blob against first.
+  :param description: How to refer to the blob in error messages.
+  :param renameFlag: The flag the user can pass to pick a different remote name.
+
+  :raises AddException: If the blob could not be added.
+
+  :returns: A tuple of the new file ID and the hash of the blob.
+  """
+  # Get the hash of the blob, and check that it can be added. The length of the encrypted blob is
+  # known in advance
+  blobHash = hashlib.sha256(blob).hexdigest()
+  encryptedLength = fernetTokenLength(len(blob))
+  checkRemote(client, filesInfo, encryptedLength, blobHash, remote, description, renameFlag)
+
+  # Tell the server we want to add this file, and get the file ID and URL to upload to
+  fileKey = Fernet.generate_key()
+  try:
+    prepareStoreResponse = client.prepareStore(remote, encryptedLength, blobHash, fileKey)
+  except lib.FileTooLargeException:
+    raise AddException(f"{description} is too large to upload. Run `bitbox` to check how much space you have.")
+  except lib.FileExistsException:
+    raise AddException(f"A remote file named '@{client.username}/{remote}' already exists. Use the `{renameFlag}` flag to specify a different name for the remote file.")
+
+  # Encrypt the blob, upload it, and tell the server we're done uploading
+  try:
+    client.putBlob(prepareStoreResponse.uploadURL, Fernet(fileKey).encrypt(blob))
+  except lib.UploadException:
+    raise AddException(f"Error while uploading {description[0].lower()}{description[1:]}.")
+  client.store(prepareStoreResponse.fileId)
+
+  return prepareStoreResponse.fileId, blobHash
+
+def uploadFile(client: lib.Client, filesInfo: List[FileInfo], fileobj: BinaryIO, blobHash: str, length: int, remote: str, description: str) -> str:
+  """
+  Encrypt and upload a readable binary stream as a new remote file, one frame at a time, so that
+  the file is never held in memory. The stream is only read once the server has accepted it.
+
+  :param filesInfo: A listing of the user's files, to check the stream against first.
+  :param blobHash: The hash of the stream, found with `hashFileobj`.
+  :param length: The length of the stream, found with `hashFileobj`.
+  :param description: How to refer to the stream in error messages.
+
+  :raises AddException: If the stream could not be added.
+
+  :returns: The new file ID.
+  """
+  # Check that the stream can be added. The length of the encrypted stream is known in advance
+  encryptedLength = framedLength(length)
+  checkRemote(client, filesInfo, encryptedLength, blobHash, remote, description, "--remote")
+
+  # Tell the server we want to add this file, and get the file ID and URL to upload to
+  fileKey = Fernet.generate_key()
+  try:
+    prepareStoreResponse = client.prepareStore(remote, encryptedLength, blobHash, fileKey)
+  except lib.FileTooLargeException:
+    raise AddException(f"{description} is too large to upload. Run `bitbox` to check how much space you have.")
+  except lib.FileExistsException:
+    raise AddException(f"A remote file named '@{client.username}/{remote}' already exists. Use the `--remote` flag to specify a different name for the remote file.")
+
+  # Encrypt the stream as it is uploaded, and tell the server we're done uploading
+  try:
+    client.putBlob(prepareStoreResponse.uploadURL, EncryptingReader(fileobj, fileKey, length))
+  except lib.UploadException:
+    raise AddException(f"Error while uploading {description[0].lower()}{description[1:]}.")
+  client.store(prepareStoreResponse.fileId)
+
+  return prepareStoreResponse.fileId
+
+def uploadDelta(client: lib.Client, filesInfo: List[FileInfo], blob: bytes, remote: str, description: str) -> Tuple[str, str]:
+  """
+  Encrypt and upload a blob as a new remote file in delta mode.
+
+  :raises AddException: If the blob could not be added.
+
+  :returns: A tuple of the new file ID and the hash of the blob.
+  """
+  try:
+    return client.storeDelta(blob, remote, filesInfo)
+  except lib.FileTooLargeException:
+    raise AddException(f"{description} is too large to upload. Run `bitbox` to check how much space you have.")
+  except lib.FileExistsException:
+    raise AddException(f"A remote file named '@{client.username}/{remote}' already exists. Use the `--remote` flag to specify a different name for the remote file.")
+  except lib.UploadException:
+    raise AddException(f"Error while uploading {description[0].lower()}{description[1:]}.")
+
+def addFile(client: lib.Client, filesInfo: List[FileInfo], local: str, remote: str, delta: bool = False) -> Tuple[str, str, bool]:
+  """
+  Encrypt and upload a single local file. If the user already has a remote file with the same name
+  and the same contents, the local file is synced with it instead, without uploading anything.
+
+  :param filesInfo: A listing of the user's files, to check the file against first.
+  :param delta: Whether to store the file in delta mode.
+
+  :raises AddException: If the file could not be added.
+
+  :returns: A tuple of the file ID of the remote, the hash of the file and whether the remote is in
+    delta mode.
+  """
+  # Files that can't fit are rejected before they are read
+  if os.path.getsize(local) > BITBOX_STORAGE_LIMIT:
+    raise AddException(f"File {local} is too large to upload. Run `bitbox` to check how much space you have.")
+
+  with open(local, "rb") as f:
+    # Files in delta mode are split into chunks by their contents, which needs all of them at once.
+    # They are mapped into memory rather than read, so the system can page them in and out
+    if delta:
+      if os.fstat(f.fileno()).st_size == 0:
+        return (*uploadDelta(client, filesInfo, b"", remote, f"File {local}"), True)
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as fileContents:
+        return (*uploadDelta(client, filesInfo, fileContents, remote, f"File {local}"), True)
+
+    # Hash the file without reading it into memory
+    _, fileHash, length = hashFileobj(f)
+
+    # Sync with an identical remote of the same name. The remote may already be in delta mode, which
+    # its chunks in the listing tell
+    existing = next((fileInfo for fileInfo in filesInfo if fileInfo.name == remote and fileInfo.owner == client.username), None)
+    if existing is not None and existing.hash == fileHash:
+      return existing.fileId, existing.hash, client.hasChunks(existing, filesInfo)
+
+    # Otherwise, encrypt and upload the file as it is read
+    return uploadFile(client, filesInfo, f, fileHash, length, remote, f"File {local}"), fileHash, False
+
+def addPack(client: lib.Client, filesInfo: List[FileInfo], files: List[Tuple[str, str]], pack: str) -> Tuple[str, List[syncinfo.NewSync]]:
+  """
+  Pack many local files into a single remote file, so that they are encrypted and uploaded together
+  in one round of requests. Each file is a member of the pack named by its remote name.
+
+  :raises AddException: If the pack could not be added.
+
+  :returns: A tuple of the new file ID and sync records for each of the packed files.
+  """
+  # Read the contents of the files, which are all small
+  members = []
+  for local, remote in files:
+    with open(local, "rb") as f:
+      members.append((remote, f.read()))
+
+  # Build the pack
+  try:
+    packBlob = lib.buildPack(members)
+  except lib.PackException as e:
+    raise AddException(e.message)
+
+  # Upload the pack, and mark it as one so that it is cloned as its files
+  fileId, _ = uploadBlob(client, filesInfo, packBlob, pack, f"Pack {pack}", "--pack")
+  try:
+    client.markPack(pack)
+  except (lib.FileNotFoundException, lib.FileTooLargeException, lib.UploadException):
+    raise AddException(f"Pack {pack} was uploaded, but could not be marked as a pack. Delete it and try again.")
+
+  # Describe where each file ended up
+  newSyncs = [syncinfo.NewSync(fileId=fileId, hash=hashlib.sha256(contents).hexdigest(), localFile=local, member=remote) for (local, remote), (_, contents) in zip(files, members)]
+  return fileId, newSyncs
 
 #
 # Add command
 #
 
-@app.command(short_help="Add a file to your bitbox")
+@app.command(short_help="Add files to your bitbox")
 def add(
-  local: str = typer.Argument(..., help="Name of the local file to add"),
-  remote: str = typer.Option(None, help="Name of the remote file to sync with (defaults to the same name as the local file)")):
-  # If remote is not specified, default to the same name as the local file
-  if (remote == None):
-    remote = os.path.basename(local)
-
+  locals: List[str] = typer.Argument(..., help="Local files to add. Globs are expanded, and directories are added with `--recursive`."),
+  remote: str = typer.Option(None, help="Name of the remote file to sync with (defaults to the same name as the local file). Only valid when adding a single file."),
+  recursive: bool = typer.Option(False, "--recursive", "-r", help="Add the files inside directories, named by their relative paths"),
+  jobs: int = typer.Option(DEFAULT_ADD_JOBS, "--jobs", "-j", help="Number of files to upload at once"),
+  pack: str = typer.Option(None, help="Pack the small files into a single remote file with this name, instead of adding them one by one"),
+  packMaxSize: int = typer.Option(DEFAULT_PACK_MEMBER_MAX_SIZE, "--pack-max-size", help="Largest file, in bytes, to put in the pack. Larger files are added on their own"),
+  delta: bool = typer.Option(False, "--delta", help="Store the files in chunks, so that `bitbox update` only uploads the parts of a file that changed and `bitbox sync` only downloads them. Best for large files that change a little at a time")):
   # Get user info and try to establish a session
   authInfo = config.load()
-  
-  # Confirm that the local file exists and is not a directory
-  confirmLocalFileExists(local)
-
-  # Confirm that the local file is not already being synced
-  existingSyncRecord = syncinfo.lookupSync(local)
-  if (existingSyncRecord is not None):
-    # Confirm that the remote file still exists
-    fileInfo = server.fileInfoById(existingSyncRecord.fileId, authInfo)
-    if isinstance(fileInfo, server.Error):
-      # If the remote file no longer exists, delete the sync record
-      syncinfo.deleteSyncsByRemote(existingSyncRecord.fileId)
+  client = lib.Client(authInfo)
+  username = authInfo.keyInfo.username
+
+  # Work out which files to add, and under which names
+  files, failures = collectLocalFiles(locals, recursive)
+  if remote is not None:
+    if len(files) != 1 or len(failures) != 0:
+      error("The `--remote` flag can only be used when adding a single file.")
+    files = [(files[0][0], remote)]
+
+  # List the user's files once, to check every file against before anything is encrypted
+  filesInfo = client.filesInfo()
+
+  # Confirm that the local files are not already being synced
+  syncRecords = { syncRecord.inode: syncRecord for syncRecord in syncinfo.readSyncInfo() }
+  syncedFiles = [(local, remoteName, syncRecords[os.stat(local).st_ino]) for local, remoteName in files if os.stat(local).st_ino in syncRecords]
+  if len(syncedFiles) > 0:
+    # Check which of their remotes still exist
+    remoteFiles = { fileInfo.fileId: fileInfo for fileInfo in filesInfo }
+    for local, remoteName, syncRecord in syncedFiles:
+      fileInfo = remoteFiles.get(syncRecord.fileId)
+      if fileInfo is None:
+        # If the remote file no longer exists, delete the sync record
+        syncinfo.deleteSyncsByRemote(syncRecord.fileId)
+      else:
+        # If the remote file still exists, the file can't be added again
+        files.remove((local, remoteName))
+        failures.append((local, f"Local file {local} is already being synced with remote file '@{fileInfo.owner}/{fileInfo.name}'."))
+
+  # Plan the uploads against the user's storage, smallest first, rejecting the files that can't fit
+  # before any of them is read. The small files go together in a single pack, if asked to
+  total = len(files) + len(failures)
+  packed = [] if pack is None else [(local, remoteName) for local, remoteName in files if os.path.getsize(local) <= packMaxSize]
+  files = [file for file in files if file not in packed]
+  items = [lib.PlanItem(key=file, remote=file[1], bytes=framedLength(os.path.getsize(file[0]))) for file in files]
+  if len(packed) > 0:
+    items.append(lib.PlanItem(key=None, remote=pack, bytes=fernetTokenLength(sum(os.path.getsize(local) for local, _ in packed))))
+  plan = lib.planTransfers(items, filesInfo, username)
+  for item in plan.rejected:
+    for local, _ in (packed if item.key is None else [item.key]):
+      failures.append((local, f"Local file {local} does not fit in the space you have left. Run `bitbox` to check how much space you have."))
+  files = [item.key for item in plan.accepted if item.key is not None]
+
+  # Upload the pack first
+  added = []
+  if len(packed) > 0 and any(item.key is None for item in plan.accepted):
+    try:
+      _, newSyncs = addPack(client, filesInfo, packed, pack)
+    except AddException as e:
+      failures += [(local, e.message) for local, _ in packed]
     else:
-      # If the remote file still exists, tell the user that the file is already being synced
-      error(f"Local file {local} is already being synced with remote file '@{fileInfo.owner}/{fileInfo.name}'.")
-  
-  # Read the contents of the file
-  with open(local, "rb") as f:
-    fileContents = f.read()
+      added += newSyncs
+      console.print(f"{len(packed)} local files have been added to your bitbox in the pack '@{username}/{pack}'.", style="green")
 
-  # Get the hash of the file
-  fileHash = hashlib.sha256(fileContents).hexdigest()
-  
-  # Encrypt the local file with a random key
-  fileKey = Fernet.generate_key()
-  encryptedFileBytes = Fernet(fileKey).encrypt(fileContents)
-  
-  # Get the user's public key
-  publicKey = getPublicKey(authInfo.keyInfo)
-  
-  # Encrypt the file key with the user's public key
-  personalEncryptedKey = rsaEncrypt(fileKey, publicKey)
-  personalEncryptedKeyHex = binascii.hexlify(personalEncryptedKey).decode("utf-8")
+  # Upload the remaining files concurrently, in the planned order
+  with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+    futures = { executor.submit(addFile, client, filesInfo, local, remoteName, delta): (local, remoteName) for local, remoteName in files }
+    for future in as_completed(futures):
+      local, remoteName = futures[future]
+      try:
+        fileId, fileHash, remoteDelta = future.result()
+      except AddException as e:
+        failures.append((local, e.message))
+        continue
+      except Exception as e:
+        failures.append((local, f"An error occurred: {e}"))
+        continue
+      added.append(syncinfo.NewSync(fileId=fileId, hash=fileHash, localFile=local, delta=remoteDelta))
+      console.print(f"Local file {local} has been added to your bitbox as '@{username}/{remoteName}'.", style="green")
 
-  # Tell the server we want to add this file, and get the file ID and URL to upload to
-  prepareStoreResponse = server.prepareStore(remote, len(encryptedFileBytes), fileHash, personalEncryptedKeyHex, authInfo)
-  guard(prepareStoreResponse, {
-    server.Error.FILE_TOO_LARGE: f"File {local} is too large to upload. Run `bitbox` to check how much space you have.",
-    server.Error.FILE_EXISTS: f"A remote file named '@{authInfo.keyInfo.username}/{remote}' already exists. Use the `--remote` flag to specify a different name for the remote file."
-  })
-
-  # Upload the file
-  uploadFile(prepareStoreResponse.uploadURL, encryptedFileBytes)
-  
-  # Tell the server we're done uploading
-  storeResponse = server.store(prepareStoreResponse.fileId, authInfo)
-  guard(storeResponse)
-  
-  # Create a sync record for the file
-  syncinfo.createSync(prepareStoreResponse.fileId, fileHash, local)
-
-  # Tell the user that the file has been added
-  success(f"Local file {local} has been added to your bitbox as '@{authInfo.keyInfo.username}/{remote}'.")
+  # Create sync records for all the added files at once. Files that can't be synced have still been
+  # uploaded, but are reported as failures
+  for newSync, message in syncinfo.createSyncs(added):
+    added.remove(newSync)
+    failures.append((newSync.localFile, message))
 
   # Save the session back onto the disk
   config.setSession(authInfo.session)
+
+  # Report the files that could not be added
+  if len(failures) > 0:
+    if total == 1:
+      error(failures[0][1])
+    table = Table()
+    table.add_column("Local File")
+    table.add_column("Error")
+    for local, message in sorted(failures):
+      table.add_row(local, message)
+    console.print(table)
+    error(f"{len(added)} files added, {len(failures)} failed.")
+  elif len(added) > 1:
+    success(f"\n{len(added)} files added.")
@@ -0,0 +1,65 @@
+from bitbox.cli.bitbox.common import *
+from bitbox.cli import *
+import sys
+
+#
+# Utility functions
+#
+
+def parseRange(byteRange: str) -> Tuple[int, Optional[int]]:
+  """
+  Parse a byte range in the syntax of HTTP range requests: 'START-END' for the bytes from START to
+  END inclusive, 'START-' for everything from START on, and '-N' for the last N bytes.
+
+  :returns: A tuple of the offset, which is negative to count back from the end, and the length, or
+    None to read to the end.
+  """
+  match = re.fullmatch(r"(\d*)-(\d*)", byteRange)
+  if match is None or match[0] == "-":
+    error(f"Invalid range '{byteRange}'. Use 'START-END', 'START-' or '-LENGTH'.")
+  start, end = match[1], match[2]
+  if start == "":
+    return -int(end), int(end)
+  if end == "":
+    return int(start), None
+  if int(end) < int(start):
+    error(f"Invalid range '{byteRange}'. The end of the range comes before its start.")
+  return int(start), int(end) - int(start) + 1
+
+#
+# Cat command
+#
+
+@app.command(short_help="Print a remote file, or part of it")
+def cat(
+  remote: str = typer.Argument(..., help="Name of the remote file to print. If the file is owned by another user, use the '@someuser/somefile' syntax."),
+  byteRange: str = typer.Option(None, "--range", help="Bytes to print, as 'START-END' (inclusive), 'START-' or '-LENGTH' for the end of the file. Only the parts of the file that cover the range are downloaded.")):
+  # Get user info and try to establish a session
+  authInfo = config.load()
+  client = lib.Client(authInfo)
+
+  # Parse the remote file name
+  owner, filename = parseRemoteFilename(remote, None)
+  renderedRemoteFilename = renderRemoteFilename(filename, owner)
+
+  # Write the file, or the range of it, to standard output
+  try:
+    if byteRange is None:
+      client.download_fileobj(filename, owner, sys.stdout.buffer)
+    else:
+      offset, length = parseRange(byteRange)
+      if length is None:
+        length = client.fileInfo(filename, owner).bytes
+      sys.stdout.buffer.write(client.read_range(filename, owner, offset, length))
+    sys.stdout.buffer.flush()
+  except lib.FileNotFoundException:
+    error(f"Remote file '{renderedRemoteFilename}' does not exist.")
+  except lib.UserNotFoundException:
+    error(f"User '@{owner}' does not exist.")
+  except lib.FileNotReadyException:
+    error(f"Remote file '{renderedRemoteFilename}' is being modified elsewhere. Please try again later.")
+  except lib.DownloadException:
+    error(f"An error occurred downloading remote file '{renderedRemoteFilename}', or it does not match its hash. This file may have been tampered with.")
+
+  # Save the session back onto the disk
+  config.setSession(authInfo.session)
@@ -1,9 +1,48 @@
 from bitbox.cli.bitbox.common import *
 from bitbox.cli import *
 import bitbox.cli.bitbox.syncinfo as syncinfo
+from bitbox.cli.bitbox.mirror import mirrorAll, DEFAULT_MIRROR_JOBS
 import bitbox.server as server
-from cryptography.fernet import Fernet
-import binascii
+
+#
+# Utility functions
+#
+
+def clonePack(fileId: str, packBlob: bytes, renderedRemoteFilename: str, directory: str) -> None:
+  """
+  Extract every file in a pack into a directory, naming them by their paths inside the pack, and
+  create a sync record for each of them.
+  """
+  # Read the index of the pack
+  try:
+    members = list(lib.readPackIndex(packBlob).values())
+  except lib.PackException as e:
+    error(f"Remote file '{renderedRemoteFilename}' is not a valid pack: {e.message}")
+
+  # Confirm that none of the local files already exist
+  locals = [os.path.join(directory, *member.name.split("/")) for member in members]
+  existing = [local for local in locals if os.path.exists(local)]
+  if len(existing) > 0:
+    error(f"A local file at '{existing[0]}' already exists. Use the `--local` flag to clone pack '{renderedRemoteFilename}' into a different directory.")
+
+  # Write each file to the local machine
+  newSyncs = []
+  for member, local in zip(members, locals):
+    try:
+      memberContents = lib.extractMember(packBlob, member)
+    except lib.PackException as e:
+      error(f"{e.message} This file may have been tampered with.")
+    os.makedirs(os.path.dirname(local) or ".", exist_ok=True)
+    with open(local, "wb") as f:
+      f.write(memberContents)
+    newSyncs.append(syncinfo.NewSync(fileId=fileId, hash=member.hash, localFile=local, member=member.name))
+
+  # Add sync records for all of the files at once
+  for _, message in syncinfo.createSyncs(newSyncs):
+    warning(f"{message} It won't be synchronized with the pack.")
+
+  # Print a success message
+  success(f"Remote pack '{renderedRemoteFilename}' has been cloned onto your local machine as {len(members)} files in '{directory}'.")
 
 #
 # Clone command
@@ -11,18 +50,33 @@ import binascii
 
 @app.command(short_help="Clone a file from your bitbox onto your local machine")
 def clone(
-  remote: str = typer.Argument(..., help="Name of the remote file to clone. If the file is owned by another user, use the '@someuser/somefile' syntax."),
-  local: str = typer.Option(None, help="Name of the local file to sync. If not specified, defaults to the same name as the remote file.")):
+  remote: str = typer.Argument(None, help="Name of the remote file to clone. If the file is owned by another user, use the '@someuser/somefile' syntax."),
+  local: str = typer.Option(None, help="Name of the local file to sync. If not specified, defaults to the same name as the remote file. For packs and `--all`, the directory to clone into, which defaults to the current directory."),
+  all: bool = typer.Option(False, "--all", help="Clone every file in your bitbox and every file shared with you. Files that are already cloned and up to date are skipped, so this can be rerun to pull changes."),
+  jobs: int = typer.Option(DEFAULT_MIRROR_JOBS, "--jobs", "-j", help="Number of files to download at once with `--all`")):
+  # With --all, mirror every remote file into the local directory
+  if all:
+    if remote is not None:
+      error("A remote file can't be given together with the `--all` flag.")
+    authInfo = config.load()
+    mirrorAll(lib.Client(authInfo), local or ".", jobs)
+    return
+  if remote is None:
+    error("Specify a remote file to clone, or use the `--all` flag to clone every file.")
+
   # If local is not specified, default to the same name as the remote file
+  localDirectory = local
   if (local == None):
     local = os.path.basename(remote)
   
-  # Confirm that the local file does not already exist
-  if os.path.exists(local):
+  # Confirm that the local file does not already exist. Packs are extracted into a directory instead,
+  # so this is checked once we know what the remote file is
+  if os.path.exists(local) and not os.path.isdir(local):
     error(f"A local file at '{local}' already exists. Use the `--local` flag to specify a different name for the local file.")
 
   # Get user info and try to establish a session
   authInfo = config.load()
+  client = lib.Client(authInfo)
 
   # Parse the remote file name and get file information
   owner, filename = parseRemoteFilename(remote, None)
@@ -47,41 +101,45 @@ def clone(
     # If we do, check if it's the latest version by seeing if the hashes match
     if (syncRecord.lastHash == fileHash):
       # If the hashes match, we can just copy the file and create a hardlink to it
-      syncinfo.copySync(syncRecord.syncId, remote)
+      syncinfo.copySync(syncRecord.syncId, local)
 
       # Print a success message and exit
       success(f"Remote file '{renderedRemoteFilename}' has been cloned onto your local machine as '{local}'.")
       return
   
-  # Otherwise, we need to download the file from the server
-  saveResponse = server.save(fileId, authInfo)
-  guard(saveResponse, {
-    server.Error.FILE_NOT_FOUND: f"Remote file '{renderedRemoteFilename}' does not exist.",
-    server.Error.FILE_NOT_READY: f"Remote file '{renderedRemoteFilename}' is being modified elsewhere. Please try again later.",
-  })
+  # Otherwise, use the cached contents if we already have them. Cached contents don't say whether
+  # the remote is in delta mode, so the sync record of an earlier clone of it is trusted for that
+  fileContents = client.blobCache.get(fileHash)
+  delta = syncRecord is not None and syncRecord.delta
+  if fileContents is None:
+    # If we don't, download and verify the file. Remotes in delta mode are put together from their
+    # chunks
+    try:
+      saveResponse = client.saveById(fileId)
+      fileContents, _, delta = client.fetchFile(saveResponse, operation="clone")
+    except lib.FileNotFoundException:
+      error(f"Remote file '{renderedRemoteFilename}' does not exist.")
+    except lib.FileNotReadyException:
+      error(f"Remote file '{renderedRemoteFilename}' is being modified elsewhere. Please try again later.")
+    except lib.DownloadException:
+      error(f"An error occurred downloading remote file '{renderedRemoteFilename}', or it does not match its hash. This file may have been tampered with.")
+    fileHash = saveResponse.hash
 
-  # Download the file
-  downloadResponse = requests.get(saveResponse.downloadURL)
-  if downloadResponse.status_code != 200:
-    error(f"An error occurred downloading remote file '{renderedRemoteFilename}'.")
-  
-  # Decrypt the file
-  downloadFileContents = downloadResponse.text
-  privateKey = authInfo.getPrivateKey()
-  fileKey = rsaDecrypt(binascii.unhexlify(saveResponse.encryptedKey), privateKey)
-  fileContents = Fernet(fileKey).decrypt(downloadFileContents)
-
-  # As a security measure, make sure the hashes match
-  downloadedFileHash = hashlib.sha256(fileContents).hexdigest()
-  if (downloadedFileHash != saveResponse.hash):
-    error(f"Hash for remote file '{renderedRemoteFilename}' does not match the downloaded copy. This file may have been tampered with.")
+  # Find out whether the remote is a pack from its marker, since its contents can't say. Packs are
+  # extracted into their files
+  if client.hasPackMarker(fileInfo):
+    clonePack(fileId, fileContents, renderedRemoteFilename, localDirectory or ".")
+    config.setSession(authInfo.session)
+    return
+  if os.path.exists(local):
+    error(f"A local file at '{local}' already exists. Use the `--local` flag to specify a different name for the local file.")
   
   # Write the file to the local machine
   with open(local, "wb") as f:
     f.write(fileContents)
   
   # Add a sync record for this file
-  syncinfo.createSync(fileId, saveResponse.hash, local)
+  syncinfo.createSync(fileId, fileHash, local, delta)
 
   # Print a success message
   success(f"Remote file '{renderedRemoteFilename}' has been cloned onto your local machine as '{local}'.")
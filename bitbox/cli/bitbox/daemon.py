@@ -0,0 +1,181 @@
+from bitbox.cli.bitbox.common import *
+from bitbox.cli.bitbox.jobqueue import *
+from bitbox.cli import *
+import subprocess
+import threading
+import sys
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+#
+# Parameters
+#
+
+BITBOX_DAEMON_LOCK_PATH = os.path.join(BITBOX_CONFIG_FOLDER, "daemon.lock")
+BITBOX_DAEMON_THROTTLE_PATH = os.path.join(BITBOX_CONFIG_FOLDER, "daemon.throttle")
+DEFAULT_DAEMON_JOBS = 2
+DEFAULT_DAEMON_POLL_INTERVAL = 1.0
+
+# Each job runs as `bitbox` in a process of its own
+JOB_ENTRY_POINT = "from bitbox.cli.bitbox.main import run; run()"
+
+#
+# Daemon
+#
+
+class Daemon:
+  """
+  Runs the jobs in the queue in the background, highest priority first, a few at a time. Each job
+  runs `bitbox` in a process of its own with the session the daemon logged in with, so the user only
+  authenticates once however many jobs run. Jobs have nothing to read from, so they can't prompt for
+  the password of a password-protected key, and the daemon refuses to run with one. The jobs share
+  one bucket for the bandwidth limit, kept in a file, so the jobs that run at once never go over it
+  together, and a job that runs alone gets all of it.
+  """
+  queue: JobQueue
+  jobs: int
+  schedule: Optional[lib.RateSchedule]
+  pollInterval: float
+
+  def __init__(self, queue: JobQueue, jobs: int, schedule: Optional[lib.RateSchedule], pollInterval: float):
+    self.queue = queue
+    self.jobs = jobs
+    self.schedule = schedule
+    self.pollInterval = pollInterval
+
+  def runJob(self, job: Job) -> int:
+    """
+    :returns: The exit code of the job.
+    """
+    # Have the job share the bandwidth with the others. Where buckets can't be kept in files, each
+    # job gets an even share of it instead
+    env = dict(os.environ)
+    env["BITBOX_CONFIG_FOLDER"] = BITBOX_CONFIG_FOLDER
+    if self.schedule is not None and fcntl is not None:
+      env["BITBOX_LIMIT_RATE"] = str(self.schedule)
+      env["BITBOX_LIMIT_RATE_FILE"] = BITBOX_DAEMON_THROTTLE_PATH
+    elif self.schedule is not None:
+      env["BITBOX_LIMIT_RATE"] = str(self.schedule.scaled(1 / self.jobs))
+
+    # Run it with its output in its log, and nothing to read from, so that commands that would
+    # prompt fail instead of waiting forever
+    os.makedirs(BITBOX_JOBS_LOG_FOLDER, exist_ok=True)
+    with open(job.logPath, "wb") as log:
+      try:
+        process = subprocess.run([sys.executable, "-c", JOB_ENTRY_POINT] + job.argv,
+          cwd=job.cwd, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        return process.returncode
+      except OSError as e:
+        log.write(f"Could not run job: {e}\n".encode("utf-8"))
+        return 1
+
+  def worker(self) -> None:
+    while True:
+      job = self.queue.claim()
+      if job is None:
+        time.sleep(self.pollInterval)
+        continue
+      console.print(f"Started job {job.jobId}: bitbox {' '.join(job.argv)}")
+      returnCode = self.runJob(job)
+      self.queue.finish(job.jobId, returnCode)
+      if returnCode == 0:
+        console.print(f"Finished job {job.jobId}.")
+      else:
+        warning(f"Job {job.jobId} failed. See '{job.logPath}' for its output.")
+
+  def run(self) -> None:
+    workers = [threading.Thread(target=self.worker, daemon=True) for _ in range(self.jobs)]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+
+#
+# Utility functions
+#
+
+def lockDaemon() -> Optional[Any]:
+  """
+  Take the lock that only one daemon can hold at a time.
+
+  :returns: The open lock file, which holds the lock until it is closed, or None if another daemon
+    holds it.
+  """
+  lockFile = open(BITBOX_DAEMON_LOCK_PATH, "w")
+  if fcntl is None:
+    return lockFile
+  try:
+    fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except OSError:
+    lockFile.close()
+    return None
+  return lockFile
+
+def keyNeedsPassword() -> bool:
+  """
+  :returns: Whether the private key is password-protected, which jobs can't prompt for.
+  """
+  keyInfo = config.getKeyInfo()
+  return keyInfo is not None and keyInfo.encrypted
+
+def daemonRunning() -> bool:
+  if fcntl is None or not os.path.exists(BITBOX_DAEMON_LOCK_PATH):
+    return False
+  lockFile = lockDaemon()
+  if lockFile is None:
+    return True
+  lockFile.close()
+  return False
+
+#
+# Daemon command
+#
+
+@app.command(short_help="Run queued jobs in the background")
+def daemon(
+  jobs: int = typer.Option(DEFAULT_DAEMON_JOBS, "--jobs", "-j", min=1, help="Number of jobs to run at once"),
+  limitRate: str = typer.Option(None, "--limit-rate", help="Total bandwidth for all jobs, in bytes per second with an optional suffix of 'k', 'M' or 'G' (e.g. '2M'), or a schedule like '09:00-18:00=512k,4M'. Defaults to the limit for every command."),
+  pollInterval: float = typer.Option(DEFAULT_DAEMON_POLL_INTERVAL, "--poll-interval", help="Time in seconds between checks for new jobs")):
+  # Parse the bandwidth limit
+  if limitRate is not None:
+    schedule = parseLimitRate(limitRate)
+  else:
+    throttle = lib.defaultThrottle()
+    schedule = None if throttle is None else throttle.schedule
+
+  # Jobs can't prompt for the password of the private key, so they would fail as soon as they needed it
+  if keyNeedsPassword():
+    error("The bitbox daemon can't run jobs with a password-protected key, since they can't prompt for the password. Run the commands directly instead.")
+
+  # Make sure no other daemon is running
+  lockFile = lockDaemon()
+  if lockFile is None:
+    error("The bitbox daemon is already running.")
+
+  # Log in once, and save the session for the jobs to use
+  authInfo = config.load()
+  config.setSession(authInfo.session)
+
+  # Queue the jobs that were interrupted the last time the daemon stopped again
+  queue = JobQueue()
+  recovered = queue.recover()
+  if recovered > 0:
+    warning(f"Restarting {recovered} job{'s' if recovered > 1 else ''} that did not finish the last time the daemon ran.")
+
+  # Run jobs until interrupted
+  success(f"Running queued jobs, {jobs} at a time. Press Ctrl+C to stop.")
+  try:
+    Daemon(queue, jobs, schedule, pollInterval).run()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    lockFile.close()
+
+def run():
+  # `bitboxd` is short for `bitbox daemon`
+  sys.argv = sys.argv[:1] + ["daemon"] + sys.argv[1:]
+  from bitbox.cli.bitbox.main import run as runBitbox
+  runBitbox()
@@ -8,19 +8,24 @@ def delete(remote: str = typer.Argument(..., help="Name of the remote file to de
   # Get user info and try to establish a session
   authInfo = config.load()
 
-  # Get file information
+  # Get file information from a listing, which also has the chunks and marker of the file if it has any
+  client = lib.Client(authInfo)
   owner = authInfo.keyInfo.username
   filename = remote
-  fileInfo = server.fileInfo(remote, authInfo.keyInfo.username, authInfo)
-  guard(fileInfo, {
-    server.Error.FILE_NOT_FOUND: f"Remote file '@{owner}/{filename}' does not exist.",
-  })
+  filesInfo = client.filesInfo()
+  fileInfo = next((fileInfo for fileInfo in filesInfo if fileInfo.owner == owner and fileInfo.name == filename), None)
+  if fileInfo is None:
+    error(f"Remote file '@{owner}/{filename}' does not exist.")
   fileId = fileInfo.fileId
 
   # Delete the file
   deleteResponse = server.delete(fileId, authInfo)
   guard(deleteResponse)
 
+  # Delete the chunks of the file, if it was in delta mode, and its marker, if it was a pack
+  client.deleteChunks(filename, filesInfo=filesInfo)
+  client.unmarkPack(filename, filesInfo)
+
   # Delete the syncs corresponding to the file
   syncinfo.deleteSyncsByRemote(fileId)
   
@@ -0,0 +1,45 @@
+from bitbox.cli.bitbox.common import *
+from bitbox.cli.bitbox.jobqueue import *
+from bitbox.cli.bitbox.daemon import daemonRunning, keyNeedsPassword
+from bitbox.cli import *
+
+#
+# Utility functions
+#
+
+def showJobResult(job: Job) -> None:
+  # Print what the job printed, then exit the way it did
+  if os.path.exists(job.logPath):
+    with open(job.logPath, "rb") as log:
+      sys.stdout.buffer.write(log.read())
+    sys.stdout.buffer.flush()
+  if job.state == "cancelled":
+    error(f"Job {job.jobId} was cancelled.")
+  raise typer.Exit(code=job.returnCode)
+
+#
+# Enqueue command
+#
+
+@app.command(short_help="Queue a command to run in the background", context_settings={"allow_extra_args": True, "ignore_unknown_options": True})
+def enqueue(
+  ctx: typer.Context,
+  command: str = typer.Argument(..., help=f"Command to run, which is one of: {', '.join(JOB_COMMANDS)}. Its arguments follow it."),
+  priority: int = typer.Option(0, "--priority", "-p", help="Priority of the job. Jobs with a higher priority run first."),
+  wait: bool = typer.Option(False, "--wait", help="Wait for the job to finish, then print its output")):
+  # Check that the command can be run in the background
+  if command not in JOB_COMMANDS:
+    error(f"'{command}' can't be run in the background. Queue one of: {', '.join(JOB_COMMANDS)}.")
+  if keyNeedsPassword():
+    error("Commands can't be run in the background with a password-protected key, since they can't prompt for the password. Run the command directly instead.")
+
+  # Queue it to run in the current directory
+  queue = JobQueue()
+  jobId = queue.enqueue([command] + ctx.args, os.getcwd(), priority)
+  success(f"Queued job {jobId}: bitbox {' '.join([command] + ctx.args)}")
+  if not daemonRunning():
+    warning("The bitbox daemon is not running, so the job will wait until it is started with `bitboxd`.")
+
+  # Wait for it to finish if requested
+  if wait:
+    showJobResult(queue.wait(jobId))
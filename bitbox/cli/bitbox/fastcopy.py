@@ -0,0 +1,104 @@
+import bitbox.metrics as metrics
+from typing import Callable, List, Tuple
+import errno
+import fcntl
+import os
+import shutil
+
+#
+# Parameters
+#
+
+# _IOW(0x94, 9, int), from linux/fs.h
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 1024 ** 3
+
+# Errors meaning a copy method isn't available here, as opposed to the copy having failed
+UNSUPPORTED_ERRNOS = set([errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EPERM, errno.EBADF, errno.ENOTSOCK])
+
+#
+# Copy methods
+#
+# Each method copies the whole of src into dst, which are open file descriptors with dst empty, and
+# raises an OSError with an errno in UNSUPPORTED_ERRNOS if it can't be used for these files.
+#
+
+def reflink(src: int, dst: int, size: int) -> None:
+  """
+  Share the source's data blocks with the destination (copy-on-write), on file systems that support
+  it like btrfs and XFS. No data is copied, whatever the size of the file.
+  """
+  fcntl.ioctl(dst, FICLONE, src)
+
+def copyFileRange(src: int, dst: int, size: int) -> None:
+  """
+  Copy inside the kernel with copy_file_range, which some file systems turn into a reflink or a
+  server-side copy.
+  """
+  if not hasattr(os, "copy_file_range"):
+    raise OSError(errno.ENOSYS, "copy_file_range is not available")
+  copied = 0
+  while copied < size:
+    sent = os.copy_file_range(src, dst, min(COPY_CHUNK_SIZE, size - copied))
+    if sent == 0:
+      break
+    copied += sent
+  if copied != size:
+    # Some file systems report success without copying everything
+    raise OSError(errno.ENOSYS, "copy_file_range stopped before the end of the file")
+
+def sendFile(src: int, dst: int, size: int) -> None:
+  """
+  Copy inside the kernel with sendfile, without passing the data through userspace.
+  """
+  copied = 0
+  while copied < size:
+    sent = os.sendfile(dst, src, copied, min(COPY_CHUNK_SIZE, size - copied))
+    if sent == 0:
+      break
+    copied += sent
+  if copied != size:
+    raise OSError(errno.ENOSYS, "sendfile stopped before the end of the file")
+
+def copyUserspace(src: int, dst: int, size: int) -> None:
+  """
+  Copy by reading and writing, which always works.
+  """
+  with open(src, "rb", closefd=False) as fsrc, open(dst, "wb", closefd=False) as fdst:
+    shutil.copyfileobj(fsrc, fdst)
+
+COPY_METHODS: List[Tuple[str, Callable[[int, int, int], None]]] = [
+  ("reflink", reflink),
+  ("copy_file_range", copyFileRange),
+  ("sendfile", sendFile),
+  ("userspace", copyUserspace)
+]
+
+#
+# Exports
+#
+
+def copyFile(src: str, dst: str, methods: List[Tuple[str, Callable[[int, int, int], None]]] = COPY_METHODS) -> str:
+  """
+  Copy a file using the cheapest method that works: a copy-on-write reflink, then a copy inside the
+  kernel, then a copy in userspace. The destination is created, or truncated if it already exists.
+
+  :returns: The name of the method that was used.
+  """
+  with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+    size = os.fstat(fsrc.fileno()).st_size
+    for name, method in methods:
+      try:
+        method(fsrc.fileno(), fdst.fileno(), size)
+      except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS or name == methods[-1][0]:
+          raise
+
+        # Start again from scratch with the next method
+        os.ftruncate(fdst.fileno(), 0)
+        os.lseek(fsrc.fileno(), 0, os.SEEK_SET)
+        os.lseek(fdst.fileno(), 0, os.SEEK_SET)
+        continue
+      metrics.localCopies.inc(method=name)
+      return name
+  raise OSError(errno.ENOSYS, "No copy method is available")
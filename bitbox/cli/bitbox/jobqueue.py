@@ -0,0 +1,171 @@
+from bitbox.cli.bitbox.common import *
+from dataclasses import dataclass
+from typing import Optional, List
+import sqlite3
+import json
+import time
+import os
+
+#
+# Parameters
+#
+
+BITBOX_JOBS_PATH = os.path.join(BITBOX_CONFIG_FOLDER, "jobs.db")
+BITBOX_JOBS_LOG_FOLDER = os.path.join(BITBOX_CONFIG_FOLDER, "jobs")
+
+# Commands that can be run in the background, which all work on the paths they are given
+JOB_COMMANDS = ["add", "update", "clone", "sync", "share"]
+
+#
+# Types
+#
+
+@dataclass
+class Job:
+  jobId: int
+  # Arguments to `bitbox`, starting with the command, and the directory to run it in
+  argv: List[str]
+  cwd: str
+  # Jobs with a higher priority run first, and jobs with the same priority run in order
+  priority: int
+  # One of "queued", "running", "done", "failed" or "cancelled"
+  state: str
+  returnCode: Optional[int]
+  created: float
+  started: Optional[float]
+  finished: Optional[float]
+
+  @property
+  def finishedRunning(self) -> bool:
+    return self.state in ["done", "failed", "cancelled"]
+
+  @property
+  def logPath(self) -> str:
+    return os.path.join(BITBOX_JOBS_LOG_FOLDER, f"{self.jobId}.log")
+
+#
+# Job queue
+#
+# Jobs are kept in a SQLite database in the config folder, so that they survive the daemon and the
+# commands that queued them exiting. Any number of processes can use the queue at once; the daemon
+# claims each job in a transaction of its own, so no job is ever run twice.
+#
+
+class JobQueue:
+  path: str
+
+  def __init__(self, path: str = BITBOX_JOBS_PATH):
+    self.path = path
+    with self.__connect() as connection:
+      connection.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+          jobId INTEGER PRIMARY KEY AUTOINCREMENT,
+          argv TEXT NOT NULL,
+          cwd TEXT NOT NULL,
+          priority INTEGER NOT NULL,
+          state TEXT NOT NULL,
+          returnCode INTEGER,
+          created REAL NOT NULL,
+          started REAL,
+          finished REAL
+        )""")
+      connection.execute("CREATE INDEX IF NOT EXISTS jobsByPriority ON jobs (state, priority DESC, jobId)")
+
+  def enqueue(self, argv: List[str], cwd: str, priority: int = 0) -> int:
+    """
+    :returns: The ID of the new job.
+    """
+    with self.__connect() as connection:
+      cursor = connection.execute(
+        "INSERT INTO jobs (argv, cwd, priority, state, created) VALUES (?, ?, ?, 'queued', ?)",
+        (json.dumps(argv), cwd, priority, time.time()))
+      return cursor.lastrowid
+
+  def claim(self) -> Optional[Job]:
+    """
+    Take the queued job with the highest priority, and mark it as running.
+
+    :returns: The job, or None if no jobs are queued.
+    """
+    with self.__connect() as connection:
+      connection.execute("BEGIN IMMEDIATE")
+      row = connection.execute("SELECT * FROM jobs WHERE state = 'queued' ORDER BY priority DESC, jobId LIMIT 1").fetchone()
+      if row is None:
+        connection.execute("COMMIT")
+        return None
+      connection.execute("UPDATE jobs SET state = 'running', started = ? WHERE jobId = ?", (time.time(), row["jobId"]))
+      connection.execute("COMMIT")
+    return self.get(row["jobId"])
+
+  def finish(self, jobId: int, returnCode: int) -> None:
+    with self.__connect() as connection:
+      connection.execute(
+        "UPDATE jobs SET state = ?, returnCode = ?, finished = ? WHERE jobId = ?",
+        ("done" if returnCode == 0 else "failed", returnCode, time.time(), jobId))
+
+  def cancel(self, jobId: int) -> bool:
+    """
+    Cancel a job that hasn't started yet.
+
+    :returns: Whether the job was cancelled.
+    """
+    with self.__connect() as connection:
+      cursor = connection.execute("UPDATE jobs SET state = 'cancelled', finished = ? WHERE jobId = ? AND state = 'queued'", (time.time(), jobId))
+      return cursor.rowcount > 0
+
+  def recover(self) -> int:
+    """
+    Queue the jobs that were running when the daemon last stopped again, so they run from the start.
+
+    :returns: The number of jobs queued again.
+    """
+    with self.__connect() as connection:
+      cursor = connection.execute("UPDATE jobs SET state = 'queued', started = NULL WHERE state = 'running'")
+      return cursor.rowcount
+
+  def wait(self, jobId: int, interval: float = 1.0) -> Optional[Job]:
+    """
+    Wait for a job to finish running.
+
+    :returns: The finished job, or None if there is no such job.
+    """
+    while True:
+      job = self.get(jobId)
+      if job is None or job.finishedRunning:
+        return job
+      time.sleep(interval)
+
+  def get(self, jobId: int) -> Optional[Job]:
+    with self.__connect() as connection:
+      row = connection.execute("SELECT * FROM jobs WHERE jobId = ?", (jobId,)).fetchone()
+    return None if row is None else rowToJob(row)
+
+  def list(self, unfinished: bool = False) -> List[Job]:
+    """
+    :returns: Every job in the order they would run, or only the queued and running ones if
+      unfinished = True.
+    """
+    query = "SELECT * FROM jobs"
+    if unfinished:
+      query += " WHERE state IN ('queued', 'running')"
+    with self.__connect() as connection:
+      rows = connection.execute(query + " ORDER BY state = 'queued', priority DESC, jobId").fetchall()
+    return [rowToJob(row) for row in rows]
+
+  def __connect(self) -> sqlite3.Connection:
+    # Statements run outside of transactions unless a transaction is started explicitly
+    connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+def rowToJob(row: sqlite3.Row) -> Job:
+  return Job(
+    jobId=row["jobId"],
+    argv=json.loads(row["argv"]),
+    cwd=row["cwd"],
+    priority=row["priority"],
+    state=row["state"],
+    returnCode=row["returnCode"],
+    created=row["created"],
+    started=row["started"],
+    finished=row["finished"])
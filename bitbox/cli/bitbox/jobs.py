@@ -0,0 +1,56 @@
+from bitbox.cli.bitbox.common import *
+from bitbox.cli.bitbox.jobqueue import *
+from bitbox.cli.bitbox.enqueue import showJobResult
+from bitbox.cli import *
+
+#
+# Utility functions
+#
+
+def printJobs(jobs: List[Job]) -> None:
+  table = Table()
+  table.add_column("ID")
+  table.add_column("Command")
+  table.add_column("Priority")
+  table.add_column("State")
+  table.add_column("Queued")
+  for job in jobs:
+    state = job.state if job.returnCode is None or job.returnCode == 0 else f"{job.state} ({job.returnCode})"
+    table.add_row(
+      str(job.jobId),
+      f"bitbox {' '.join(job.argv)}",
+      str(job.priority),
+      state,
+      datetime.fromtimestamp(job.created).strftime("%Y-%m-%d %H:%M:%S"))
+  console.print(table)
+
+#
+# Jobs command
+#
+
+@app.command(short_help="List queued jobs, or wait for or cancel one of them")
+def jobs(
+  showAll: bool = typer.Option(False, "--all", "-a", help="Also list jobs that have finished"),
+  wait: int = typer.Option(None, "--wait", metavar="ID", help="Wait for a job to finish, then print its output"),
+  cancel: int = typer.Option(None, "--cancel", metavar="ID", help="Cancel a job that hasn't started yet")):
+  queue = JobQueue()
+
+  # Cancel a job
+  if cancel is not None:
+    job = queue.get(cancel)
+    if job is None:
+      error(f"Job {cancel} does not exist.")
+    if not queue.cancel(cancel):
+      error(f"Job {cancel} has already started, so it can't be cancelled.")
+    success(f"Cancelled job {cancel}.")
+    return
+
+  # Wait for a job
+  if wait is not None:
+    job = queue.wait(wait)
+    if job is None:
+      error(f"Job {wait} does not exist.")
+    showJobResult(job)
+
+  # List the jobs
+  printJobs(queue.list(unfinished=not showAll))
@@ -4,10 +4,15 @@ import bitbox.server as server
 import sys
 
 @app.callback(invoke_without_command=True)
-def main(ctx: typer.Context):
+def main(
+  ctx: typer.Context,
+  limitRate: str = typer.Option(None, "--limit-rate", help="Bandwidth for all transfers, in bytes per second with an optional suffix of 'k', 'M' or 'G' (e.g. '2M'), or a schedule like '09:00-18:00=512k,4M'. Overrides `BITBOX_LIMIT_RATE` and the limit set with `bitbox throttle`.")):
   # Get the key info
   keyInfo = config.getKeyInfo()
 
+  # Limit the bandwidth of transfers
+  limitTransfers(limitRate or BITBOX_LIMIT_RATE or config.getLimitRate())
+
   # # Log that a command has been invoked
   try:
     server.logCommand(" ".join(sys.argv[1:]), "" if keyInfo is None else keyInfo.username)
@@ -31,7 +36,7 @@ def main(ctx: typer.Context):
   # Print info
   printFilesInfo(keyInfo.username, filesInfo)
   bytesUsed = sum([file.bytes for file in filesInfo if file.owner == keyInfo.username])
-  console.print(f"\nTotal space usage: {humanReadableFilesize(bytesUsed)} / 1 GiB ({bytesUsed / 1073741824 :.0%})")
+  console.print(f"\nTotal space usage: {humanReadableFilesize(bytesUsed)} / {humanReadableFilesize(BITBOX_STORAGE_LIMIT)} ({bytesUsed / BITBOX_STORAGE_LIMIT :.0%})")
 
   # Save the session back onto the disk
   config.setSession(authInfo.session)
@@ -0,0 +1,232 @@
+from bitbox.cli.bitbox.common import *
+from bitbox.cli import *
+import bitbox.cli.bitbox.syncinfo as syncinfo
+from bitbox.lib.stream import hashFileobj
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Tuple
+import tempfile
+import shutil
+
+#
+# Parameters
+#
+
+DEFAULT_MIRROR_JOBS = 8
+
+#
+# Types
+#
+
+@dataclass
+class MirrorTask:
+  fileInfo: FileInfo
+  local: str
+  # Whether the local file is an existing clone that should be updated in place
+  existing: bool
+
+#
+# Exceptions
+#
+
+class MirrorException(Exception):
+  def __init__(self, message: str):
+    self.message = message
+
+#
+# Utility functions
+#
+
+def mirrorPath(directory: str, fileInfo: FileInfo, username: str) -> Optional[str]:
+  """
+  Get the local path a remote file is mirrored to. Files owned by the user are named by their
+  remote names, and files shared by other users are put in a folder named after the owner.
+
+  :returns: The local path, or None if the remote name can't be used as a local path.
+  """
+  parts = fileInfo.name.split("/")
+  if any(part in ("", ".", "..") for part in parts) or "\\" in fileInfo.name or "\0" in fileInfo.name:
+    return None
+  if fileInfo.owner != username:
+    parts = [f"@{fileInfo.owner}"] + parts
+  return os.path.join(directory, *parts)
+
+def planMirror(filesInfo: List[FileInfo], directory: str, username: str) -> Tuple[List[MirrorTask], int, List[Tuple[str, str]], List[str]]:
+  """
+  Work out which remote files need to be downloaded to bring a mirror up to date. Files whose clone
+  already has the latest hash are skipped, and clones with local edits are never overwritten. Packs
+  are skipped too, since their files are synchronized with the pack rather than a remote file of
+  their own, and are left to `bitbox clone`.
+
+  :returns: A tuple of the files to download, the number of files that are already up to date, the
+    (remote name, message) pairs of files that can't be mirrored, and the remote names of the packs
+    that were skipped.
+  """
+  syncRecords = { syncRecord.inode: syncRecord for syncRecord in syncinfo.readSyncInfo() }
+  packMarkers = { (fileInfo.owner, fileInfo.name) for fileInfo in filesInfo if lib.isPackMarker(fileInfo.name) }
+  tasks = []
+  upToDate = 0
+  failures = []
+  packs = []
+  claimed = set()
+  for fileInfo in filesInfo:
+    # Chunks of files in delta mode are downloaded as part of their files, and pack markers have no
+    # contents
+    if lib.isChunkName(fileInfo.name) or lib.isPackMarker(fileInfo.name):
+      continue
+    renderedRemoteFilename = renderRemoteFilename(fileInfo.name, fileInfo.owner)
+
+    # Packs would be mirrored as the archive itself, so they are skipped
+    if (fileInfo.owner, lib.packMarkerName(fileInfo.name)) in packMarkers:
+      packs.append(renderedRemoteFilename)
+      continue
+
+    # Work out where the file goes, making sure no two remote files are mirrored to the same place
+    local = mirrorPath(directory, fileInfo, username)
+    if local is None:
+      failures.append((renderedRemoteFilename, f"Remote file '{renderedRemoteFilename}' has a name that can't be used as a local path."))
+      continue
+    if local in claimed:
+      failures.append((renderedRemoteFilename, f"Another remote file is already being mirrored to '{local}'."))
+      continue
+    claimed.add(local)
+
+    # If there is nothing there yet, download the file
+    if not os.path.lexists(local):
+      tasks.append(MirrorTask(fileInfo=fileInfo, local=local, existing=False))
+      continue
+
+    # Otherwise, only touch the local file if it is a clone of this remote file
+    syncRecord = syncRecords.get(os.stat(local).st_ino) if os.path.isfile(local) else None
+    if syncRecord is None or syncRecord.fileId != fileInfo.fileId or syncRecord.member is not None:
+      failures.append((renderedRemoteFilename, f"A local file at '{local}' already exists and is not a clone of this remote file."))
+    elif syncRecord.lastHash == fileInfo.hash:
+      upToDate += 1
+    else:
+      # The remote file has changed since it was last pulled. Check that the clone hasn't changed too
+      with open(local, "rb") as f:
+        _, localHash, _ = hashFileobj(f)
+      if localHash != syncRecord.lastHash:
+        failures.append((renderedRemoteFilename, f"Local file '{local}' has edits. Push them with `bitbox update` or move the file, then mirror again."))
+      else:
+        tasks.append(MirrorTask(fileInfo=fileInfo, local=local, existing=True))
+  return tasks, upToDate, failures, packs
+
+def mirrorFile(client: lib.Client, task: MirrorTask) -> str:
+  """
+  Download a remote file to its place in the mirror. The download is verified before the local
+  file is touched, and existing clones are rewritten in place so that they stay linked to their
+  sync records.
+
+  :raises MirrorException: If the file could not be downloaded.
+
+  :returns: The hash of the downloaded file.
+  """
+  renderedRemoteFilename = renderRemoteFilename(task.fileInfo.name, task.fileInfo.owner)
+
+  # Get a download link for the file
+  try:
+    saveResponse = client.saveById(task.fileInfo.fileId)
+  except lib.FileNotFoundException:
+    raise MirrorException(f"Remote file '{renderedRemoteFilename}' has been deleted.")
+  except lib.FileNotReadyException:
+    raise MirrorException(f"Remote file '{renderedRemoteFilename}' is being modified elsewhere. Please try again later.")
+
+  # Download and decrypt the file next to where it is going
+  directory = os.path.dirname(task.local) or "."
+  os.makedirs(directory, exist_ok=True)
+  with tempfile.NamedTemporaryFile(dir=directory, prefix=".bitbox-", delete=False) as f:
+    tempPath = f.name
+    try:
+      client.fetchInto(saveResponse, f, operation="mirror")
+    except lib.DownloadException:
+      f.close()
+      os.unlink(tempPath)
+      raise MirrorException(f"An error occurred downloading remote file '{renderedRemoteFilename}', or it does not match its hash. This file may have been tampered with.")
+
+  # Move the file into place
+  if task.existing:
+    with open(tempPath, "rb") as src, open(task.local, "wb") as dst:
+      shutil.copyfileobj(src, dst)
+    os.unlink(tempPath)
+  else:
+    os.replace(tempPath, task.local)
+  return saveResponse.hash
+
+def mirrorAll(client: lib.Client, directory: str, jobs: int) -> None:
+  """
+  Bring a mirror of every file in the user's bitbox, and every file shared with them, up to date.
+  The files are listed with a single request and downloaded concurrently. Running it again only
+  downloads the files that have changed.
+  """
+  # List every remote file at once, and work out which ones need downloading
+  os.makedirs(directory, exist_ok=True)
+  filesInfo = client.filesInfo()
+  tasks, upToDate, failures, packs = planMirror(filesInfo, directory, client.username)
+
+  # Download the files concurrently
+  created = []
+  updated = []
+  deltas = {}
+  renderedRemoteFilenames = {}
+  with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+    futures = { executor.submit(mirrorFile, client, task): task for task in tasks }
+    for future in as_completed(futures):
+      task = futures[future]
+      renderedRemoteFilename = renderRemoteFilename(task.fileInfo.name, task.fileInfo.owner)
+      try:
+        fileHash = future.result()
+      except MirrorException as e:
+        failures.append((renderedRemoteFilename, e.message))
+        continue
+      except Exception as e:
+        failures.append((renderedRemoteFilename, f"An error occurred: {e}"))
+        continue
+      if task.existing:
+        updated.append((task.local, fileHash))
+        deltas[task.local] = client.hasChunks(task.fileInfo, filesInfo)
+      else:
+        created.append(syncinfo.NewSync(fileId=task.fileInfo.fileId, hash=fileHash, localFile=task.local, delta=client.hasChunks(task.fileInfo, filesInfo)))
+        renderedRemoteFilenames[task.local] = renderedRemoteFilename
+      console.print(f"Remote file '{renderedRemoteFilename}' has been mirrored to '{task.local}'.")
+
+  # Write all the sync records at once
+  for newSync, message in syncinfo.createSyncs(created):
+    created.remove(newSync)
+    failures.append((renderedRemoteFilenames[newSync.localFile], message))
+  syncinfo.updateSyncs(updated, deltas)
+
+  # Save the session back onto the disk
+  config.setSession(client.authInfo.session)
+
+  # Report the packs that were skipped, and the files that could not be mirrored
+  for renderedRemoteFilename in sorted(packs):
+    warning(f"Remote file '{renderedRemoteFilename}' is a pack, so it has been skipped. Clone it with `bitbox clone` to extract its files.")
+  summary = f"{len(created)} files downloaded, {len(updated)} updated, {upToDate} already up to date"
+  if len(packs) > 0:
+    summary += f", {len(packs)} packs skipped"
+  if len(failures) > 0:
+    table = Table()
+    table.add_column("Remote File")
+    table.add_column("Error")
+    for remote, message in sorted(failures):
+      table.add_row(remote, message)
+    console.print(table)
+    error(f"{summary}, {len(failures)} failed.")
+  else:
+    success(f"\nMirror successful: {summary}.")
+
+#
+# Mirror command
+#
+
+@app.command(short_help="Download every file in your bitbox and every file shared with you")
+def mirror(
+  directory: str = typer.Argument(..., help="Local directory to mirror into. Files shared by other users are put in folders named like '@someuser'."),
+  jobs: int = typer.Option(DEFAULT_MIRROR_JOBS, "--jobs", "-j", help="Number of files to download at once")):
+  # Get user info and try to establish a session
+  authInfo = config.load()
+  client = lib.Client(authInfo)
+
+  # Bring the mirror up to date
+  mirrorAll(client, directory, jobs)
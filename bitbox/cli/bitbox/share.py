@@ -14,11 +14,13 @@ def share(
   # Get user info and try to establish a session
   authInfo = config.load()
 
-  # Get the encrypted file key from the server
-  fileInfo = server.fileInfo(remote, authInfo.keyInfo.username, authInfo)
-  guard(fileInfo, {
-    server.Error.FILE_NOT_FOUND: f"Remote file '@{authInfo.keyInfo.username}/{remote}' does not exist."
-  })
+  # Get the encrypted file key from a listing, which also has the chunks and marker of the file if
+  # it has any
+  client = lib.Client(authInfo)
+  filesInfo = client.filesInfo()
+  fileInfo = next((fileInfo for fileInfo in filesInfo if fileInfo.owner == authInfo.keyInfo.username and fileInfo.name == remote), None)
+  if fileInfo is None:
+    error(f"Remote file '@{authInfo.keyInfo.username}/{remote}' does not exist.")
   fileId = fileInfo.fileId
   encryptedKey = fileInfo.encryptedKey
   
@@ -52,6 +54,9 @@ def share(
   shareResponse = server.share(fileId, recipientEncryptedKeys, authInfo)
   guard(shareResponse)
 
+  # Share the chunks of the file too, if it is in delta mode
+  client.shareChunks(remote, decryptedFileKey, publicKeys, filesInfo)
+
   # Print a success message
   success(f"{remote} has been shared with: {', '.join(recipients)}")
 
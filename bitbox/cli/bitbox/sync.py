@@ -1,35 +1,41 @@
 from bitbox.cli.bitbox.common import *
 from bitbox.cli import *
-import bitbox.server as server
 import bitbox.cli.bitbox.syncinfo as syncinfo
+import bitbox.cli.bitbox.walk as walk
 from rich.prompt import Confirm
-import binascii
-from cryptography.fernet import Fernet
+from typing import Tuple
 
 #
 # Utility functions
 #
 
-def syncFile(authInfo: AuthInfo, file: str, syncRecord : syncinfo.SyncRecord, errMode: PrintMode = PrintMode.WARNING) -> bool:
+def syncFile(client: lib.Client, file: str, syncRecord : syncinfo.SyncRecord, filesInfo: List[FileInfo], errMode: PrintMode = PrintMode.WARNING) -> bool:
+  """
+  Synchronize a local file with its remote.
+
+  :param filesInfo: A listing of the user's files, to find out whether the remote is in delta mode.
+
+  :returns: Whether the file was modified.
+  """
   # Get the has of the last pull
   lastPullHash = syncRecord.lastHash
 
   # Get the latest file info from the server
   fileId = syncRecord.fileId
-  serverFileInfo = server.fileInfoById(fileId, authInfo)
-  if (isinstance(serverFileInfo, server.Error) and serverFileInfo == server.Error.FILE_NOT_FOUND):
+  try:
+    serverFileInfo = client.fileInfoById(fileId)
+  except lib.FileNotFoundException:
     syncinfo.deleteSyncsByRemote(fileId)
     print(f"The remote for local file '{file}' has been deleted from your bitbox. It can no longer be synchronized.", mode=errMode)
     return False
-  guard(serverFileInfo)
   owner = serverFileInfo.owner
   filename = serverFileInfo.name
   serverHash = serverFileInfo.hash
 
   # Read the file and get its hash
   with open(file, "rb") as f:
-    fileContents = f.read()
-  currentFileHash = hashlib.sha256(fileContents).hexdigest()
+    localContents = f.read()
+  currentFileHash = hashlib.sha256(localContents).hexdigest()
 
   # If the current hash is the same from the one on the server, the file hasn't changed
   if serverHash == currentFileHash:
@@ -42,71 +48,160 @@ def syncFile(authInfo: AuthInfo, file: str, syncRecord : syncinfo.SyncRecord, er
     if not overwrite:
       return False
   
-  # Get a download link from the server
-  saveResponse = server.save(fileId, authInfo)
-  if (isinstance(saveResponse, server.Error) and saveResponse == server.Error.FILE_NOT_READY):
-    warning(f"Skipping local file '{file}' because its remote at '@{owner}/{filename}' is being modified elsewhere. Try synchronizing this file later.")
-    return False
-  guard(saveResponse)
+  # Use the cached contents if we already have them
+  fileContents = client.blobCache.get(serverHash)
+  if fileContents is None:
+    # If we don't, download and verify the file. Remotes in delta mode are put together from their
+    # chunks, reusing the ones the local file already has
+    try:
+      saveResponse = client.saveById(fileId)
+      fileContents, _ = client.fetch(saveResponse, operation="sync", local=localContents)
+    except lib.FileNotFoundException:
+      print(f"Skipping local file '{file}' because its remote at '@{owner}/{filename}' has just been deleted.", mode=errMode)
+      return False
+    except lib.FileNotReadyException:
+      warning(f"Skipping local file '{file}' because its remote at '@{owner}/{filename}' is being modified elsewhere. Try synchronizing this file later.")
+      return False
+    except lib.DownloadException:
+      print(f"Skipping local file '{file}' because an error occured while downloading its remote at '@{owner}/{filename}', or it does not match its hash. This file may have been tampered with.", mode=errMode)
+      return False
+    serverHash = saveResponse.hash
 
-  # Download the file
-  downloadResponse = requests.get(saveResponse.downloadURL)
-  if downloadResponse.status_code != 200:
-    print(f"Skipping local file '{file}' because an error occured while downloading its remote at '@{owner}/{filename}'.", mode=errMode)
-    return False
-  
-  # Decrypt the file
-  downloadFileContents = downloadResponse.text
-  privateKey = authInfo.getPrivateKey()
-  fileKey = rsaDecrypt(binascii.unhexlify(saveResponse.encryptedKey), privateKey)
-  fileContents = Fernet(fileKey).decrypt(downloadFileContents)
-
-  # As a security measure, make sure the hashes match
-  downloadedFileHash = hashlib.sha256(fileContents).hexdigest()
-  if (downloadedFileHash != saveResponse.hash):
-    print(f"Skipping local file '{file}' because the hash for remote file '@{owner}/{filename}' does not match the downloaded copy. This file may have been tampered with.", mode=errMode)
-    return False
-  
   # Write the file to the local machine
   with open(file, "wb") as f:
     f.write(fileContents)
   
-  # Update the sync record
-  syncinfo.updateSync(file, saveResponse.hash)
+  # Update the sync record, along with whether the remote is in delta mode
+  syncinfo.updateSync(file, serverHash, client.hasChunks(serverFileInfo, filesInfo))
 
   # Print a success message
   console.print(f"Local file '{file}' synchronized with its remote at '@{owner}/{filename}'.")
   return True
 
+def syncPack(client: lib.Client, fileId: str, files: List[Tuple[str, syncinfo.SyncRecord]], errMode: PrintMode = PrintMode.WARNING) -> int:
+  """
+  Synchronize local files that were extracted from the same pack, downloading the pack only once.
+
+  :returns: The number of files modified.
+  """
+  # Get the latest file info from the server
+  try:
+    serverFileInfo = client.fileInfoById(fileId)
+  except lib.FileNotFoundException:
+    syncinfo.deleteSyncsByRemote(fileId)
+    for file, _ in files:
+      print(f"The remote for local file '{file}' has been deleted from your bitbox. It can no longer be synchronized.", mode=errMode)
+    return 0
+  owner = serverFileInfo.owner
+  filename = serverFileInfo.name
+
+  # Use the cached pack if we already have it
+  packBlob = client.blobCache.get(serverFileInfo.hash)
+  if packBlob is None:
+    # If we don't, download and verify the pack
+    try:
+      packBlob, _ = client.fetch(client.saveById(fileId), operation="sync")
+    except lib.FileNotFoundException:
+      print(f"Skipping {len(files)} local files because their pack at '@{owner}/{filename}' has just been deleted.", mode=errMode)
+      return 0
+    except lib.FileNotReadyException:
+      warning(f"Skipping {len(files)} local files because their pack at '@{owner}/{filename}' is being modified elsewhere. Try synchronizing these files later.")
+      return 0
+    except lib.DownloadException:
+      print(f"Skipping {len(files)} local files because an error occured while downloading their pack at '@{owner}/{filename}', or it does not match its hash. This file may have been tampered with.", mode=errMode)
+      return 0
+
+  # Read the index of the pack
+  try:
+    members = lib.readPackIndex(packBlob)
+  except lib.PackException as e:
+    print(f"Skipping {len(files)} local files because their pack '@{owner}/{filename}' is not valid: {e.message}", mode=errMode)
+    return 0
+
+  modifiedCount = 0
+  for file, syncRecord in files:
+    # Find this file in the pack
+    member = members.get(syncRecord.member)
+    if member is None:
+      print(f"Local file '{file}' has been removed from its pack at '@{owner}/{filename}'. It can no longer be synchronized.", mode=errMode)
+      continue
+
+    # Read the file and get its hash
+    with open(file, "rb") as f:
+      currentFileHash = hashlib.sha256(f.read()).hexdigest()
+
+    # If the current hash is the same as the one in the pack, the file hasn't changed
+    if member.hash == currentFileHash:
+      warning(f"Skipping local file '{file}' because there have been no local or remote changes.")
+      continue
+
+    # If the current hash is different from the one from the last pull, there have been local changes to the file
+    if syncRecord.lastHash != currentFileHash:
+      overwrite = Confirm.ask(f"Local file '{file}' has edits. Synchronize with remote and overwrite changes?", default=False)
+      if not overwrite:
+        continue
+
+    # Write the file to the local machine
+    try:
+      memberContents = lib.extractMember(packBlob, member)
+    except lib.PackException as e:
+      print(f"Skipping local file '{file}'. {e.message} This file may have been tampered with.", mode=errMode)
+      continue
+    with open(file, "wb") as f:
+      f.write(memberContents)
+
+    # Update the sync record
+    syncinfo.updateSync(file, member.hash)
+
+    # Print a success message
+    console.print(f"Local file '{file}' synchronized with '{syncRecord.member}' in its pack at '@{owner}/{filename}'.")
+    modifiedCount += 1
+  return modifiedCount
+
+def syncFiles(client: lib.Client, files: List[Tuple[str, syncinfo.SyncRecord]], errMode: PrintMode = PrintMode.WARNING) -> int:
+  """
+  Synchronize local files with their remotes. Files extracted from the same pack are synchronized
+  together.
+
+  :returns: The number of files modified.
+  """
+  # List the user's files once, to find out which remotes are in delta mode
+  plain = [(file, syncRecord) for file, syncRecord in files if syncRecord.member is None]
+  filesInfo = client.filesInfo() if len(plain) > 0 else []
+
+  modifiedCount = 0
+  packs: Dict[str, List[Tuple[str, syncinfo.SyncRecord]]] = {}
+  for file, syncRecord in files:
+    if syncRecord.member is None:
+      modifiedCount += syncFile(client, file, syncRecord, filesInfo, errMode)
+    else:
+      packs.setdefault(syncRecord.fileId, []).append((file, syncRecord))
+  for fileId, packFiles in packs.items():
+    modifiedCount += syncPack(client, fileId, packFiles, errMode)
+  return modifiedCount
+
 #
 # Sync command
 #
 
 @app.command(short_help="Synchronize all clones in a given path with their remotes")
-def sync(path: str = typer.Argument(".", help="Path to synchronize")):
+def sync(
+  path: str = typer.Argument(".", help="Path to synchronize"),
+  rediscover: bool = typer.Option(False, "--rediscover", help="Search the whole path for clones, to find clones that were moved into it")):
   # Get user info and try to establish a session
   authInfo = config.load()
+  client = lib.Client(authInfo)
 
   # Keep track of how many files have been modified
   modifiedCount = 0
 
   # Check if the path refers to a directory
   if os.path.isdir(path):
-    # Get a list of all files in the path
-    files = []
-    for root, dirs, fileNames in os.walk(path):
-      for fileName in fileNames:
-        # Check if the file is an existing sync point
-        file = os.path.join(root, fileName)
-        syncRecord = syncinfo.lookupSync(file)
-
-        # If it is, add it to the list of files to sync
-        if syncRecord is not None:
-          files.append((file, syncRecord))
+    # Get a list of all the existing sync points in the path, skipping ignored directories
+    files = walk.locateClones(path, rediscover)
     
     # Pull changes from the server for each file
-    for file, syncRecord in files:
-      modifiedCount += syncFile(authInfo, file, syncRecord, PrintMode.WARNING)
+    modifiedCount += syncFiles(client, files, PrintMode.WARNING)
     
     if len(files) == 0:
       warning(f"No clones found. Nothing to synchronize.")
@@ -123,7 +218,7 @@ def sync(path: str = typer.Argument(".", help="Path to synchronize")):
     if syncRecord is None:
       error(f"Local file '{path}' is not known to be synchronized with any remote.")
     else:
-      modifiedCount += syncFile(authInfo, path, syncRecord, PrintMode.ERROR)
+      modifiedCount += syncFiles(client, [(path, syncRecord)], PrintMode.ERROR)
 
   # Print a success message
   success(f"\nSync successful: {modifiedCount} files modified.")
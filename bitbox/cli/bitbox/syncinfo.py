@@ -1,18 +1,24 @@
 from bitbox.parameters import *
 from bitbox.cli import *
 from bitbox.cli.bitbox.common import *
-from dataclasses import dataclass
-from typing import Optional, List
+import bitbox.cli.bitbox.fastcopy as fastcopy
+from dataclasses import dataclass, field
+from typing import Optional, List, Tuple, Dict
+import contextlib
+import tempfile
+import bisect
+import hashlib
+import fcntl
 import json
 import os
-import shutil
 
 #
 # Parameters
 #
 
 BITBOX_SYNCS_FOLDER = os.path.join(BITBOX_CONFIG_FOLDER, BITBOX_SYNCS_FOLDERNAME)
-BITBOX_SYNCINFO_PATH = os.path.join(BITBOX_SYNCS_FOLDERNAME, BITBOX_SYNCINFO_FILENAME)
+BITBOX_SYNCINFO_PATH = os.path.join(BITBOX_SYNCS_FOLDER, BITBOX_SYNCINFO_FILENAME)
+BITBOX_SYNCINFO_LOCK_PATH = BITBOX_SYNCINFO_PATH + ".lock"
 
 #
 # Types
@@ -26,9 +32,32 @@ class SyncRecord:
   fileId: str
   lastHash: str
   inode: Inode
+  # Name of the file inside its remote, if the remote is a pack of many files
+  member: Optional[str] = None
+  # Size and modification time (in nanoseconds) of the local file when lastHash was recorded, so
+  # that unchanged files don't need to be hashed again
+  size: Optional[int] = None
+  mtime: Optional[int] = None
+  # Absolute paths the clone is known to live at, and the device it is on, so that clones can be
+  # found without walking the file system
+  paths: List[str] = field(default_factory=list)
+  device: Optional[int] = None
+  # Absolute paths of directories that were walked without finding the clone, so that clones with no
+  # recorded paths don't make every directory be walked again
+  walkedRoots: List[str] = field(default_factory=list)
+  # Whether the remote is in delta mode, so that updates only upload the chunks that changed
+  delta: bool = False
 
 SyncInfo = List[SyncRecord]
 
+@dataclass
+class NewSync:
+  fileId: str
+  hash: str
+  localFile: str
+  member: Optional[str] = None
+  delta: bool = False
+
 #
 # Exceptions
 #
@@ -52,13 +81,34 @@ def readSyncInfo() -> SyncInfo:
   return [SyncRecord(**syncRecord) for syncRecord in syncInfoJSON]
 
 def writeSyncInfo(syncInfo: SyncInfo) -> None:
+  # Write to a temporary file and move it into place, so that readers never see a partial file
   syncInfoJSON = [syncRecord.__dict__ for syncRecord in syncInfo]
   try:
-    with open(BITBOX_SYNCINFO_PATH, "w") as f:
-      json.dump(syncInfoJSON, f, indent=2)
+    with tempfile.NamedTemporaryFile("w", dir=BITBOX_SYNCS_FOLDER, prefix=".syncinfo-", delete=False) as f:
+      tempPath = f.name
+      try:
+        json.dump(syncInfoJSON, f, indent=2)
+      except BaseException:
+        f.close()
+        os.unlink(tempPath)
+        raise
+    os.replace(tempPath, BITBOX_SYNCINFO_PATH)
   except Exception as e:
     raise ConfigParseException(BITBOX_SYNCINFO_PATH, e)
 
+@contextlib.contextmanager
+def modifySyncInfo():
+  """
+  Read the sync records to modify them, and write them back at the end of the block unless it
+  raises. Other processes, like the jobs of the bitbox daemon, wait to modify the sync records until
+  the block is done, so that none of their changes are lost.
+  """
+  with open(BITBOX_SYNCINFO_LOCK_PATH, "w") as lockFile:
+    fcntl.flock(lockFile, fcntl.LOCK_EX)
+    syncInfo = readSyncInfo()
+    yield syncInfo
+    writeSyncInfo(syncInfo)
+
 def findInSyncByInode(syncInfo: SyncInfo, inode: Inode) -> Optional[SyncRecord]:
   for syncRecord in syncInfo:
     if syncRecord.inode == inode:
@@ -75,40 +125,139 @@ def getNewSyncId(syncInfo: SyncInfo) -> int:
 def getLinkName(syncRecord: SyncRecord) -> str:
   return os.path.join(BITBOX_SYNCS_FOLDER, f"{syncRecord.fileId}_{syncRecord.syncId}")
 
+def recordStat(syncRecord: SyncRecord, stat: os.stat_result) -> None:
+  syncRecord.size = stat.st_size
+  syncRecord.mtime = stat.st_mtime_ns
+
+def isStatUnchanged(syncRecord: SyncRecord, stat: os.stat_result) -> bool:
+  return syncRecord.size == stat.st_size and syncRecord.mtime == stat.st_mtime_ns
+
+def recordPath(syncRecord: SyncRecord, localFile: str, stat: os.stat_result) -> None:
+  # The hard links in the syncs folder are not clones, so they are never recorded
+  path = os.path.abspath(localFile)
+  if os.path.dirname(path) == os.path.abspath(BITBOX_SYNCS_FOLDER):
+    return
+  if path not in syncRecord.paths:
+    syncRecord.paths.append(path)
+  syncRecord.device = stat.st_dev
+
+def recordWalk(syncRecord: SyncRecord, root: str) -> None:
+  # Directories under the walked one are covered by it, so they don't need to be kept
+  root = os.path.abspath(root)
+  prefix = os.path.join(root, "")
+  syncRecord.walkedRoots = [walked for walked in syncRecord.walkedRoots if not walked.startswith(prefix) and walked != root] + [root]
+
+def isWalked(syncRecord: SyncRecord, directory: str) -> bool:
+  """
+  Check whether a directory, or a directory it is in, was walked without finding the clone.
+  """
+  prefix = os.path.join(os.path.abspath(directory), "")
+  return any(prefix.startswith(os.path.join(walked, "")) for walked in syncRecord.walkedRoots)
+
+def isSameFile(syncRecord: SyncRecord, stat: os.stat_result) -> bool:
+  return stat.st_ino == syncRecord.inode and (syncRecord.device is None or stat.st_dev == syncRecord.device)
+
+def hashLocalFile(localFile: str, syncRecord: Optional[SyncRecord] = None) -> str:
+  """
+  Get the hash of a local file. If the file has the same size and modification time as when its
+  sync record was last written, the hash from the sync record is used instead of reading the file.
+  """
+  if syncRecord is not None:
+    hit = isStatUnchanged(syncRecord, os.stat(localFile))
+    metrics.recordCacheLookup("stat", hit)
+    if hit:
+      return syncRecord.lastHash
+  hasher = hashlib.sha256()
+  with open(localFile, "rb") as f:
+    for chunk in iter(lambda: f.read(1024 ** 2), b""):
+      hasher.update(chunk)
+  return hasher.hexdigest()
+
 #
-# Exports
+# Path index
 #
 
-# Raises: ConfigParseFailed, SyncExists
-def createSync(fileId: str, hash: str, localFile: str):
-  # Get inode of file
-  inode = os.stat(localFile).st_ino
+class PathIndex:
+  """
+  A sorted index of the paths of every clone, for finding the clones under a directory without
+  walking it. The paths are only hints: files can be moved or replaced, so each one should be
+  checked with `isSameFile` before it is used.
+  """
+  __paths: List[str]
+  __records: List[SyncRecord]
+
+  def __init__(self, syncInfo: SyncInfo):
+    entries = sorted((path, syncRecord.syncId, syncRecord) for syncRecord in syncInfo for path in syncRecord.paths)
+    self.__paths = [path for path, _, _ in entries]
+    self.__records = [syncRecord for _, _, syncRecord in entries]
+
+  def under(self, directory: str) -> List[Tuple[str, SyncRecord]]:
+    """
+    Get the recorded clone paths under a directory, in sorted order.
+    """
+    prefix = os.path.join(os.path.abspath(directory), "")
+    start = bisect.bisect_left(self.__paths, prefix)
+    end = start
+    while end < len(self.__paths) and self.__paths[end].startswith(prefix):
+      end += 1
+    return list(zip(self.__paths[start:end], self.__records[start:end]))
 
-  # Read sync info
-  syncInfo = readSyncInfo()
+#
+# Exports
+#
 
-  # Check if sync already exists
-  syncRecord = findInSyncByInode(syncInfo, inode)
-  if syncRecord != None:
+# Raises: ConfigParseFailed, SyncExists, OSError
+def createSync(fileId: str, hash: str, localFile: str, delta: bool = False):
+  with modifySyncInfo() as syncInfo:
+    addSyncRecord(syncInfo, NewSync(fileId=fileId, hash=hash, localFile=localFile, delta=delta))
+
+# Raises: ConfigParseFailed
+def createSyncs(newSyncs: List[NewSync]) -> List[Tuple[NewSync, str]]:
+  """
+  Create the sync records for many files at once. Each file is linked into the syncs folder on its
+  own, so a file that can't be synced doesn't stop the others from being synced.
+
+  :returns: The files that could not be synced, each with a message saying why.
+  """
+  failures = []
+  with modifySyncInfo() as syncInfo:
+    for newSync in newSyncs:
+      try:
+        addSyncRecord(syncInfo, newSync)
+      except SyncExistsException:
+        failures.append((newSync, f"Local file {newSync.localFile} is already being synced, possibly under another name."))
+      except OSError as e:
+        failures.append((newSync, f"Local file {newSync.localFile} could not be linked into '{BITBOX_SYNCS_FOLDER}': {e.strerror}. It may be on a different file system."))
+  return failures
+
+def addSyncRecord(syncInfo: SyncInfo, newSync: NewSync) -> None:
+  """
+  Add a sync record for a file to the sync records, and link the file into the syncs folder. The
+  record is only added if the link was created.
+
+  :raises SyncExistsException: If the file is already synced.
+  :raises OSError: If the file could not be linked.
+  """
+  # Get the inode of the file, and check that it isn't already synced
+  stat = os.stat(newSync.localFile)
+  if any(syncRecord.inode == stat.st_ino for syncRecord in syncInfo):
     raise SyncExistsException()
-  
-  # Create an id for the sync that doesn't exist yet
-  syncId = getNewSyncId(syncInfo)
-  
-  # Add record to sync info
+
+  # Create a record with an id that doesn't exist yet
   newSyncRecord = SyncRecord(
-    syncId=syncId,
-    fileId=fileId,
-    lastHash=hash,
-    inode=inode
+    syncId=getNewSyncId(syncInfo),
+    fileId=newSync.fileId,
+    lastHash=newSync.hash,
+    inode=stat.st_ino,
+    member=newSync.member,
+    delta=newSync.delta
   )
-  syncInfo.append(newSyncRecord)
+  recordStat(newSyncRecord, stat)
+  recordPath(newSyncRecord, newSync.localFile, stat)
 
-  # Create hard link to local file
-  os.link(localFile, getLinkName(newSyncRecord))
-
-  # Write sync info
-  writeSyncInfo(syncInfo)
+  # Create hard link to local file, then add the record to sync info
+  os.link(newSync.localFile, getLinkName(newSyncRecord))
+  syncInfo.append(newSyncRecord)
 
 # Raises: ConfigParseFailed
 def lookupSync(localFile: str) -> Optional[SyncRecord]:
@@ -129,83 +278,81 @@ def lookupSyncByRemote(fileId: str) -> Optional[SyncRecord]:
   # Read sync info
   syncInfo = readSyncInfo()
 
-  # Find sync record by owner and filename
+  # Find sync record by owner and filename, ignoring files extracted from packs
   for syncRecord in syncInfo:
-    if syncRecord.fileId == fileId:
+    if syncRecord.fileId == fileId and syncRecord.member is None:
       return syncRecord
 
-# Raises: ConfigParseFailed
-def updateSync(localFile: str, hash: str):
-  # Get inode of file
-  inode = os.stat(localFile).st_ino
-
-  # Read sync info
-  syncInfo = readSyncInfo()
-
-  # Find sync record by inode
-  syncRecord = findInSyncByInode(syncInfo, inode)
-  if syncRecord == None:
-    raise SyncNotFoundException()
-  
-  # Update sync record
-  syncRecord.lastHash = hash
-
-  # Write sync info
-  writeSyncInfo(syncInfo)
+# Raises: ConfigParseFailed, SyncNotFound
+def updateSync(localFile: str, hash: str, delta: Optional[bool] = None):
+  updateSyncs([(localFile, hash)], {} if delta is None else { localFile: delta })
+
+# Raises: ConfigParseFailed, SyncNotFound
+def updateSyncs(updates: List[Tuple[str, str]], deltas: Dict[str, bool] = {}):
+  with modifySyncInfo() as syncInfo:
+    syncRecords = { syncRecord.inode: syncRecord for syncRecord in syncInfo }
+    for localFile, hash in updates:
+      # Get inode of file
+      stat = os.stat(localFile)
+
+      # Find sync record by inode
+      syncRecord = syncRecords.get(stat.st_ino)
+      if syncRecord == None:
+        raise SyncNotFoundException()
+
+      # Update sync record
+      syncRecord.lastHash = hash
+      syncRecord.delta = deltas.get(localFile, syncRecord.delta)
+      recordStat(syncRecord, stat)
+      recordPath(syncRecord, localFile, stat)
 
 # Raises: ConfigParseFailed, Exception
 def copySync(id: int, localFile: str):
-  # Read sync info
-  syncInfo = readSyncInfo()
-
-  # Find sync record by id
-  syncRecord = getSyncRecord(syncInfo, id)
-  if syncRecord == None:
-    raise Exception
-  
-  # Get the inode of the old hard link
-  oldLinkName = getLinkName(syncRecord)
-  inode = os.stat(oldLinkName).st_ino
-  
-  # Create new sync id
-  newSyncId = getNewSyncId(syncInfo)
-  
-  # Create new sync record
-  newSyncRecord = SyncRecord(
-    syncId=newSyncId,
-    fileId=syncRecord.fileId,
-    lastHash=syncRecord.lastHash,
-    inode=inode
-  )
-
-  # Add new sync record to sync info
-  syncInfo.append(newSyncRecord)
-
-  # Copy the hard link
-  newLinkName = getLinkName(newSyncRecord)
-  shutil.copyfile(oldLinkName, newLinkName)
-
-  # Create hard link to local file
-  os.link(newLinkName, localFile)
-
-  # Write sync info
-  writeSyncInfo(syncInfo)
+  with modifySyncInfo() as syncInfo:
+    # Find sync record by id
+    syncRecord = getSyncRecord(syncInfo, id)
+    if syncRecord == None:
+      raise Exception
+
+    # Get the old hard link
+    oldLinkName = getLinkName(syncRecord)
+
+    # Create new sync id
+    newSyncId = getNewSyncId(syncInfo)
+
+    # Create new sync record. The copy may have been edited since it was synced, so its size and
+    # modification time are left unset for it to be hashed the next time it is checked
+    newSyncRecord = SyncRecord(
+      syncId=newSyncId,
+      fileId=syncRecord.fileId,
+      lastHash=syncRecord.lastHash,
+      inode=0,
+      member=syncRecord.member,
+      delta=syncRecord.delta
+    )
+
+    # Add new sync record to sync info
+    syncInfo.append(newSyncRecord)
+
+    # Copy the hard link, sharing its data blocks where the file system allows it, and track the copy
+    # by its own inode
+    newLinkName = getLinkName(newSyncRecord)
+    fastcopy.copyFile(oldLinkName, newLinkName)
+    newSyncRecord.inode = os.stat(newLinkName).st_ino
+
+    # Create hard link to local file
+    os.link(newLinkName, localFile)
+    recordPath(newSyncRecord, localFile, os.stat(localFile))
 
 # Raises: ConfigParseFailed, Exception
 def deleteSyncsByRemote(fileId: str):
-  # Read sync info
-  syncInfo = readSyncInfo()
-
-  # Create a variable for the updated sync info
-  newSyncInfo = []
-
-  # Remove syncs corresponding to the file that is to be deleted
-  for syncRecord in syncInfo:
-    if syncRecord.fileId == fileId:
-      # Remove hard link
-      os.unlink(getLinkName(syncRecord))
-    else:
-      newSyncInfo.append(syncRecord)
-  
-  # Write sync info
-  writeSyncInfo(newSyncInfo)
+  with modifySyncInfo() as syncInfo:
+    # Remove syncs corresponding to the file that is to be deleted
+    newSyncInfo = []
+    for syncRecord in syncInfo:
+      if syncRecord.fileId == fileId:
+        # Remove hard link
+        os.unlink(getLinkName(syncRecord))
+      else:
+        newSyncInfo.append(syncRecord)
+    syncInfo[:] = newSyncInfo
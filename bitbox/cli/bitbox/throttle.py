@@ -0,0 +1,28 @@
+from bitbox.cli.bitbox.common import *
+from bitbox.cli import *
+
+@app.command(short_help="Show or set the bandwidth limit for transfers")
+def throttle(
+  limitRate: str = typer.Argument(None, help="Bandwidth for all transfers, in bytes per second with an optional suffix of 'k', 'M' or 'G' (e.g. '2M'), or a schedule of comma-separated windows of the day and a rate for the rest of it (e.g. '09:00-18:00=512k,4M'). Use 'unlimited' in a schedule for no limit."),
+  off: bool = typer.Option(False, "--off", help="Remove the bandwidth limit")):
+  # Remove the limit
+  if off:
+    config.setLimitRate(None)
+    success("Transfers are no longer limited.")
+    return
+
+  # Show the current limit
+  if limitRate is None:
+    current = config.getLimitRate()
+    if current is None:
+      console.print("Transfers are not limited. Set a limit with `bitbox throttle RATE`.")
+    else:
+      console.print(f"Transfers are limited to: [bold]{current}[/bold]")
+    if BITBOX_LIMIT_RATE:
+      warning(f"`BITBOX_LIMIT_RATE` is set to '{BITBOX_LIMIT_RATE}', which takes precedence.")
+    return
+
+  # Check and save the new limit
+  parseLimitRate(limitRate)
+  config.setLimitRate(limitRate)
+  success(f"Transfers are now limited to: {limitRate}")
@@ -1,77 +1,424 @@
 from bitbox.cli.bitbox.common import *
 from bitbox.cli import *
 import bitbox.cli.bitbox.syncinfo as syncinfo
+import bitbox.cli.bitbox.walk as walk
 import bitbox.server as server
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from cryptography.fernet import Fernet
+from dataclasses import dataclass
+from typing import Tuple
 import binascii
 
 #
-# Push command
+# Parameters
 #
 
-@app.command(short_help="Push changes in a local file to its remote copy")
-def update(local: str = typer.Argument(..., help="Path to the local file whose remote should be updated")):
-  # Get user info and try to establish a session
-  authInfo = config.load()
-  
-  # Check if the file exists and is not a directory
-  confirmLocalFileExists(local)
+DEFAULT_UPDATE_JOBS = 8
 
-  # Check if the file is in the user's bitbox
-  syncRecord = syncinfo.lookupSync(local)
-  if syncRecord == None:
-    error(f"Local file '{local}' is not known to be synchronized with bitbox.")
+#
+# Types
+#
 
-  # Get the file information from the server
-  fileInfo = server.fileInfoById(syncRecord.fileId, authInfo)
-  guard(fileInfo, {
-    server.Error.FILE_NOT_FOUND: f"The remote for local file '{local}' has been deleted from your bitbox. It can no longer be updated."
-  })
-  owner = fileInfo.owner
-  filename = fileInfo.name
+@dataclass
+class PushResult:
+  local: str
+  remote: str
+  # Hash of the local file, which the remote has after the push
+  hash: str
+  # Whether anything was sent, or the remote already had the same contents
+  pushed: bool
+  # Whether the remote is now in delta mode
+  delta: bool = False
+
+#
+# Exceptions
+#
+
+class UpdateException(Exception):
+  def __init__(self, message: str):
+    self.message = message
 
-  # Make sure this user owns the file
-  if (owner != authInfo.keyInfo.username):
-    error(f"Only the file owner, @{owner}, has permissions to update remote file '{local}'")
+class ConflictException(UpdateException):
+  def __init__(self, message: str, remoteHash: str):
+    super().__init__(message)
+    self.remoteHash = remoteHash
 
+#
+# Utility functions
+#
+
+def readLocalFile(local: str) -> Tuple[bytes, str]:
   # Read the file and get its hash
   with open(local, "rb") as f:
     fileContents = f.read()
-  fileHash = hashlib.sha256(fileContents).hexdigest()
+  return fileContents, hashlib.sha256(fileContents).hexdigest()
+
+def getOwnedFileInfo(client: lib.Client, local: str, fileId: str) -> FileInfo:
+  """
+  Get the file information for the remote of a local file, and make sure the user owns it.
+
+  :raises UpdateException: If the remote has been deleted or is owned by someone else.
+  """
+  try:
+    fileInfo = client.fileInfoById(fileId)
+  except lib.FileNotFoundException:
+    raise UpdateException(f"The remote for local file '{local}' has been deleted from your bitbox. It can no longer be updated.")
+  if (fileInfo.owner != client.username):
+    raise UpdateException(f"Only the file owner, @{fileInfo.owner}, has permissions to update remote file '{local}'")
+  return fileInfo
+
+def uploadUpdate(client: lib.Client, fileInfo: FileInfo, fileKey: bytes, blob: bytes, description: str) -> None:
+  """
+  Replace the contents of a remote file, encrypting them with the file's existing key.
+
+  :raises UpdateException: If the update could not be sent.
+  """
+  remote = f"@{fileInfo.owner}/{fileInfo.name}"
+
+  # Encrypt the updated file contents
+  encryptedFileBytes = Fernet(fileKey).encrypt(blob)
+
+  # Send a request to the server to update the file, and grab the upload URL
+  try:
+    prepareUpdateResponse = client.prepareUpdate(fileInfo.fileId, len(encryptedFileBytes), hashlib.sha256(blob).hexdigest())
+  except lib.FileNotFoundException:
+    raise UpdateException(f"Remote file '{remote}' has been deleted from your bitbox. It can no longer be updated.")
+  except lib.FileTooLargeException:
+    raise UpdateException(f"{description} is too large to upload. Run `bitbox` to check how much space you have.")
+  except lib.FileNotReadyException:
+    raise UpdateException(f"Remote file '{remote}' is being modified elswhere. Try again later.")
+
+  # Upload the file, and tell the server we're done uploading
+  try:
+    client.putBlob(prepareUpdateResponse.uploadURL, encryptedFileBytes)
+  except lib.UploadException:
+    raise UpdateException(f"Error while uploading remote file '{remote}'.")
+  client.store(fileInfo.fileId)
+
+def uploadDeltaUpdate(client: lib.Client, fileInfo: FileInfo, fileKey: bytes, blob: bytes, isDelta: bool, description: str) -> None:
+  """
+  Replace the contents of a remote file in delta mode, uploading only the chunks that the remote
+  does not have yet.
+
+  :param isDelta: Whether the remote is already in delta mode. If not, it is converted to it.
+
+  :raises UpdateException: If the update could not be sent.
+  """
+  remote = f"@{fileInfo.owner}/{fileInfo.name}"
+  try:
+    # Find out which chunks the remote already has from its manifest
+    previous = client.fetchManifest(fileInfo.fileId)[0] if isDelta else None
+
+    # Upload the new chunks and manifest
+    client.updateDelta(fileInfo, fileKey, blob, previous)
+  except lib.FileNotFoundException:
+    raise UpdateException(f"Remote file '{remote}' has been deleted from your bitbox. It can no longer be updated.")
+  except lib.FileTooLargeException:
+    raise UpdateException(f"{description} is too large to upload. Run `bitbox` to check how much space you have.")
+  except lib.FileNotReadyException:
+    raise UpdateException(f"Remote file '{remote}' is being modified elswhere. Try again later.")
+  except lib.DownloadException:
+    raise UpdateException(f"An error occurred downloading the manifest of remote file '{remote}'.")
+  except lib.UploadException:
+    raise UpdateException(f"Error while uploading remote file '{remote}'.")
+
+def pushFile(client: lib.Client, local: str, syncRecord: syncinfo.SyncRecord, delta: bool = False, checkConflict: bool = False, filesInfo: Optional[List[FileInfo]] = None) -> PushResult:
+  """
+  Push the contents of a local file to its remote, unless the remote already has them. Remotes in
+  delta mode stay in delta mode.
+
+  :param delta: Whether to store the remote in delta mode, if it isn't already.
+  :param checkConflict: Whether to refuse to push if the remote has changed since the file was
+    last synchronized, rather than overwriting those changes.
+  :param filesInfo: A listing of the user's files to find the remote's chunks in, if the caller
+    already has one.
+
+  :raises ConflictException: If checkConflict = True and the remote has changed.
+  :raises UpdateException: If the file could not be pushed.
+  """
+  # Get the file information from the server
+  fileInfo = getOwnedFileInfo(client, local, syncRecord.fileId)
+  remote = f"@{fileInfo.owner}/{fileInfo.name}"
 
   # Check to see if the file has changed by comparing hashes
+  fileContents, fileHash = readLocalFile(local)
   if (fileInfo.hash == fileHash):
-    warning(f"Local file '{local}' has not changed. No update will be sent to the server.")
+    return PushResult(local=local, remote=remote, hash=fileHash, pushed=False)
+
+  # Check the latest hash of the remote against the one the file was last synchronized with
+  if checkConflict and fileInfo.hash != syncRecord.lastHash:
+    raise ConflictException(f"Remote file '{remote}' has changed since local file '{local}' was last synchronized.", fileInfo.hash)
+
+  # Decrypt the file key, and send the new contents. Remotes in delta mode only get the chunks that
+  # changed. Whether the remote is in delta mode is found from its chunks, since the sync record
+  # doesn't know if it was converted elsewhere
+  fileKey = rsaDecrypt(binascii.unhexlify(fileInfo.encryptedKey), client.getPrivateKey())
+  isDelta = client.hasChunks(fileInfo, filesInfo)
+  if delta or isDelta:
+    uploadDeltaUpdate(client, fileInfo, fileKey, fileContents, isDelta, f"File {local}")
+    return PushResult(local=local, remote=remote, hash=fileHash, pushed=True, delta=True)
+  uploadUpdate(client, fileInfo, fileKey, fileContents, f"File {local}")
+  return PushResult(local=local, remote=remote, hash=fileHash, pushed=True)
+
+def pushPack(client: lib.Client, fileId: str, files: List[Tuple[str, syncinfo.SyncRecord]], filesInfo: Optional[List[FileInfo]] = None) -> Tuple[List[PushResult], List[Tuple[str, str]]]:
+  """
+  Push changes in local files that were extracted from the same pack, by rebuilding the pack with
+  the new contents of those files and the old contents of every other file in it. The pack is
+  downloaded and uploaded once, however many of its files have changed.
+
+  :param filesInfo: A listing of the user's files to find the pack's chunks in, if the caller
+    already has one.
+
+  :raises UpdateException: If the pack could not be updated.
+
+  :returns: A tuple of the results for each file, and the (local file, message) pairs of files
+    that could not be pushed.
+  """
+  # Get the file information from the server
+  fileInfo = getOwnedFileInfo(client, files[0][0], fileId)
+  remote = f"@{fileInfo.owner}/{fileInfo.name}"
+
+  # Download the pack, keeping the file key to encrypt the new pack with
+  try:
+    saveResponse = client.saveById(fileId)
+    packBlob, fileKey = client.fetch(saveResponse, operation="update")
+  except lib.FileNotFoundException:
+    raise UpdateException(f"Remote file '{remote}' has been deleted from your bitbox. It can no longer be updated.")
+  except lib.FileNotReadyException:
+    raise UpdateException(f"Remote file '{remote}' is being modified elswhere. Try again later.")
+  except lib.DownloadException:
+    raise UpdateException(f"An error occurred downloading remote file '{remote}', or it does not match its hash. This file may have been tampered with.")
+  try:
+    members = lib.readPackIndex(packBlob)
+  except lib.PackException as e:
+    raise UpdateException(f"Remote file '{remote}' is not a valid pack: {e.message}")
+
+  # Find each file in the pack, and check whether it has changed
+  results = []
+  failures = []
+  updates = {}
+  for local, syncRecord in files:
+    member = members.get(syncRecord.member)
+    if member is None:
+      failures.append((local, f"Local file '{local}' has been removed from its pack at '{remote}'. It can no longer be updated."))
+      continue
+    fileContents, fileHash = readLocalFile(local)
+    if member.hash != fileHash:
+      updates[member.name] = fileContents
+    results.append(PushResult(local=local, remote=f"{remote}:{member.name}", hash=fileHash, pushed=member.hash != fileHash))
+
+  # Rebuild and upload the pack, keeping it in delta mode if it is
+  if len(updates) > 0:
+    newPack = lib.replaceMembers(packBlob, updates)
+    if client.hasChunks(fileInfo, filesInfo):
+      uploadDeltaUpdate(client, fileInfo, fileKey, newPack, True, f"Pack '{remote}'")
+      for result in results:
+        result.delta = True
+    else:
+      uploadUpdate(client, fileInfo, fileKey, newPack, f"Pack '{remote}'")
+
+    # Mark packs that were added before packs had markers, so that they are cloned as their files
+    if not client.hasPackMarker(fileInfo, filesInfo):
+      try:
+        client.markPack(fileInfo.name)
+      except (lib.FileNotFoundException, lib.FileTooLargeException, lib.UploadException):
+        pass
+  return results, failures
+
+def findModifiedClones(path: str, rediscover: bool = False) -> Tuple[List[Tuple[str, syncinfo.SyncRecord]], List[Tuple[str, str]]]:
+  """
+  Find the clones in a path that have changed since they were last synchronized. Files with the
+  same size and modification time as when they were last synchronized are not read at all.
+
+  :returns: A tuple of the modified clones and their sync records, and the (local file, hash) pairs
+    of clones whose contents are unchanged but whose size and modification time should be recorded
+    again.
+  """
+  # Get a list of all the existing sync points in the path
+  if os.path.isdir(path):
+    clones = walk.locateClones(path, rediscover)
+  else:
+    syncRecord = syncinfo.lookupSync(path)
+    clones = [] if syncRecord is None else [(path, syncRecord)]
+
+  modified = []
+  refreshes = []
+  for file, syncRecord in clones:
+    try:
+      stat = os.stat(file)
+    except OSError:
+      continue
+
+    # Check whether the file has changed since it was last synchronized
+    if syncinfo.hashLocalFile(file, syncRecord) != syncRecord.lastHash:
+      modified.append((file, syncRecord))
+    elif not syncinfo.isStatUnchanged(syncRecord, stat):
+      refreshes.append((file, syncRecord.lastHash))
+  return modified, refreshes
+
+def planPushes(client: lib.Client, pushes: List[Tuple[str, List[Tuple[str, syncinfo.SyncRecord]]]], filesInfo: List[FileInfo]) -> Tuple[List[Tuple[str, List[Tuple[str, syncinfo.SyncRecord]]]], List[Tuple[str, syncinfo.SyncRecord]]]:
+  """
+  Plan pushes to remotes against the user's storage from a single listing of their files. A pack
+  is projected to change by as much as the files in it have changed in size since they were last
+  synchronized. Pushes to remotes that are missing or owned by someone else are left for
+  `pushFile` and `pushPack` to report.
+
+  :param pushes: Pairs of the file ID of a remote and the local files to push to it.
+  :param filesInfo: A listing of the user's files.
+
+  :returns: A tuple of the pushes to make, in order, and the local files whose pushes can't fit.
+  """
+  remoteFiles = { fileInfo.fileId: fileInfo for fileInfo in filesInfo }
+  items = []
+  unplanned = []
+  for fileId, pushFiles in pushes:
+    fileInfo = remoteFiles.get(fileId)
+    if fileInfo is None or fileInfo.owner != client.username:
+      unplanned.append((fileId, pushFiles))
+      continue
+    if pushFiles[0][1].member is None:
+      projected = fernetTokenLength(os.path.getsize(pushFiles[0][0]))
+    else:
+      projected = fileInfo.bytes + sum(os.path.getsize(local) - (syncRecord.size or os.path.getsize(local)) for local, syncRecord in pushFiles)
+    items.append(lib.PlanItem(key=(fileId, pushFiles), remote=fileInfo.name, bytes=projected))
+  plan = lib.planTransfers(items, filesInfo, client.username)
+  rejected = [pushFile for item in plan.rejected for pushFile in item.key[1]]
+  return [item.key for item in plan.accepted] + unplanned, rejected
+
+def updateAll(client: lib.Client, path: str, jobs: int, rediscover: bool = False, delta: bool = False) -> None:
+  """
+  Push every modified clone in a path to its remote, several at a time.
+
+  :param delta: Whether to store the remotes in delta mode, if they aren't already.
+  """
+  # Find the clones that have changed
+  if not os.path.exists(path):
+    error(f"Local path '{path}' does not exist.")
+  modified, refreshes = findModifiedClones(path, rediscover)
+
+  # Group the files in each pack, which are pushed together
+  results = []
+  failures = []
+  pushes: List[Tuple[str, List[Tuple[str, syncinfo.SyncRecord]]]] = []
+  packs: Dict[str, List[Tuple[str, syncinfo.SyncRecord]]] = {}
+  for local, syncRecord in modified:
+    if syncRecord.member is None:
+      pushes.append((syncRecord.fileId, [(local, syncRecord)]))
+    else:
+      packs.setdefault(syncRecord.fileId, []).append((local, syncRecord))
+  pushes += list(packs.items())
+
+  # Plan the pushes against the user's storage, smallest first, rejecting the ones that can't fit
+  # before any of them is read. The same listing tells which remotes are in delta mode
+  filesInfo = []
+  if len(pushes) > 0:
+    filesInfo = client.filesInfo()
+    pushes, rejected = planPushes(client, pushes, filesInfo)
+    for local, _ in rejected:
+      failures.append((local, f"The changes to local file '{local}' do not fit in the space you have left. Run `bitbox` to check how much space you have."))
+
+  # Push the files concurrently, in the planned order
+  with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+    futures = {}
+    for fileId, pushFiles in pushes:
+      if pushFiles[0][1].member is None:
+        local, syncRecord = pushFiles[0]
+        futures[executor.submit(pushFile, client, local, syncRecord, delta, False, filesInfo)] = [local]
+      else:
+        futures[executor.submit(pushPack, client, fileId, pushFiles, filesInfo)] = [local for local, _ in pushFiles]
+
+    for future in as_completed(futures):
+      locals = futures[future]
+      try:
+        result = future.result()
+      except UpdateException as e:
+        failures += [(local, e.message) for local in locals]
+        continue
+      except Exception as e:
+        failures += [(local, f"An error occurred: {e}") for local in locals]
+        continue
+      if isinstance(result, PushResult):
+        pushResults = [result]
+      else:
+        pushResults, packFailures = result
+        failures += packFailures
+      for pushResult in pushResults:
+        if pushResult.pushed:
+          console.print(f"Remote file '{pushResult.remote}' has been updated with local changes from '{pushResult.local}'.")
+      results += pushResults
+
+  # Update the sync records of every file that now matches its remote at once
+  syncinfo.updateSyncs([(result.local, result.hash) for result in results] + refreshes, { result.local: result.delta for result in results if result.pushed })
+
+  # Save the session back onto the disk
+  config.setSession(client.authInfo.session)
+
+  # Report the files that could not be pushed
+  pushedCount = len([result for result in results if result.pushed])
+  summary = f"{pushedCount} files pushed, {len(results) - pushedCount} already up to date"
+  if len(failures) > 0:
+    table = Table()
+    table.add_column("Local File")
+    table.add_column("Error")
+    for local, message in sorted(failures):
+      table.add_row(local, message)
+    console.print(table)
+    error(f"{summary}, {len(failures)} failed.")
+  elif len(modified) == 0:
+    warning("No modified clones found. Nothing to update.")
+  else:
+    success(f"\nUpdate successful: {summary}.")
+
+#
+# Push command
+#
+
+@app.command(short_help="Push changes in a local file to its remote copy")
+def update(
+  local: str = typer.Argument(None, help="Path to the local file whose remote should be updated. With `--all`, the path to search for modified clones, which defaults to the current directory."),
+  all: bool = typer.Option(False, "--all", help="Push every clone in the path that has changed since it was last synchronized"),
+  jobs: int = typer.Option(DEFAULT_UPDATE_JOBS, "--jobs", "-j", help="Number of files to push at once with `--all`"),
+  rediscover: bool = typer.Option(False, "--rediscover", help="With `--all`, search the whole path for clones, to find clones that were moved into it"),
+  delta: bool = typer.Option(False, "--delta", help="Store the remote in chunks, so that later updates only upload the parts of the file that changed. Remotes added with `bitbox add --delta` always are")):
+  # Get user info and try to establish a session
+  authInfo = config.load()
+  client = lib.Client(authInfo)
+
+  # With --all, push every modified clone in the path
+  if all:
+    updateAll(client, local or ".", jobs, rediscover, delta)
     return
-  
-  # Get the user's private key so we can decrypt the file key
-  privateKey = authInfo.getPrivateKey()
-  
-  # Decrypt the file key
-  fileKey = rsaDecrypt(binascii.unhexlify(fileInfo.encryptedKey), privateKey)
-  
-  # Encrypt the updated file contents
-  encryptedFileBytes = Fernet(fileKey).encrypt(fileContents)
+  if local is None:
+    error("Specify a local file to update, or use the `--all` flag to update every modified clone.")
 
-  # Send a request to the server to update the file, and grab the upload URL
-  prepareUpdateResponse = server.prepareUpdate(fileInfo.fileId, len(encryptedFileBytes), fileHash, authInfo)
-  guard(prepareUpdateResponse, {
-    server.Error.FILE_TOO_LARGE: f"File {local} is too large to upload. Run `bitbox` to check how much space you have.",
-    server.Error.FILE_NOT_READY: f"Remote file '@{owner}/{filename}' is being modified elswhere. Try again later."
-  })
-  
-  # Upload the file
-  uploadFile(prepareUpdateResponse.uploadURL, encryptedFileBytes)
-  
-  # Tell the server we're done uploading
-  storeResponse = server.store(fileInfo.fileId, authInfo)
-  guard(storeResponse)
+  # Check if the file exists and is not a directory
+  confirmLocalFileExists(local)
+
+  # Check if the file is in the user's bitbox
+  syncRecord = syncinfo.lookupSync(local)
+  if syncRecord == None:
+    error(f"Local file '{local}' is not known to be synchronized with bitbox.")
+
+  # Push the file. Files extracted from a pack are pushed by rebuilding the pack
+  try:
+    if syncRecord.member is None:
+      result = pushFile(client, local, syncRecord, delta)
+    else:
+      results, failures = pushPack(client, syncRecord.fileId, [(local, syncRecord)])
+      if len(failures) > 0:
+        error(failures[0][1])
+      result = results[0]
+  except UpdateException as e:
+    error(e.message)
 
   # Update the sync record with the new hash
-  syncinfo.updateSync(local, fileHash)
+  syncinfo.updateSync(local, result.hash, result.delta if result.pushed else None)
 
-  # Tell the user that the file has been pushed
-  success(f"Remote file '@{owner}/{filename}' has been updated with local changes.")
+  # Tell the user whether the file has been pushed
+  if result.pushed:
+    success(f"Remote file '{result.remote}' has been updated with local changes.")
+  else:
+    warning(f"Local file '{local}' has not changed. No update will be sent to the server.")
 
   # Save the session back onto the disk
   config.setSession(authInfo.session)
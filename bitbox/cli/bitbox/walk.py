@@ -0,0 +1,226 @@
+from bitbox.cli.bitbox.common import *
+from bitbox.cli import *
+import bitbox.cli.bitbox.syncinfo as syncinfo
+from typing import Iterator, Tuple
+import re
+
+#
+# Parameters
+#
+
+BITBOX_IGNORE_FILENAME = ".bitboxignore"
+
+# Directories that never hold clones but can hold a great many files. A `.bitboxignore` can bring
+# them back with a negated pattern, like `!node_modules/`
+DEFAULT_IGNORE_PATTERNS = [".git/", ".hg/", ".svn/", "node_modules/", "__pycache__/"]
+
+#
+# Ignore rules
+#
+
+class IgnoreRule:
+  """
+  A single line of a `.bitboxignore` file, which uses a subset of the `.gitignore` syntax:
+
+  - Blank lines and lines starting with '#' are skipped.
+  - A leading '!' re-includes paths excluded by an earlier rule.
+  - A trailing '/' only matches directories.
+  - Patterns containing a '/' (other than a trailing one) are relative to the directory of the
+    `.bitboxignore` file; other patterns match a name at any depth below it.
+  - '*' and '?' match within a single path component, and '**' matches across components.
+  """
+  pattern: str
+  base: str
+  negate: bool
+  directoryOnly: bool
+  __regex: re.Pattern
+
+  def __init__(self, pattern: str, base: str = ""):
+    self.pattern = pattern
+    self.base = base
+    self.negate = pattern.startswith("!")
+    if self.negate:
+      pattern = pattern[1:]
+    self.directoryOnly = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    regex = globToRegex(pattern)
+    self.__regex = re.compile(regex if anchored else f"(?:.*/)?{regex}")
+
+  def matches(self, path: str, isDirectory: bool) -> bool:
+    """
+    :param path: Path relative to the root of the walk, using '/' as the separator.
+    """
+    if self.directoryOnly and not isDirectory:
+      return False
+    if self.base:
+      if not path.startswith(self.base + "/"):
+        return False
+      path = path[len(self.base) + 1:]
+    return self.__regex.fullmatch(path) is not None
+
+def globToRegex(pattern: str) -> str:
+  regex = ""
+  i = 0
+  while i < len(pattern):
+    if pattern.startswith("**/", i):
+      regex += "(?:.*/)?"
+      i += 3
+    elif pattern.startswith("**", i):
+      regex += ".*"
+      i += 2
+    elif pattern[i] == "*":
+      regex += "[^/]*"
+      i += 1
+    elif pattern[i] == "?":
+      regex += "[^/]"
+      i += 1
+    elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+      end = pattern.index("]", i + 1)
+      regex += "[" + pattern[i + 1:end].replace("\\", "\\\\") + "]"
+      i = end + 1
+    else:
+      regex += re.escape(pattern[i])
+      i += 1
+  return regex
+
+def parseIgnoreFile(path: str, base: str) -> List[IgnoreRule]:
+  try:
+    with open(path, "r") as f:
+      lines = f.read().splitlines()
+  except (OSError, UnicodeDecodeError):
+    return []
+  return [IgnoreRule(line.strip(), base) for line in lines if line.strip() and not line.strip().startswith("#")]
+
+def isIgnored(rules: List[IgnoreRule], path: str, isDirectory: bool) -> bool:
+  # The last rule that matches wins, so deeper `.bitboxignore` files override shallower ones
+  ignored = False
+  for rule in rules:
+    if rule.negate == ignored and rule.matches(path, isDirectory):
+      ignored = not rule.negate
+  return ignored
+
+#
+# Walking
+#
+
+def walkFiles(root: str, useIgnoreFiles: bool = True) -> Iterator[os.DirEntry]:
+  """
+  Walk the regular files under a directory in sorted order, without following symlinks. Directories
+  excluded by ignore rules are pruned without being listed, and the syncs folder is never entered.
+  Each file is yielded as an `os.DirEntry`, whose inode is known from the directory listing without
+  a separate `stat`.
+
+  :param useIgnoreFiles: Whether to apply `.bitboxignore` files and the default ignore patterns.
+  """
+  syncsFolder = os.path.abspath(syncinfo.BITBOX_SYNCS_FOLDER)
+  rootRules = [IgnoreRule(pattern) for pattern in DEFAULT_IGNORE_PATTERNS] if useIgnoreFiles else []
+  stack = [(root, "", rootRules)]
+  while len(stack) > 0:
+    path, relativePath, rules = stack.pop()
+    try:
+      with os.scandir(path) as iterator:
+        entries = sorted(iterator, key=lambda entry: entry.name)
+    except OSError:
+      continue
+
+    # Rules in this directory's ignore file apply to everything below it
+    if useIgnoreFiles and any(entry.name == BITBOX_IGNORE_FILENAME for entry in entries):
+      rules = rules + parseIgnoreFile(os.path.join(path, BITBOX_IGNORE_FILENAME), relativePath)
+
+    subdirectories = []
+    for entry in entries:
+      entryPath = f"{relativePath}/{entry.name}" if relativePath else entry.name
+      try:
+        if entry.is_dir(follow_symlinks=False):
+          if not isIgnored(rules, entryPath, True) and os.path.abspath(entry.path) != syncsFolder:
+            subdirectories.append((entry.path, entryPath, rules))
+        elif entry.is_file(follow_symlinks=False):
+          if not isIgnored(rules, entryPath, False):
+            yield entry
+      except OSError:
+        continue
+    stack.extend(reversed(subdirectories))
+
+def findClones(root: str, syncRecords: List[syncinfo.SyncRecord]) -> List[Tuple[str, syncinfo.SyncRecord, os.stat_result]]:
+  """
+  Find the clones under a directory by matching the inodes from the directory listings against the
+  sync records. Inode numbers are only unique within a device, so each match is then checked with a
+  `stat` of the file, which is returned along with it.
+  """
+  byInode: Dict[syncinfo.Inode, List[syncinfo.SyncRecord]] = {}
+  for syncRecord in syncRecords:
+    byInode.setdefault(syncRecord.inode, []).append(syncRecord)
+
+  clones = []
+  for entry in walkFiles(root):
+    candidates = byInode.get(entry.inode())
+    if candidates is None:
+      continue
+    try:
+      stat = entry.stat(follow_symlinks=False)
+    except OSError:
+      continue
+    for syncRecord in candidates:
+      if syncinfo.isSameFile(syncRecord, stat):
+        clones.append((entry.path, syncRecord, stat))
+  return clones
+
+def locateClones(root: str, rediscover: bool = False) -> List[Tuple[str, syncinfo.SyncRecord]]:
+  """
+  Find the clones under a directory. The paths recorded in the sync records are looked up in a
+  prefix index and each is checked with a single `stat`. The directory is only walked if a recorded
+  path under it no longer holds its clone, if some clones have no recorded paths and the directory
+  hasn't been walked for them yet, or if rediscover = True; the paths found by the walk are then
+  written back to the sync records, along with which clones the walk did not find.
+
+  :param rediscover: Whether to always walk the directory, to find clones that were moved into it.
+  """
+  syncInfo = syncinfo.readSyncInfo()
+  if not rediscover:
+    clones = []
+    found = set()
+    stale = False
+    for path, syncRecord in syncinfo.PathIndex(syncInfo).under(root):
+      try:
+        isClone = syncinfo.isSameFile(syncRecord, os.stat(path))
+      except OSError:
+        isClone = False
+      if not isClone:
+        stale = True
+      elif syncRecord.syncId not in found:
+        found.add(syncRecord.syncId)
+        clones.append((path, syncRecord))
+    unlocated = any(len(syncRecord.paths) == 0 and not syncinfo.isWalked(syncRecord, root) for syncRecord in syncInfo)
+    if not stale and not unlocated:
+      return clones
+
+  # Walk the directory, and record where each clone was found
+  rootPrefix = os.path.join(os.path.abspath(root), "")
+  walked = findClones(root, syncInfo)
+  walkedPaths = set(os.path.abspath(path) for path, _, _ in walked)
+
+  # Write the paths back to the latest sync records, since other processes may have changed them
+  # during the walk
+  clones = []
+  found = set()
+  with syncinfo.modifySyncInfo() as syncInfo:
+    for syncRecord in syncInfo:
+      # Forget paths under the directory that no longer hold the clone
+      syncRecord.paths = [path for path in syncRecord.paths if not path.startswith(rootPrefix) or path in walkedPaths]
+    syncRecords = { syncRecord.syncId: syncRecord for syncRecord in syncInfo }
+    for path, walkedRecord, stat in walked:
+      syncRecord = syncRecords.get(walkedRecord.syncId)
+      if syncRecord is None or not syncinfo.isSameFile(syncRecord, stat):
+        continue
+      syncinfo.recordPath(syncRecord, path, stat)
+      if syncRecord.syncId not in found:
+        found.add(syncRecord.syncId)
+        clones.append((path, syncRecord))
+
+    # Remember that the directory has no clones of the other records, so it isn't walked again for them
+    for syncRecord in syncInfo:
+      if syncRecord.syncId not in found:
+        syncinfo.recordWalk(syncRecord, root)
+  return clones
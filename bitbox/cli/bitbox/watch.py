@@ -0,0 +1,422 @@
+from bitbox.cli.bitbox.common import *
+from bitbox.cli import *
+import bitbox.cli.bitbox.syncinfo as syncinfo
+from bitbox.cli.bitbox.update import pushFile, pushPack, UpdateException, ConflictException
+from bitbox.cli.bitbox.mirror import mirrorFile, MirrorTask, MirrorException
+from typing import Tuple, Set
+import ctypes
+import ctypes.util
+import select
+import struct
+
+#
+# Parameters
+#
+
+DEFAULT_WATCH_DEBOUNCE = 2.0
+DEFAULT_WATCH_MIN_INTERVAL = 10.0
+DEFAULT_WATCH_MAX_INTERVAL = 300.0
+
+#
+# Inotify
+#
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT = struct.Struct("iIII")
+INOTIFY_READ_SIZE = 64 * 1024
+
+class InotifyException(Exception):
+  def __init__(self, message: str):
+    self.message = message
+
+class Inotify:
+  """
+  A minimal binding to Linux's inotify, through the C library. A watch on a file follows its inode,
+  so watching the hard links in the syncs folder reports writes made to a clone through any of its
+  paths.
+  """
+  __libc: ctypes.CDLL
+  __fd: int
+
+  def __init__(self):
+    libcName = ctypes.util.find_library("c")
+    try:
+      self.__libc = ctypes.CDLL(libcName, use_errno=True)
+      self.__libc.inotify_init1
+    except (OSError, AttributeError):
+      raise InotifyException("inotify is not available on this system.")
+    self.__fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.__fd < 0:
+      raise InotifyException(os.strerror(ctypes.get_errno()))
+
+  def fileno(self) -> int:
+    return self.__fd
+
+  def addWatch(self, path: str, mask: int) -> int:
+    wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(path), ctypes.c_uint32(mask))
+    if wd < 0:
+      raise InotifyException(os.strerror(ctypes.get_errno()))
+    return wd
+
+  def removeWatch(self, wd: int) -> None:
+    self.__libc.inotify_rm_watch(self.__fd, wd)
+
+  def read(self) -> List[Tuple[int, int]]:
+    """
+    Read all pending events without blocking.
+
+    :returns: A list of (watch descriptor, event mask) pairs.
+    """
+    events = []
+    while True:
+      try:
+        buffer = os.read(self.__fd, INOTIFY_READ_SIZE)
+      except BlockingIOError:
+        return events
+      offset = 0
+      while offset < len(buffer):
+        wd, mask, _, nameLength = INOTIFY_EVENT.unpack_from(buffer, offset)
+        events.append((wd, mask))
+        offset += INOTIFY_EVENT.size + nameLength
+
+  def close(self) -> None:
+    os.close(self.__fd)
+
+#
+# Watcher
+#
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_DELETE_SELF | IN_MOVE_SELF
+
+class Watcher:
+  """
+  Keeps clones in sync with their remotes. Writes to clones are picked up through inotify, and once
+  a file has been quiet for the debounce period its changes are pushed, if the user owns it.
+  Remote changes are found with a single listing of every file, polled less often the longer
+  nothing changes. Between events the watcher sleeps in `select`, so it uses no CPU when idle.
+  """
+  client: lib.Client
+  inotify: Inotify
+  debounce: float
+  minInterval: float
+  maxInterval: float
+  interval: float
+  nextPoll: float
+  records: Dict[int, syncinfo.SyncRecord]
+  watches: Dict[int, int]
+  dirty: Dict[int, float]
+  remoteFiles: Dict[str, FileInfo]
+  conflicts: Set[Tuple[int, str]]
+  __syncInfoMtime: Optional[int]
+
+  def __init__(self, client: lib.Client, debounce: float, minInterval: float, maxInterval: float):
+    self.client = client
+    self.inotify = Inotify()
+    self.debounce = debounce
+    self.minInterval = minInterval
+    self.maxInterval = max(minInterval, maxInterval)
+    self.interval = minInterval
+    self.nextPoll = time.monotonic()
+    self.records = {}
+    self.watches = {}
+    self.dirty = {}
+    self.remoteFiles = {}
+    self.conflicts = set()
+    self.__syncInfoMtime = None
+
+  #
+  # Sync records
+  #
+
+  def reload(self) -> None:
+    """
+    Re-read the sync records if another command has changed them, and watch any new clones.
+    """
+    try:
+      mtime = os.stat(syncinfo.BITBOX_SYNCINFO_PATH).st_mtime_ns
+    except OSError:
+      return
+    if mtime == self.__syncInfoMtime:
+      return
+    self.__syncInfoMtime = mtime
+    self.records = { syncRecord.syncId: syncRecord for syncRecord in syncinfo.readSyncInfo() }
+
+    # Stop watching clones that are no longer tracked
+    watchedSyncIds = set(self.watches.values())
+    for wd, syncId in list(self.watches.items()):
+      if syncId not in self.records:
+        self.inotify.removeWatch(wd)
+        del self.watches[wd]
+        self.dirty.pop(syncId, None)
+
+    # Start watching new clones through their hard links
+    for syncId, syncRecord in self.records.items():
+      if syncId not in watchedSyncIds:
+        try:
+          self.watches[self.inotify.addWatch(syncinfo.getLinkName(syncRecord), WATCH_MASK)] = syncId
+        except InotifyException as e:
+          warning(f"Could not watch the clone of '{self.renderRemote(syncRecord)}': {e.message}")
+
+  def renderRemote(self, syncRecord: syncinfo.SyncRecord) -> str:
+    fileInfo = self.remoteFiles.get(syncRecord.fileId)
+    remote = syncRecord.fileId if fileInfo is None else f"@{fileInfo.owner}/{fileInfo.name}"
+    return remote if syncRecord.member is None else f"{remote}:{syncRecord.member}"
+
+  def notify(self, message: str, mode: PrintMode = PrintMode.DEFAULT) -> None:
+    print(f"[{time.strftime('%H:%M:%S')}] {message}", mode=mode)
+
+  def conflict(self, syncRecord: syncinfo.SyncRecord, remoteHash: str) -> None:
+    # Only warn about each conflict once
+    if (syncRecord.syncId, remoteHash) not in self.conflicts:
+      self.conflicts.add((syncRecord.syncId, remoteHash))
+      self.notify(f"'{self.renderRemote(syncRecord)}' has changed both locally and remotely. Resolve it with `bitbox sync` or `bitbox update`.", PrintMode.WARNING)
+
+  #
+  # Local changes
+  #
+
+  def handleEvents(self) -> None:
+    now = time.monotonic()
+    for wd, mask in self.inotify.read():
+      if mask & IN_Q_OVERFLOW:
+        # Events were dropped, so any clone may have changed
+        for syncId in self.records:
+          self.dirty[syncId] = now
+      elif mask & IN_IGNORED:
+        # The hard link was removed, so the clone is no longer tracked
+        syncId = self.watches.pop(wd, None)
+        self.dirty.pop(syncId, None)
+      elif wd in self.watches:
+        self.dirty[self.watches[wd]] = now
+
+  def pushQuiet(self) -> bool:
+    """
+    Push the clones that have been quiet for the debounce period.
+
+    :returns: Whether any changes were pushed.
+    """
+    now = time.monotonic()
+    quiet = [syncId for syncId, lastEvent in self.dirty.items() if now - lastEvent >= self.debounce]
+    plain = []
+    packs: Dict[str, List[Tuple[str, syncinfo.SyncRecord]]] = {}
+    for syncId in quiet:
+      del self.dirty[syncId]
+      syncRecord = self.records.get(syncId)
+      if syncRecord is None:
+        continue
+
+      # Skip files that haven't really changed, or that aren't the user's to push
+      link = syncinfo.getLinkName(syncRecord)
+      try:
+        if syncinfo.hashLocalFile(link, syncRecord) == syncRecord.lastHash:
+          continue
+      except OSError:
+        continue
+      fileInfo = self.remoteFiles.get(syncRecord.fileId)
+      if fileInfo is not None and fileInfo.owner != self.client.username:
+        self.notify(f"'{self.renderRemote(syncRecord)}' has local changes, but only its owner, @{fileInfo.owner}, can push them.", PrintMode.WARNING)
+        continue
+
+      # Don't overwrite remote changes that haven't been pulled yet
+      if syncRecord.member is None:
+        if fileInfo is not None and fileInfo.hash != syncRecord.lastHash:
+          self.conflict(syncRecord, fileInfo.hash)
+          continue
+        plain.append((link, syncRecord))
+      else:
+        packs.setdefault(syncRecord.fileId, []).append((link, syncRecord))
+
+    # Push the changes, checking for remote changes against the latest file information. A remote
+    # is only converted to delta mode along with new contents, so the last listing can be used to
+    # find its chunks if it was taken after the clone was last synchronized
+    results = []
+    for link, syncRecord in plain:
+      listed = self.remoteFiles.get(syncRecord.fileId)
+      filesInfo = list(self.remoteFiles.values()) if listed is not None and listed.hash == syncRecord.lastHash else None
+      try:
+        results.append(pushFile(self.client, link, syncRecord, checkConflict=True, filesInfo=filesInfo))
+      except ConflictException as e:
+        self.conflict(syncRecord, e.remoteHash)
+      except UpdateException as e:
+        self.notify(e.message, PrintMode.WARNING)
+      except (requests.RequestException, lib.BitboxException):
+        self.retry([syncRecord])
+    for fileId, packFiles in packs.items():
+      try:
+        packResults, failures = pushPack(self.client, fileId, packFiles)
+      except UpdateException as e:
+        self.notify(e.message, PrintMode.WARNING)
+        continue
+      except (requests.RequestException, lib.BitboxException):
+        self.retry([syncRecord for _, syncRecord in packFiles])
+        continue
+      results += packResults
+      for _, message in failures:
+        self.notify(message, PrintMode.WARNING)
+
+    # Record the new hashes
+    syncinfo.updateSyncs([(result.local, result.hash) for result in results], { result.local: result.delta for result in results if result.pushed })
+    pushed = [result for result in results if result.pushed]
+    for result in pushed:
+      self.notify(f"Pushed local changes to '{result.remote}'.", PrintMode.SUCCESS)
+    return len(pushed) > 0
+
+  def retry(self, syncRecords: List[syncinfo.SyncRecord]) -> None:
+    """
+    Push clones again later, after a push failed because bitbox could not be reached. Polls back
+    off at the same time, since they would most likely fail as well.
+    """
+    self.notify("An error occurred reaching bitbox. Local changes will be pushed later.", PrintMode.WARNING)
+    self.interval = min(self.interval * 2, self.maxInterval)
+    for syncRecord in syncRecords:
+      self.dirty[syncRecord.syncId] = time.monotonic() + self.interval - self.debounce
+
+  #
+  # Remote changes
+  #
+
+  def poll(self) -> bool:
+    """
+    List every remote file at once, and pull the ones that have changed.
+
+    :returns: Whether any remote changes were found.
+    """
+    previousFiles = self.remoteFiles
+    self.remoteFiles = { fileInfo.fileId: fileInfo for fileInfo in self.client.filesInfo() }
+    changed = False
+    updates = []
+    packs: Dict[str, List[syncinfo.SyncRecord]] = {}
+    for syncRecord in list(self.records.values()):
+      fileInfo = self.remoteFiles.get(syncRecord.fileId)
+      if fileInfo is None:
+        continue
+      if syncRecord.member is not None:
+        # Packs are only downloaded when their hash changes, or when the watcher starts
+        previous = previousFiles.get(syncRecord.fileId)
+        if previous is None or previous.hash != fileInfo.hash:
+          packs.setdefault(syncRecord.fileId, []).append(syncRecord)
+        continue
+      if fileInfo.hash == syncRecord.lastHash or syncRecord.syncId in self.dirty:
+        continue
+
+      # Only pull into clones without local changes
+      link = syncinfo.getLinkName(syncRecord)
+      if syncinfo.hashLocalFile(link, syncRecord) != syncRecord.lastHash:
+        self.conflict(syncRecord, fileInfo.hash)
+        continue
+      try:
+        updates.append((link, mirrorFile(self.client, MirrorTask(fileInfo=fileInfo, local=link, existing=True))))
+        self.notify(f"Pulled remote changes from '{self.renderRemote(syncRecord)}'.", PrintMode.SUCCESS)
+        changed = True
+      except MirrorException as e:
+        self.notify(e.message, PrintMode.WARNING)
+      except (requests.RequestException, lib.BitboxException):
+        self.notify(f"Could not download '{self.renderRemote(syncRecord)}'. It will be tried again later.", PrintMode.WARNING)
+
+    for fileId, syncRecords in packs.items():
+      try:
+        packUpdates = self.pullPack(self.remoteFiles[fileId], syncRecords)
+      except (lib.FileNotFoundException, lib.FileNotReadyException, lib.DownloadException, lib.PackException, requests.RequestException, lib.BitboxException):
+        self.notify(f"Could not download the pack '@{self.remoteFiles[fileId].owner}/{self.remoteFiles[fileId].name}'. It will be tried again later.", PrintMode.WARNING)
+        self.remoteFiles.pop(fileId)
+        continue
+      updates += packUpdates
+      changed = changed or len(packUpdates) > 0
+
+    # Write the session and the new hashes back onto the disk
+    syncinfo.updateSyncs(updates)
+    config.setSession(self.client.authInfo.session)
+    return changed
+
+  def pullPack(self, fileInfo: FileInfo, syncRecords: List[syncinfo.SyncRecord]) -> List[Tuple[str, str]]:
+    """
+    Download a pack once, and write the members that have changed into their clones.
+
+    :returns: The (hard link, hash) pairs of the clones that were written.
+    """
+    saveResponse = self.client.saveById(fileInfo.fileId)
+    packBlob, _ = self.client.fetch(saveResponse, operation="watch")
+    members = lib.readPackIndex(packBlob)
+    updates = []
+    for syncRecord in syncRecords:
+      member = members.get(syncRecord.member)
+      if member is None or member.hash == syncRecord.lastHash or syncRecord.syncId in self.dirty:
+        continue
+      link = syncinfo.getLinkName(syncRecord)
+      if syncinfo.hashLocalFile(link, syncRecord) != syncRecord.lastHash:
+        self.conflict(syncRecord, member.hash)
+        continue
+      with open(link, "wb") as f:
+        f.write(lib.extractMember(packBlob, member))
+      updates.append((link, member.hash))
+      self.notify(f"Pulled remote changes from '{self.renderRemote(syncRecord)}'.", PrintMode.SUCCESS)
+    return updates
+
+  #
+  # Main loop
+  #
+
+  def run(self) -> None:
+    while True:
+      self.reload()
+
+      # Push local changes once they've settled, and poll for remote changes when it's time
+      changed = self.pushQuiet()
+      now = time.monotonic()
+      if now >= self.nextPoll:
+        try:
+          changed = self.poll() or changed
+        except (requests.RequestException, lib.BitboxException):
+          # Back off until bitbox can be reached again
+          self.notify("An error occurred checking for remote changes. Trying again later.", PrintMode.WARNING)
+        self.interval = self.minInterval if changed else min(self.interval * 2, self.maxInterval)
+        self.nextPoll = time.monotonic() + self.interval
+      elif changed:
+        # Local activity makes remote activity more likely, so poll again soon
+        self.interval = self.minInterval
+        self.nextPoll = min(self.nextPoll, now + self.interval)
+
+      # Sleep until the next event, the next push or the next poll
+      deadlines = [self.nextPoll] + [lastEvent + self.debounce for lastEvent in self.dirty.values()]
+      timeout = max(0, min(deadlines) - time.monotonic())
+      readable, _, _ = select.select([self.inotify], [], [], timeout)
+      if readable:
+        self.handleEvents()
+
+#
+# Watch command
+#
+
+@app.command(short_help="Watch your clones, pushing and pulling changes automatically (Linux only)")
+def watch(
+  debounce: float = typer.Option(DEFAULT_WATCH_DEBOUNCE, help="Seconds a file must go without writes before its changes are pushed"),
+  minInterval: float = typer.Option(DEFAULT_WATCH_MIN_INTERVAL, "--min-interval", help="Shortest time in seconds between checks for remote changes"),
+  maxInterval: float = typer.Option(DEFAULT_WATCH_MAX_INTERVAL, "--max-interval", help="Longest time in seconds between checks for remote changes, reached when nothing changes")):
+  # Get user info and try to establish a session
+  authInfo = config.load()
+
+  # Set up inotify
+  try:
+    watcher = Watcher(lib.Client(authInfo), debounce, minInterval, maxInterval)
+  except InotifyException as e:
+    error(f"`bitbox watch` needs Linux's inotify: {e.message}")
+
+  # Watch until interrupted
+  watcher.reload()
+  success(f"Watching {len(watcher.watches)} clones for changes. Press Ctrl+C to stop.")
+  try:
+    watcher.run()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    watcher.inotify.close()
+    config.setSession(authInfo.session)
@@ -4,6 +4,7 @@ from bitbox.common import *
 import bitbox.server as server
 from bitbox.cli.otc_dict import otcDict
 import bitbox.lib as lib
+import bitbox.metrics as metrics
 import time
 import typer
 import requests
@@ -25,11 +26,12 @@ import sys
 
 BITBOX_KEYFILE_FILENAME = "keyfile.json"
 BITBOX_SESSION_FILENAME = "session.str"
+BITBOX_LIMIT_RATE_FILENAME = "limitrate.str"
 BITBOX_SYNCS_FOLDERNAME = "syncs"
 BITBOX_SYNCINFO_FILENAME = "syncinfo.json"
 OTC_WORDS = 6
 BITBOX_USERNAME_REGEX = r"^[a-z0-9]+$"
-BITBOX_FILENAME_REGEX = r"^@[a-z0-9]+\/[^\/\r\n ]+$"
+BITBOX_FILENAME_REGEX = r"^@[a-z0-9]+\/[^\r\n ]+$"
 
 #
 # Global variables
@@ -95,6 +97,29 @@ class Config:
     except Exception as e:
       raise ConfigParseException(keyInfoPath, e)
 
+  def getLimitRate(self) -> Optional[str]:
+    try:
+      limitRatePath = os.path.join(self.__configFolder, BITBOX_LIMIT_RATE_FILENAME)
+      if os.path.exists(limitRatePath):
+        with open(limitRatePath, "r") as f:
+          return f.read().strip() or None
+      else:
+        return None
+    except Exception as e:
+      raise ConfigParseException(limitRatePath, e)
+
+  def setLimitRate(self, limitRate: Optional[str]):
+    try:
+      limitRatePath = os.path.join(self.__configFolder, BITBOX_LIMIT_RATE_FILENAME)
+      if limitRate is None:
+        if os.path.exists(limitRatePath):
+          os.remove(limitRatePath)
+      else:
+        with open(limitRatePath, "w") as f:
+          f.write(limitRate)
+    except Exception as e:
+      raise ConfigParseException(limitRatePath, e)
+
   def load(self) -> AuthInfo:
     # Get key info
     keyInfo = self.getKeyInfo()
@@ -195,7 +220,7 @@ def confirmLocalFileExists(file: str):
 def parseRemoteFilename(remote: str, defaultOwner: Optional[str] = None):
     # Parse the remote file name as either the owner's username and filename or just a filename
   if (re.match(BITBOX_FILENAME_REGEX, remote)):
-    splitFile = remote.split("/")
+    splitFile = remote.split("/", 1)
     owner = splitFile[0][1:]
     filename = splitFile[1]
   else:
@@ -215,7 +240,7 @@ def uploadFile(uploadURL: str, encryptedFileBytes: bytes) -> None:
     console.print(f"Uploading file...", end="")
   
   # Create a resumable session
-  resumableSession = requests.post(uploadURL, "", headers={
+  resumableSession = server.defaultConnection.pool.post(uploadURL, "", headers={
       "x-goog-resumable": "start",
       "content-type": "text/plain",
       "x-goog-content-length-range": f"0,{len(encryptedFileBytes)}"
@@ -228,8 +253,10 @@ def uploadFile(uploadURL: str, encryptedFileBytes: bytes) -> None:
   # Get the location to upload to
   location = resumableSession.headers["location"]
 
-  # Upload to that location via a PUT request
-  uploadResponse = requests.put(location, data=encryptedFileBytes, headers={
+  # Upload to that location via a PUT request, at no more than the bandwidth limit
+  throttle = lib.defaultThrottle()
+  body = encryptedFileBytes if throttle is None else lib.throttle.ThrottledReader(encryptedFileBytes, throttle)
+  uploadResponse = server.defaultConnection.pool.put(location, data=body, headers={
     "content-type": "text/plain",
     "content-length": str(len(encryptedFileBytes))
   })
@@ -243,6 +270,21 @@ def uploadFile(uploadURL: str, encryptedFileBytes: bytes) -> None:
     console.print("Error while uploading file.", style="red")
     console.print(uploadResponse.text)
     raise typer.Exit(code=1)
+  metrics.bytesUploaded.inc(len(encryptedFileBytes))
+
+def parseLimitRate(limitRate: str) -> lib.RateSchedule:
+  try:
+    return lib.parseSchedule(limitRate)
+  except ValueError:
+    error(f"Invalid rate limit '{limitRate}'. Use a number of bytes per second with an optional suffix of 'k', 'M' or 'G', like '2M', or a schedule like '09:00-18:00=512k,4M'.")
+
+def limitTransfers(limitRate: Optional[str]) -> None:
+  """
+  Limit the bandwidth of every transfer in this process to a rate or schedule of rates, as read by
+  `lib.parseSchedule`, sharing it with other processes if `BITBOX_LIMIT_RATE_FILE` is set.
+  """
+  if limitRate is not None:
+    lib.setDefaultThrottle(lib.TokenBucket(parseLimitRate(limitRate), BITBOX_LIMIT_RATE_FILE))
 
 def humanReadableFilesize(bytes: int) -> str:
   if bytes < 1024:
@@ -277,6 +319,9 @@ def printFilesInfo(username: str, filesInfo: List[FileInfo]) -> None:
   table.add_column("Last Modified")
   table.add_column("Shared With")
   for fileInfo in filesInfo:
+    # Chunks of files in delta mode and pack markers are listed as part of their files
+    if lib.isChunkName(fileInfo.name) or lib.isPackMarker(fileInfo.name):
+      continue
     if fileInfo.owner != username:
       filename = f"@{fileInfo.owner}/{fileInfo.name}"
     else:
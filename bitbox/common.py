@@ -3,6 +3,7 @@ from dataclasses import dataclass
 from typing import Optional, List, Callable
 import time
 from Crypto.PublicKey import RSA
+import bitbox.metrics as metrics
 
 PersonalKey = str
 Session = str
@@ -28,6 +29,7 @@ class AuthInfo:
     key is cached in the AuthInfo object.
     """
     # If we've already cached the private key, return it
+    metrics.recordCacheLookup("private-key", self.cachedPrivateKey is not None)
     if self.cachedPrivateKey is not None:
       return self.cachedPrivateKey
     
@@ -1,10 +1,12 @@
 from bitbox.common import *
-from typing import Optional
+from typing import Optional, Tuple
+from cryptography.fernet import Fernet, InvalidToken
 from Crypto.Cipher import PKCS1_OAEP
 from Crypto.PublicKey import RSA
 import cryptocode
 import hashlib
 import getpass
+import os
 
 def getPersonalKey() -> PersonalKey:
   password = getpass.getpass("Password: ")
@@ -66,3 +68,215 @@ class StreamDecryptor(StreamOperator):
       decrypted.append(encrypted[i] ^ self._getState())
       self._rotateState(decrypted[i])
     return bytes(decrypted)
+
+#
+# Framed encryption
+#
+# Large blobs are encrypted as a header line followed by a sequence of frames, each of which is a
+# Fernet token on its own line. The header holds a random ID for the blob, and the plaintext of
+# every frame starts with that ID, the frame index and a flag marking the final frame, so frames
+# cannot be reordered, dropped, truncated or spliced in from another blob encrypted with the same
+# key, such as an older version of the same file, without detection. Every frame except the last
+# holds exactly `frameSize` bytes of data, so the position of any frame in the encrypted blob can
+# be computed without reading the blob.
+#
+
+FRAMED_MAGIC = b"bitbox-frames/"
+FRAMED_VERSION = 2
+BLOB_ID_BYTES = 16
+FRAME_INDEX_BYTES = 8
+DEFAULT_FRAME_SIZE = 256 * 1024
+
+class FrameException(Exception):
+  pass
+
+def fernetTokenLength(plaintextLength: int) -> int:
+  # Version, timestamp, IV, AES-CBC ciphertext with PKCS7 padding and HMAC, then base64 encoded
+  ciphertextLength = (plaintextLength // 16 + 1) * 16
+  return 4 * ((1 + 8 + 16 + ciphertextLength + 32 + 2) // 3)
+
+def framedHeader(frameSize: int, blobId: bytes) -> bytes:
+  return FRAMED_MAGIC + f"{FRAMED_VERSION} {frameSize} {blobId.hex()}\n".encode("utf-8")
+
+def frameCount(plaintextLength: int, frameSize: int) -> int:
+  return max(1, (plaintextLength + frameSize - 1) // frameSize)
+
+def frameLength(dataLength: int) -> int:
+  return fernetTokenLength(BLOB_ID_BYTES + FRAME_INDEX_BYTES + 1 + dataLength) + 1
+
+def framedLength(plaintextLength: int, frameSize: int = DEFAULT_FRAME_SIZE) -> int:
+  """
+  Returns the exact length of the framed encryption of a plaintext of the given length.
+  """
+  count = frameCount(plaintextLength, frameSize)
+  lastDataLength = plaintextLength - (count - 1) * frameSize
+  return len(framedHeader(frameSize, bytes(BLOB_ID_BYTES))) + (count - 1) * frameLength(frameSize) + frameLength(lastDataLength)
+
+def framedLayout(encryptedLength: int, frameSize: int, headerLength: int) -> Tuple[int, int]:
+  """
+  Work out how a framed blob of the given length is split into frames, without reading it. Frame
+  `i` starts `headerLength + i * frameLength(frameSize)` bytes into the blob.
+
+  :returns: A tuple of the number of frames and the length of the final frame.
+  """
+  fullLength = frameLength(frameSize)
+  count = max(1, (encryptedLength - headerLength + fullLength - 1) // fullLength)
+  lastLength = encryptedLength - headerLength - (count - 1) * fullLength
+  if lastLength < frameLength(0):
+    raise FrameException()
+  return count, lastLength
+
+def isFramed(encrypted: bytes) -> bool:
+  return encrypted.startswith(FRAMED_MAGIC)
+
+def parseFramedHeader(encrypted: bytes) -> Optional[Tuple[int, int, bytes]]:
+  """
+  Parse the header at the start of a framed blob.
+
+  :returns: A tuple of the frame size, the length of the header and the blob ID, or None if the
+    header is incomplete.
+  """
+  end = encrypted.find(b"\n")
+  if end == -1:
+    if len(encrypted) > len(FRAMED_MAGIC) + 2 * BLOB_ID_BYTES + 24:
+      raise FrameException()
+    return None
+  try:
+    fields = encrypted[len(FRAMED_MAGIC):end].decode("ascii").split(" ")
+    if fields[0] != str(FRAMED_VERSION) or len(fields) != 3:
+      raise FrameException()
+    blobId = bytes.fromhex(fields[2])
+    if len(blobId) != BLOB_ID_BYTES:
+      raise FrameException()
+    frameSize = int(fields[1])
+  except (ValueError, UnicodeDecodeError):
+    raise FrameException()
+  return frameSize, end + 1, blobId
+
+def encryptFrame(fernet: Fernet, blobId: bytes, index: int, data: bytes, final: bool) -> bytes:
+  prefix = blobId + index.to_bytes(FRAME_INDEX_BYTES, "big") + (b"\1" if final else b"\0")
+  return fernet.encrypt(prefix + data) + b"\n"
+
+def decryptFrame(fernet: Fernet, blobId: bytes, index: int, frame: bytes) -> Tuple[bytes, bool]:
+  """
+  Decrypt and authenticate a single frame, checking that it belongs to the blob with the given ID
+  at the given index.
+
+  :returns: A tuple of the frame's data and whether it is the final frame.
+  """
+  try:
+    plaintext = fernet.decrypt(frame.rstrip(b"\n"))
+  except InvalidToken:
+    raise FrameException()
+  prefixLength = len(blobId) + FRAME_INDEX_BYTES + 1
+  if len(plaintext) < prefixLength or plaintext[:len(blobId)] != blobId:
+    raise FrameException()
+  if int.from_bytes(plaintext[len(blobId):len(blobId) + FRAME_INDEX_BYTES], "big") != index:
+    raise FrameException()
+  return plaintext[prefixLength:], plaintext[prefixLength - 1] == 1
+
+class FrameEncryptor:
+  """
+  Encrypts a stream of plaintext into the framed format. Feed it every chunk of plaintext with
+  `update`, then call `finish`; both return whatever encrypted bytes are ready.
+  """
+  frameSize: int
+  blobId: bytes
+  __fernet: Fernet
+  __buffer: bytearray
+  __index: int
+  __started: bool
+
+  def __init__(self, key: bytes, frameSize: int = DEFAULT_FRAME_SIZE):
+    self.frameSize = frameSize
+    self.blobId = os.urandom(BLOB_ID_BYTES)
+    self.__fernet = Fernet(key)
+    self.__buffer = bytearray()
+    self.__index = 0
+    self.__started = False
+
+  def __header(self) -> bytes:
+    if self.__started:
+      return b""
+    self.__started = True
+    return framedHeader(self.frameSize, self.blobId)
+
+  def update(self, data: bytes) -> bytes:
+    encrypted = [self.__header()]
+    self.__buffer += data
+    # Always keep at least one byte back, so the final frame is never empty unless the whole
+    # plaintext is
+    while len(self.__buffer) > self.frameSize:
+      encrypted.append(encryptFrame(self.__fernet, self.blobId, self.__index, bytes(self.__buffer[:self.frameSize]), False))
+      del self.__buffer[:self.frameSize]
+      self.__index += 1
+    return b"".join(encrypted)
+
+  def finish(self) -> bytes:
+    encrypted = self.__header() + encryptFrame(self.__fernet, self.blobId, self.__index, bytes(self.__buffer), True)
+    self.__buffer = bytearray()
+    return encrypted
+
+class FrameDecryptor:
+  """
+  Decrypts a framed blob incrementally. Feed it encrypted bytes as they arrive with `update`, which
+  returns whatever plaintext is ready, then call `finish` to check that the final frame was seen.
+  """
+  __fernet: Fernet
+  __buffer: bytearray
+  __frameSize: Optional[int]
+  __blobId: bytes
+  __index: int
+  __finished: bool
+
+  def __init__(self, key: bytes):
+    self.__fernet = Fernet(key)
+    self.__buffer = bytearray()
+    self.__frameSize = None
+    self.__blobId = b""
+    self.__index = 0
+    self.__finished = False
+
+  def update(self, data: bytes) -> bytes:
+    self.__buffer += data
+
+    # Parse the header first
+    if self.__frameSize is None:
+      if not bytes(self.__buffer[:len(FRAMED_MAGIC)]) == FRAMED_MAGIC[:len(self.__buffer)]:
+        raise FrameException()
+      header = parseFramedHeader(bytes(self.__buffer))
+      if header is None:
+        return b""
+      self.__frameSize, headerLength, self.__blobId = header
+      del self.__buffer[:headerLength]
+
+    # Decrypt every complete frame
+    decrypted = []
+    while True:
+      end = self.__buffer.find(b"\n")
+      if end == -1:
+        break
+      if self.__finished:
+        raise FrameException()
+      data, self.__finished = decryptFrame(self.__fernet, self.__blobId, self.__index, bytes(self.__buffer[:end]))
+      del self.__buffer[:end + 1]
+      self.__index += 1
+      decrypted.append(data)
+    return b"".join(decrypted)
+
+  def finish(self) -> None:
+    if not self.__finished or len(self.__buffer) > 0:
+      raise FrameException()
+
+def decryptContents(encrypted: bytes, fileKey: bytes) -> bytes:
+  """
+  Decrypt a whole blob that was encrypted with the given file key, either as a single Fernet token
+  or in the framed format.
+  """
+  if isFramed(encrypted):
+    decryptor = FrameDecryptor(fileKey)
+    blob = decryptor.update(encrypted)
+    decryptor.finish()
+    return blob
+  else:
+    return Fernet(fileKey).decrypt(encrypted)
@@ -1,6 +1,13 @@
-from bitbox.lib.upload import upload
-from bitbox.lib.download import download
+from bitbox.lib.client import Client
+from bitbox.lib.upload import upload, upload_fileobj, upload_file, upload_stream
+from bitbox.lib.update import update, update_fileobj
+from bitbox.lib.download import download, download_fileobj, download_file, read_range
 from bitbox.lib.share import share
+from bitbox.lib.cache import BlobCache, defaultBlobCache
+from bitbox.lib.throttle import TokenBucket, RateSchedule, parseRate, parseSchedule, defaultThrottle, setDefaultThrottle
+from bitbox.lib.delta import DeltaChunk, DeltaSegment, DeltaManifest, DeltaException, isDelta, isChunkName, chunkBoundaries
+from bitbox.lib.pack import PackMember, PackException, isPack, packMarkerName, isPackMarker, buildPack, readPackIndex, extractMember, replaceMembers
+from bitbox.lib.plan import PlanItem, Plan, planTransfers
 from bitbox.lib.register import register
 from bitbox.lib.login import login
 from bitbox.lib.backup import backup
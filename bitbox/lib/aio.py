@@ -0,0 +1,482 @@
+from bitbox.common import *
+from bitbox.encryption import *
+from bitbox.lib.exceptions import *
+from bitbox.lib.client import TTLCache, DEFAULT_CACHE_TTL
+from bitbox.lib.throttle import TokenBucket, THROTTLE_QUANTUM, defaultThrottle, throttledChunks
+from bitbox.lib.delta import *
+from bitbox.lib.pack import packMarkerName
+import bitbox.server as server
+import bitbox.server.aio as aioserver
+import bitbox.metrics as metrics
+from cryptography.fernet import Fernet
+from concurrent.futures import Executor
+from typing import Callable, TypeVar, Tuple
+import asyncio
+import binascii
+import hashlib
+import re
+
+T = TypeVar("T")
+
+#
+# Client
+#
+
+class AsyncClient:
+  """
+  An asyncio client for the Bitbox server, with the same operations and exceptions as
+  `bitbox.lib.Client`. Requests share a bounded pool of connections, and all hashing, encryption
+  and RSA work runs in an executor so that it never blocks the event loop.
+
+  Use it with `async with`, or call `close()` when done.
+  """
+  authInfo: AuthInfo
+  connection: aioserver.AsyncConnection
+  executor: Optional[Executor]
+  throttle: Optional[TokenBucket]
+  __publicKey: Optional[RSA.RsaKey]
+  __keyLock: asyncio.Lock
+  __fileInfoCache: TTLCache
+  __userInfoCache: TTLCache
+
+  def __init__(self,
+    authInfo: AuthInfo,
+    host: str = BITBOX_HOST,
+    maxConcurrency: int = aioserver.DEFAULT_MAX_CONCURRENCY,
+    executor: Optional[Executor] = None,
+    cacheTTL: float = DEFAULT_CACHE_TTL,
+    throttle: Optional[TokenBucket] = None):
+    """
+    :param authInfo: Authentication information, as returned by `login`.
+    :param host: Host of the Bitbox server.
+    :param maxConcurrency: Maximum number of requests in flight at once.
+    :param executor: Executor for CPU-heavy work. If None, the event loop's default executor is used.
+    :param cacheTTL: Number of seconds that file and user information is cached for.
+    :param throttle: Bucket that limits the rate of uploads and downloads. See `Client`.
+    """
+    self.authInfo = authInfo
+    self.connection = aioserver.AsyncConnection(host, maxConcurrency)
+    self.executor = executor
+    self.throttle = defaultThrottle() if throttle is None else throttle
+    self.__publicKey = None
+    self.__keyLock = asyncio.Lock()
+    self.__fileInfoCache = TTLCache("file-info", cacheTTL)
+    self.__userInfoCache = TTLCache("user-info", cacheTTL)
+
+  @property
+  def username(self) -> str:
+    return self.authInfo.keyInfo.username
+
+  async def close(self) -> None:
+    await self.connection.close()
+
+  async def __aenter__(self) -> "AsyncClient":
+    return self
+
+  async def __aexit__(self, *args) -> None:
+    await self.close()
+
+  async def offload(self, function: Callable[..., T], *args) -> T:
+    """
+    Run a CPU-heavy function in the executor.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.executor, function, *args)
+
+  #
+  # Keys
+  #
+
+  async def getPublicKey(self) -> RSA.RsaKey:
+    async with self.__keyLock:
+      metrics.recordCacheLookup("public-key", self.__publicKey is not None)
+      if self.__publicKey is None:
+        self.__publicKey = await self.offload(getPublicKey, self.authInfo.keyInfo)
+      return self.__publicKey
+
+  async def getPrivateKey(self) -> RSA.RsaKey:
+    async with self.__keyLock:
+      return await self.offload(self.authInfo.getPrivateKey)
+
+  #
+  # Metadata
+  #
+
+  async def fileInfo(self, filename: str, owner: Optional[str] = None) -> FileInfo:
+    """
+    Get information about a file, from the cache if it is fresh enough. See `Client.fileInfo`.
+    """
+    fileInfo = self.__fileInfoCache.get((filename, owner))
+    if fileInfo is not None:
+      return fileInfo
+
+    fileInfo = await aioserver.fileInfo(filename, owner, self.authInfo, self.connection)
+    if isinstance(fileInfo, server.Error):
+      if fileInfo == server.Error.FILE_NOT_FOUND:
+        raise FileNotFoundException(filename)
+      elif fileInfo == server.Error.USER_NOT_FOUND:
+        raise UserNotFoundException(owner)
+      else:
+        raise BitboxException(fileInfo)
+    self.__fileInfoCache.set((filename, owner), fileInfo)
+    return fileInfo
+
+  async def filesInfo(self) -> List[FileInfo]:
+    """
+    List every file visible to the user with a single request. See `Client.filesInfo`.
+    """
+    filesInfo = await aioserver.filesInfo(self.authInfo, self.connection)
+    for fileInfo in filesInfo:
+      self.__fileInfoCache.set((fileInfo.name, fileInfo.owner), fileInfo)
+    return filesInfo
+
+  async def userPublicKey(self, username: str) -> RSA.RsaKey:
+    """
+    Get the public key of another user. See `Client.userPublicKey`.
+    """
+    publicKey = self.__userInfoCache.get(username)
+    if publicKey is not None:
+      return publicKey
+
+    userInfoResponse = await aioserver.userInfo(username, self.connection)
+    if isinstance(userInfoResponse, server.Error):
+      raise UserNotFoundException(username)
+    publicKey = await self.offload(RSA.import_key, userInfoResponse.publicKey)
+    self.__userInfoCache.set(username, publicKey)
+    return publicKey
+
+  def invalidate(self, filename: str, owner: Optional[str] = None) -> None:
+    self.__fileInfoCache.discard((filename, owner))
+    self.__fileInfoCache.discard((filename, None))
+
+  #
+  # Operations
+  #
+
+  async def upload(self, blob: bytes, filename: str, overwrite: bool = False, filesInfo: Optional[List[FileInfo]] = None) -> None:
+    """
+    Upload a blob to the server. See `bitbox.lib.upload`.
+
+    :param filesInfo: A listing of the user's files, if the caller already has one. See
+      `Client.upload`.
+    """
+    # Tell the server we want to add this file before encrypting anything. The length of the
+    # encrypted blob is known in advance, and the key depends on whether the file already exists
+    blobHash = await self.offload(hashBlob, blob)
+    prepared = await self.prepareUpload(filename, fernetTokenLength(len(blob)), blobHash, overwrite)
+    if prepared is None:
+      return
+    fileId, uploadURL, fileKey, replaced = prepared
+
+    # Encrypt and upload the blob
+    encryptedBlob = await self.offload(encryptBlob, blob, fileKey)
+    await self.putBlob(uploadURL, encryptedBlob)
+
+    # Tell the server we're done uploading. A file that was in delta mode no longer needs its chunks
+    await self.store(fileId)
+    if replaced and filesInfo is not None:
+      await self.deleteChunks(filename, filesInfo)
+
+  async def prepareUpload(self, filename: str, bytes: int, blobHash: str, overwrite: bool = False) -> Optional[Tuple[str, str, bytes, bool]]:
+    """
+    Tell the server we want to upload a file, before anything is encrypted. See
+    `Client.prepareUpload`.
+    """
+    # Wrap a random file key with the user's public key
+    fileKey = Fernet.generate_key()
+    personalEncryptedKeyHex = await self.offload(wrapKey, fileKey, await self.getPublicKey())
+
+    # Whatever happens, cached information about this file is about to be stale
+    self.invalidate(filename, self.username)
+
+    # Try to add the file first, which is a single request when it is new
+    prepareStoreResponse = await aioserver.prepareStore(filename, bytes, blobHash, personalEncryptedKeyHex, self.authInfo, self.connection)
+    if isinstance(prepareStoreResponse, server.Error):
+      if prepareStoreResponse == server.Error.FILE_EXISTS:
+        if overwrite:
+          # If the file already exists and overwrite = True, replace its contents in place
+          prepared = await self.prepareReplace(await self.fileInfo(filename, self.username), bytes, blobHash)
+          return None if prepared is None else (*prepared, True)
+        else:
+          raise FileExistsException(filename)
+      elif prepareStoreResponse == server.Error.FILE_TOO_LARGE:
+        raise FileTooLargeException()
+      else:
+        raise BitboxException(prepareStoreResponse)
+    return prepareStoreResponse.fileId, prepareStoreResponse.uploadURL, fileKey, False
+
+  async def prepareReplace(self, fileInfo: FileInfo, bytes: int, blobHash: str) -> Optional[Tuple[str, str, bytes]]:
+    """
+    Tell the server we want to replace the contents of one of the user's files, keeping its key so
+    that it stays shared with everyone it was shared with. See `Client.prepareReplace`.
+    """
+    # Nothing needs to be uploaded if the file already has these contents
+    if fileInfo.hash == blobHash:
+      return None
+
+    # Decrypt the existing file key
+    privateKey = await self.getPrivateKey()
+    fileKey = await self.offload(unwrapKey, fileInfo.encryptedKey, privateKey)
+
+    # Tell the server we want to replace the contents, and get the URL to upload to
+    self.invalidate(fileInfo.name, self.username)
+    prepareUpdateResponse = await aioserver.prepareUpdate(fileInfo.fileId, bytes, blobHash, self.authInfo, self.connection)
+    if isinstance(prepareUpdateResponse, server.Error):
+      if prepareUpdateResponse == server.Error.FILE_NOT_FOUND:
+        raise FileNotFoundException(fileInfo.fileId)
+      elif prepareUpdateResponse == server.Error.FILE_TOO_LARGE:
+        raise FileTooLargeException()
+      elif prepareUpdateResponse == server.Error.FILE_NOT_READY:
+        raise FileNotReadyException(fileInfo.fileId)
+      else:
+        raise BitboxException(prepareUpdateResponse)
+    return fileInfo.fileId, prepareUpdateResponse.uploadURL, fileKey
+
+  async def download(self, filename: str, owner: str) -> bytes:
+    """
+    Download a blob from the server. See `bitbox.lib.download`.
+    """
+    # Get the file info, and a download link for the encrypted blob, looking the file up again if
+    # the cached file info is out of date
+    fileInfo = await self.fileInfo(filename, owner)
+    saveResponse = await aioserver.save(fileInfo.fileId, self.authInfo, self.connection)
+    if saveResponse == server.Error.FILE_NOT_FOUND:
+      self.invalidate(filename, owner)
+      fileInfo = await self.fileInfo(filename, owner)
+      saveResponse = await aioserver.save(fileInfo.fileId, self.authInfo, self.connection)
+    if isinstance(saveResponse, server.Error):
+      if saveResponse == server.Error.FILE_NOT_FOUND:
+        raise FileNotFoundException(fileInfo.name)
+      elif saveResponse == server.Error.FILE_NOT_READY:
+        raise FileNotReadyException(fileInfo.name)
+      else:
+        raise BitboxException(saveResponse)
+
+    # Download the file
+    encryptedBlob = await self.getBlob(saveResponse.downloadURL)
+
+    # Decrypt the file. Files in delta mode hold a manifest, and their contents are put together from
+    # their chunks
+    privateKey = await self.getPrivateKey()
+    blob, fileKey = await self.offload(decryptBlob, encryptedBlob, saveResponse.encryptedKey, privateKey)
+    if isDelta(blob):
+      blob = await self.assembleDelta(blob, fileKey)
+
+    # Check that it matches the hash on the server
+    blobHash = await self.offload(hashBlob, blob)
+    if blobHash != saveResponse.hash:
+      metrics.hashMismatches.inc(operation="download")
+      raise DownloadException()
+
+    # Return the decrypted blob
+    return blob
+
+  async def share(self, filename: str, recipients: List[str], filesInfo: Optional[List[FileInfo]] = None) -> None:
+    """
+    Share a file with other users. See `bitbox.lib.share`.
+
+    :param filesInfo: A listing of the user's files, if the caller already has one.
+    """
+    # Get the file info from a listing, which also has the chunks and marker of the file if it has any
+    filesInfo = await self.filesInfo() if filesInfo is None else filesInfo
+    fileInfo = next((fileInfo for fileInfo in filesInfo if fileInfo.owner == self.username and fileInfo.name == filename), None)
+    if fileInfo is None:
+      raise FileNotFoundException(filename)
+    publicKeys = await asyncio.gather(*[self.userPublicKey(recipient) for recipient in recipients])
+
+    # Decrypt the file key and re-encrypt it for each recipient
+    privateKey = await self.getPrivateKey()
+    encryptedKeys = await self.offload(reencryptKey, fileInfo.encryptedKey, privateKey, publicKeys)
+    recipientEncryptedKeys = dict(zip(recipients, encryptedKeys))
+
+    # Share the file with the recipients
+    try:
+      await self.shareKey(fileInfo.fileId, recipientEncryptedKeys)
+    except FileNotFoundException:
+      raise FileNotFoundException(fileInfo.name)
+    finally:
+      self.invalidate(filename, self.username)
+
+    # Share its segments too if it is in delta mode, and its marker if it is a pack. They are
+    # encrypted with the same key, so the same wrapped keys work for them
+    prefix = chunkPrefix(filename)
+    marker = packMarkerName(filename)
+    related = [fileInfo for fileInfo in filesInfo if fileInfo.owner == self.username and (fileInfo.name.startswith(prefix) or fileInfo.name == marker)]
+    await asyncio.gather(*[self.shareKey(fileInfo.fileId, recipientEncryptedKeys) for fileInfo in related])
+
+  async def shareKey(self, fileId: str, recipientEncryptedKeys: Dict[str, str]) -> None:
+    """
+    Share a file with other users, given its key wrapped with each of their public keys. See
+    `Client.shareKey`.
+    """
+    shareResponse = await aioserver.share(fileId, recipientEncryptedKeys, self.authInfo, self.connection)
+    if isinstance(shareResponse, server.Error):
+      if shareResponse == server.Error.FILE_NOT_FOUND:
+        raise FileNotFoundException(fileId)
+      else:
+        raise BitboxException(shareResponse)
+
+  async def assembleDelta(self, manifestBlob: bytes, fileKey: bytes) -> bytes:
+    """
+    Put together the contents of a file in delta mode from its chunks. Each run of neighbouring
+    chunks is downloaded with one range request, as many at once as the connection allows. See
+    `Client.assembleDelta`.
+
+    :raises DownloadException: If the manifest is not valid, a chunk could not be downloaded, or a
+      chunk does not match its hash.
+    """
+    try:
+      manifest = readManifest(manifestBlob)
+    except DeltaException:
+      raise DownloadException()
+    runs = chunkRuns(manifest.chunks)
+
+    # Get a download link for each segment
+    async def getLink(segment: int) -> str:
+      saveResponse = await aioserver.save(manifest.segments[segment].fileId, self.authInfo, self.connection)
+      if isinstance(saveResponse, server.Error):
+        raise DownloadException()
+      return saveResponse.downloadURL
+    used = sorted(set(run[0].segment for run in runs))
+    links = dict(zip(used, await asyncio.gather(*[getLink(segment) for segment in used])))
+
+    # Download and decrypt the runs, checking each chunk against its hash
+    async def fetchRun(run: List[DeltaChunk]) -> List[bytes]:
+      start = run[0].offset
+      end = run[-1].offset + chunkTokenLength(run[-1])
+      received, receivedStart = await self.getBlobRange(links[run[0].segment], start, end - 1)
+      encryptedRun = received[start - receivedStart:end - receivedStart]
+      if start < receivedStart or len(encryptedRun) != end - start:
+        raise DownloadException()
+      try:
+        chunksContents = await self.offload(decryptRun, encryptedRun, run, fileKey)
+      except InvalidToken:
+        raise DownloadException()
+      if any(hashlib.sha256(contents).hexdigest() != chunk.hash for chunk, contents in zip(run, chunksContents)):
+        metrics.hashMismatches.inc(operation="download")
+        raise DownloadException()
+      return chunksContents
+    fetched = {}
+    for run, chunksContents in zip(runs, await asyncio.gather(*[fetchRun(run) for run in runs])):
+      for chunk, contents in zip(run, chunksContents):
+        fetched[(chunk.segment, chunk.offset)] = contents
+    return b"".join(fetched[(chunk.segment, chunk.offset)] for chunk in manifest.chunks)
+
+  async def deleteChunks(self, filename: str, filesInfo: Optional[List[FileInfo]] = None) -> None:
+    """
+    Delete the segments of one of the user's files in delta mode. See `Client.deleteChunks`.
+    """
+    prefix = chunkPrefix(filename)
+    for fileInfo in await self.filesInfo() if filesInfo is None else filesInfo:
+      if fileInfo.owner == self.username and fileInfo.name.startswith(prefix):
+        await aioserver.delete(fileInfo.fileId, self.authInfo, self.connection)
+        self.invalidate(fileInfo.name, self.username)
+
+  async def store(self, fileId: str) -> None:
+    """
+    Tell the server we're done uploading a file.
+    """
+    storeResponse = await aioserver.store(fileId, self.authInfo, self.connection)
+    if isinstance(storeResponse, server.Error):
+      raise BitboxException(storeResponse)
+
+  #
+  # Transfers
+  #
+
+  async def putBlob(self, uploadURL: str, encryptedBlob: bytes) -> None:
+    """
+    Upload an encrypted blob to a storage upload URL. See `Client.putBlob`.
+    """
+    resumableSession = await aioserver.fetch(self.connection, "POST", uploadURL, data=b"", headers={
+        "x-goog-resumable": "start",
+        "content-type": "text/plain",
+        "x-goog-content-length-range": f"0,{len(encryptedBlob)}"
+    })
+    if resumableSession.status_code != 201:
+      raise UploadException()
+
+    body = encryptedBlob if self.throttle is None else throttledChunks(encryptedBlob, self.throttle)
+    uploadResponse = await aioserver.fetch(self.connection, "PUT", resumableSession.headers["location"], data=body, headers={
+      "content-type": "text/plain",
+      "content-length": str(len(encryptedBlob))
+    })
+    if uploadResponse.status_code != 200:
+      raise UploadException()
+    metrics.bytesUploaded.inc(len(encryptedBlob))
+
+  async def getBlob(self, downloadURL: str) -> bytes:
+    """
+    Download an encrypted blob from a storage download URL. See `Client.getBlob`.
+    """
+    if self.throttle is None:
+      downloadResponse = await aioserver.fetch(self.connection, "GET", downloadURL)
+      if downloadResponse.status_code != 200:
+        raise DownloadException()
+      content = downloadResponse.content
+    else:
+      # Read the body a piece at a time, waiting for a turn for each
+      async with self.connection.semaphore:
+        async with self.connection.pool.get(downloadURL) as response:
+          if response.status != 200:
+            raise DownloadException()
+          chunks = []
+          async for chunk in response.content.iter_chunked(THROTTLE_QUANTUM):
+            await self.throttle.consumeAsync(len(chunk))
+            chunks.append(chunk)
+          content = b"".join(chunks)
+    metrics.bytesDownloaded.inc(len(content))
+    return content
+
+  async def getBlobRange(self, downloadURL: str, start: int, end: int) -> Tuple[bytes, int]:
+    """
+    Download the bytes from start to end inclusive of an encrypted blob with an HTTP range request.
+    See `Client.getBlobRange`.
+
+    :returns: A tuple of the bytes received, and the offset of the first of them in the blob.
+    """
+    async with self.connection.semaphore:
+      async with self.connection.pool.get(downloadURL, headers={ "range": f"bytes={start}-{end}" }) as response:
+        if response.status == 206:
+          contentRange = re.fullmatch(r"bytes (\d+)-(\d+)/(\d+)", response.headers.get("content-range", ""))
+          if contentRange is None:
+            raise DownloadException()
+          offset = int(contentRange[1])
+        elif response.status == 200:
+          offset = 0
+        else:
+          raise DownloadException()
+
+        # Read the body a piece at a time, waiting for a turn for each if downloads are throttled
+        chunks = []
+        async for chunk in response.content.iter_chunked(THROTTLE_QUANTUM):
+          if self.throttle is not None:
+            await self.throttle.consumeAsync(len(chunk))
+          chunks.append(chunk)
+        content = b"".join(chunks)
+    metrics.bytesDownloaded.inc(len(content))
+    return content, offset
+
+#
+# CPU-bound helpers, run in the executor
+#
+
+def hashBlob(blob: bytes) -> str:
+  return hashlib.sha256(blob).hexdigest()
+
+def encryptBlob(blob: bytes, fileKey: bytes) -> bytes:
+  return Fernet(fileKey).encrypt(blob)
+
+def wrapKey(fileKey: bytes, publicKey: RSA.RsaKey) -> str:
+  return binascii.hexlify(rsaEncrypt(fileKey, publicKey)).decode("utf-8")
+
+def unwrapKey(encryptedKey: str, privateKey: RSA.RsaKey) -> bytes:
+  return rsaDecrypt(binascii.unhexlify(encryptedKey), privateKey)
+
+def decryptBlob(encryptedBlob: bytes, encryptedKey: str, privateKey: RSA.RsaKey) -> Tuple[bytes, bytes]:
+  fileKey = rsaDecrypt(binascii.unhexlify(encryptedKey), privateKey)
+  return decryptContents(encryptedBlob, fileKey), fileKey
+
+def reencryptKey(encryptedKey: str, privateKey: RSA.RsaKey, publicKeys: List[RSA.RsaKey]) -> List[str]:
+  fileKey = rsaDecrypt(binascii.unhexlify(encryptedKey), privateKey)
+  return [binascii.hexlify(rsaEncrypt(fileKey, publicKey)).decode("utf-8") for publicKey in publicKeys]
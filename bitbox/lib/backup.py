@@ -1,8 +1,5 @@
 from bitbox.common import *
-from bitbox.encryption import *
-import bitbox.server as server
-import cryptocode
-from bitbox.lib.exceptions import *
+from bitbox.lib.client import Client
 
 def backup(otc: str, authInfo: AuthInfo) -> None:
   """
@@ -15,10 +12,4 @@ def backup(otc: str, authInfo: AuthInfo) -> None:
   :raises InvalidVersionException: If the server no longer supports the current version of Bitbox.
   :raises BitboxException: Any other exception indicating an bug in Bitbox.
   """
-
-  encryptedPrivateKey = cryptocode.encrypt(authInfo.keyInfo.privateKey, otc)
-  
-  try:
-    server.pushEncryptedKey(encryptedPrivateKey, authInfo)
-  except Exception as e:
-    raise BitboxException(e)
+  Client(authInfo).backup(otc)
@@ -0,0 +1,219 @@
+from bitbox.common import *
+from typing import BinaryIO, Tuple
+import threading
+import tempfile
+import hashlib
+import shutil
+import os
+import re
+
+#
+# Parameters
+#
+
+CACHE_CHUNK_SIZE = 1024 ** 2
+BLOB_HASH_PATTERN = re.compile("[0-9a-f]{64}")
+
+#
+# Blob cache
+#
+
+class BlobCache:
+  """
+  A size-capped cache of decrypted blobs on the local disk, keyed by the SHA-256 hash of their
+  contents, which is the hash the server keeps for every file. Since entries are looked up by the
+  hash of their contents, a blob is only downloaded once however many remote files hold it.
+
+  Entries are inserted atomically, so several processes can share a cache, and every entry is
+  checked against its hash before it is returned. When the cache grows past its maximum size, the
+  least recently used entries are evicted. The total size is counted once and then kept up to date
+  as entries are added, so the cache is only scanned again when it looks full; entries added by
+  other processes are counted at that scan. A cache with a maximum size of 0 is disabled: nothing is
+  stored, and every lookup misses.
+  """
+  directory: str
+  maxSize: int
+  __lock: threading.Lock
+  __size: Optional[int]
+
+  def __init__(self, directory: str, maxSize: int):
+    self.directory = directory
+    self.maxSize = maxSize
+    self.__lock = threading.Lock()
+    self.__size = None
+
+  @property
+  def enabled(self) -> bool:
+    return self.maxSize > 0
+
+  def path(self, blobHash: str) -> Optional[str]:
+    """
+    :returns: Where the blob with a given hash would be stored, or None if the hash is not valid.
+    """
+    if BLOB_HASH_PATTERN.fullmatch(blobHash) is None:
+      return None
+    return os.path.join(self.directory, blobHash[:2], blobHash)
+
+  def get(self, blobHash: str) -> Optional[bytes]:
+    """
+    :returns: The blob with a given hash, or None if it isn't cached.
+    """
+    path = self.__lookup(blobHash)
+    if path is None:
+      return None
+    try:
+      with open(path, "rb") as f:
+        blob = f.read()
+    except OSError:
+      blob = None
+    if blob is not None and hashlib.sha256(blob).hexdigest() != blobHash:
+      self.__discard(path)
+      blob = None
+    metrics.recordCacheLookup("blob", blob is not None)
+    return blob
+
+  def getInto(self, blobHash: str, fileobj: BinaryIO) -> bool:
+    """
+    Write the blob with a given hash into a writable binary stream. Nothing is written unless the
+    blob is cached and matches its hash.
+
+    :returns: Whether the blob was cached.
+    """
+    path = self.__lookup(blobHash)
+    if path is None:
+      return False
+    try:
+      with open(path, "rb") as f:
+        # Check the entry before writing any of it
+        hasher = hashlib.sha256()
+        for chunk in iter(lambda: f.read(CACHE_CHUNK_SIZE), b""):
+          hasher.update(chunk)
+        hit = hasher.hexdigest() == blobHash
+        if hit:
+          f.seek(0)
+          shutil.copyfileobj(f, fileobj, CACHE_CHUNK_SIZE)
+        else:
+          self.__discard(path)
+    except FileNotFoundError:
+      hit = False
+    metrics.recordCacheLookup("blob", hit)
+    return hit
+
+  def put(self, blobHash: str, blob: bytes) -> None:
+    """
+    Add a blob to the cache. The caller must have checked that the blob matches its hash.
+    """
+    self.__insert(blobHash, len(blob), lambda f: f.write(blob))
+
+  def putFile(self, blobHash: str, path: str) -> None:
+    """
+    Add the contents of a local file to the cache. The caller must have checked that the file
+    matches the hash.
+    """
+    def write(f: BinaryIO) -> None:
+      with open(path, "rb") as src:
+        shutil.copyfileobj(src, f, CACHE_CHUNK_SIZE)
+    try:
+      self.__insert(blobHash, os.path.getsize(path), write)
+    except OSError:
+      pass
+
+  def evict(self) -> None:
+    """
+    Delete the least recently used entries until the cache fits within its maximum size.
+    """
+    with self.__lock:
+      entries = self.__entries()
+      total = sum(size for _, size, _ in entries)
+      for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+        if total <= self.maxSize:
+          break
+        self.__discard(path)
+        total -= size
+      self.__size = total
+
+  def clear(self) -> None:
+    """
+    Delete every entry in the cache.
+    """
+    with self.__lock:
+      for path, _, _ in self.__entries():
+        self.__discard(path)
+      self.__size = 0
+
+  def __lookup(self, blobHash: str) -> Optional[str]:
+    # Find the entry, and mark it as recently used
+    path = self.path(blobHash) if self.enabled else None
+    try:
+      if path is not None:
+        os.utime(path)
+        return path
+    except OSError:
+      pass
+    metrics.recordCacheLookup("blob", False)
+    return None
+
+  def __insert(self, blobHash: str, size: int, write: Callable[[BinaryIO], None]) -> None:
+    path = self.path(blobHash)
+    if not self.enabled or path is None or size > self.maxSize or os.path.exists(path):
+      return
+
+    # Write the entry to a temporary file, and move it into place once it is complete, so that other
+    # processes never see a partial entry
+    try:
+      # The cache holds decrypted contents, so only the user can read it
+      os.makedirs(self.directory, mode=0o700, exist_ok=True)
+      os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+      with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=".tmp-", delete=False) as f:
+        tempPath = f.name
+        try:
+          write(f)
+        except BaseException:
+          f.close()
+          os.unlink(tempPath)
+          raise
+      os.replace(tempPath, path)
+    except OSError:
+      # The cache is an optimization, so failing to write to it is not an error
+      return
+
+    # Only scan the cache for entries to evict once it looks full
+    with self.__lock:
+      if self.__size is None:
+        self.__size = sum(size for _, size, _ in self.__entries())
+      else:
+        self.__size += size
+      full = self.__size > self.maxSize
+    if full:
+      self.evict()
+
+  def __entries(self) -> List[Tuple[str, int, float]]:
+    # List the (path, size, last use) of every entry
+    entries = []
+    try:
+      with os.scandir(self.directory) as iterator:
+        shards = [entry for entry in iterator if entry.is_dir(follow_symlinks=False)]
+    except OSError:
+      return entries
+    for shard in shards:
+      try:
+        with os.scandir(shard.path) as iterator:
+          for entry in iterator:
+            if BLOB_HASH_PATTERN.fullmatch(entry.name) is not None:
+              stat = entry.stat(follow_symlinks=False)
+              entries.append((entry.path, stat.st_size, stat.st_mtime))
+      except OSError:
+        continue
+    return entries
+
+  def __discard(self, path: str) -> None:
+    try:
+      os.unlink(path)
+    except OSError:
+      pass
+
+def defaultBlobCache() -> BlobCache:
+  """
+  :returns: The cache in `BITBOX_CACHE_FOLDER`, capped at `BITBOX_CACHE_MAX_SIZE` bytes.
+  """
+  return BlobCache(BITBOX_CACHE_FOLDER, BITBOX_CACHE_MAX_SIZE)
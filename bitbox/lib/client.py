@@ -0,0 +1,1447 @@
+from bitbox.common import *
+from bitbox.encryption import *
+from bitbox.lib.exceptions import *
+from bitbox.lib.stream import *
+from bitbox.lib.cache import BlobCache, defaultBlobCache
+from bitbox.lib.throttle import TokenBucket, ThrottledReader, defaultThrottle
+from bitbox.lib.delta import *
+from bitbox.lib.pack import packMarkerName
+import bitbox.server as server
+import bitbox.metrics as metrics
+from cryptography.fernet import Fernet
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Set, Tuple, Any, Hashable, Union, BinaryIO
+import threading
+import requests
+import io
+import tempfile
+import os
+import binascii
+import cryptocode
+import hashlib
+import time
+import re
+
+#
+# Parameters
+#
+
+DEFAULT_CACHE_TTL = 30
+DEFAULT_DELTA_JOBS = 8
+
+# Segments are up to DELTA_SEGMENT_SIZE bytes, so fewer of them are encrypted and uploaded at once
+DEFAULT_SEGMENT_JOBS = 4
+
+# Streams of unknown length are split into chunks of this size
+DEFAULT_STREAM_CHUNK_SIZE = 4 * 1024 ** 2
+
+# Files in delta mode are put together this many bytes at a time
+DEFAULT_ASSEMBLY_WINDOW = 64 * 1024 ** 2
+
+# Enough bytes to hold the header of a framed blob
+RANGE_HEADER_BYTES = 128
+
+#
+# Utility functions
+#
+
+def rangeStart(offset: int, size: int) -> int:
+  # Negative offsets count back from the end of the file
+  return max(0, size + offset) if offset < 0 else offset
+
+#
+# Caches
+#
+
+class TTLCache:
+  """
+  A thread-safe dictionary whose entries expire a fixed number of seconds after they were set.
+  """
+  name: str
+  ttl: float
+  __entries: Dict[Hashable, Tuple[float, Any]]
+  __lock: threading.Lock
+
+  def __init__(self, name: str, ttl: float):
+    self.name = name
+    self.ttl = ttl
+    self.__entries = {}
+    self.__lock = threading.Lock()
+
+  def get(self, key: Hashable) -> Optional[Any]:
+    with self.__lock:
+      entry = self.__entries.get(key)
+      if entry is not None and entry[0] < time.monotonic():
+        del self.__entries[key]
+        entry = None
+    metrics.recordCacheLookup(self.name, entry is not None)
+    return None if entry is None else entry[1]
+
+  def set(self, key: Hashable, value: Any) -> None:
+    with self.__lock:
+      self.__entries[key] = (time.monotonic() + self.ttl, value)
+
+  def discard(self, key: Hashable) -> None:
+    with self.__lock:
+      self.__entries.pop(key, None)
+
+  def clear(self) -> None:
+    with self.__lock:
+      self.__entries.clear()
+
+#
+# Client
+#
+
+class Client:
+  """
+  A long-lived client for the Bitbox server. A client owns a pool of HTTP connections, the user's
+  session and parsed RSA keys, and short-lived caches of file and user information, so that many
+  operations can be performed without repeating work. Clients are safe to share between threads.
+
+  Downloaded contents are kept in a local blob cache keyed by their hash, so that contents already
+  on the machine, even under another name, are not downloaded again.
+
+  The module-level functions (`upload`, `upload_fileobj`, `upload_file`, `upload_stream`, `update`,
+  `update_fileobj`, `download`, `download_fileobj`, `download_file`, `read_range`, `share`,
+  `backup`) are shorthands for creating a client and calling the method of the same name.
+  """
+  authInfo: AuthInfo
+  connection: server.Connection
+  blobCache: BlobCache
+  throttle: Optional[TokenBucket]
+  __publicKey: Optional[RSA.RsaKey]
+  __keyLock: threading.Lock
+  __fileInfoCache: TTLCache
+  __userInfoCache: TTLCache
+
+  def __init__(self, authInfo: AuthInfo, host: Optional[str] = None, cacheTTL: float = DEFAULT_CACHE_TTL, blobCache: Optional[BlobCache] = None, throttle: Optional[TokenBucket] = None):
+    """
+    :param authInfo: Authentication information, as returned by `login`.
+    :param host: Host of the Bitbox server. If None, the host from the `BITBOX_HOST` environment
+      variable is used, sharing the default connection pool.
+    :param cacheTTL: Number of seconds that file and user information is cached for.
+    :param blobCache: Cache of downloaded contents. If None, the cache in the `BITBOX_CACHE_FOLDER`
+      environment variable is used.
+    :param throttle: Bucket that limits the rate of uploads and downloads. If None, the bucket
+      shared by the whole process is used, which only limits them if `BITBOX_LIMIT_RATE` is set.
+    """
+    self.authInfo = authInfo
+    self.connection = server.defaultConnection if host is None else server.Connection(host)
+    self.blobCache = defaultBlobCache() if blobCache is None else blobCache
+    self.throttle = defaultThrottle() if throttle is None else throttle
+    self.__publicKey = None
+    self.__keyLock = threading.Lock()
+    self.__fileInfoCache = TTLCache("file-info", cacheTTL)
+    self.__userInfoCache = TTLCache("user-info", cacheTTL)
+
+  @property
+  def username(self) -> str:
+    return self.authInfo.keyInfo.username
+
+  #
+  # Keys
+  #
+
+  def getPublicKey(self) -> RSA.RsaKey:
+    """
+    Returns the user's public key, parsing it only the first time it is needed.
+    """
+    with self.__keyLock:
+      metrics.recordCacheLookup("public-key", self.__publicKey is not None)
+      if self.__publicKey is None:
+        self.__publicKey = getPublicKey(self.authInfo.keyInfo)
+      return self.__publicKey
+
+  def getPrivateKey(self) -> RSA.RsaKey:
+    """
+    Returns the user's private key. If the key is encrypted and no password was given on login, the
+    password is prompted for once, even if several threads need the key at the same time.
+    """
+    with self.__keyLock:
+      return self.authInfo.getPrivateKey()
+
+  #
+  # Metadata
+  #
+
+  def fileInfo(self, filename: str, owner: Optional[str] = None) -> FileInfo:
+    """
+    Get information about a file, from the cache if it is fresh enough.
+
+    :param filename: Remote filename.
+    :param owner: Owner of the file, or None to search all files visible to the user.
+
+    :raises FileNotFoundException: If the file doesn't exist.
+    :raises UserNotFoundException: If the owner doesn't exist.
+    :raises BitboxException: Any other exception indicating an bug in Bitbox.
+
+    :returns: The file info.
+    """
+    fileInfo = self.__fileInfoCache.get((filename, owner))
+    if fileInfo is not None:
+      return fileInfo
+
+    fileInfo = server.fileInfo(filename, owner, self.authInfo, self.connection)
+    if isinstance(fileInfo, server.Error):
+      if fileInfo == server.Error.FILE_NOT_FOUND:
+        raise FileNotFoundException(filename)
+      elif fileInfo == server.Error.USER_NOT_FOUND:
+        raise UserNotFoundException(owner)
+      else:
+        raise BitboxException(fileInfo)
+    self.__fileInfoCache.set((filename, owner), fileInfo)
+    return fileInfo
+
+  def filesInfo(self) -> List[FileInfo]:
+    """
+    List every file visible to the user with a single request, refreshing the file info cache.
+
+    :raises AuthenticationException: If login failed with the server.
+    :raises BitboxException: Any other exception indicating an bug in Bitbox.
+
+    :returns: The file infos.
+    """
+    filesInfo = server.filesInfo(self.authInfo, self.connection)
+    for fileInfo in filesInfo:
+      self.__fileInfoCache.set((fileInfo.name, fileInfo.owner), fileInfo)
+    return filesInfo
+
+  def fileInfoById(self, fileId: str) -> FileInfo:
+    """
+    Get information about a file by its ID. This always asks the server, since it is used to check
+    whether a file has changed.
+
+    :raises FileNotFoundException: If the file doesn't exist.
+    """
+    fileInfo = server.fileInfoById(fileId, self.authInfo, self.connection)
+    if isinstance(fileInfo, server.Error):
+      if fileInfo == server.Error.FILE_NOT_FOUND:
+        raise FileNotFoundException(fileId)
+      else:
+        raise BitboxException(fileInfo)
+    self.__fileInfoCache.set((fileInfo.name, fileInfo.owner), fileInfo)
+    return fileInfo
+
+  def userPublicKey(self, username: str) -> RSA.RsaKey:
+    """
+    Get the public key of another user, from the cache if it is fresh enough.
+
+    :raises UserNotFoundException: If the user doesn't exist.
+    """
+    publicKey = self.__userInfoCache.get(username)
+    if publicKey is not None:
+      return publicKey
+
+    userInfoResponse = server.userInfo(username, self.connection)
+    if isinstance(userInfoResponse, server.Error):
+      raise UserNotFoundException(username)
+    publicKey = RSA.import_key(userInfoResponse.publicKey)
+    self.__userInfoCache.set(username, publicKey)
+    return publicKey
+
+  def invalidate(self, filename: str, owner: Optional[str] = None) -> None:
+    """
+    Forget cached information about a file.
+    """
+    self.__fileInfoCache.discard((filename, owner))
+    self.__fileInfoCache.discard((filename, None))
+
+  #
+  # Operations
+  #
+
+  def upload(self, blob: bytes, filename: str, overwrite: bool = False, filesInfo: Optional[List[FileInfo]] = None) -> None:
+    """
+    Upload a blob to the server. See `bitbox.lib.upload`.
+
+    :param filesInfo: A listing of the user's files, if the caller already has one. If it shows that
+      the file being replaced was in delta mode, its segments are deleted.
+    """
+    # Create a hash of the blob
+    blobHash = hashlib.sha256(blob).hexdigest()
+
+    # Tell the server we want to add this file before encrypting anything. The length of the
+    # encrypted blob is known in advance, and the key depends on whether the file already exists
+    prepared = self.prepareUpload(filename, fernetTokenLength(len(blob)), blobHash, overwrite)
+    if prepared is None:
+      return
+    fileId, uploadURL, fileKey, replaced = prepared
+
+    # Encrypt and upload the blob
+    self.putBlob(uploadURL, Fernet(fileKey).encrypt(blob))
+
+    # Tell the server we're done uploading. A file that was in delta mode no longer needs its chunks
+    self.store(fileId)
+    if replaced and filesInfo is not None:
+      self.deleteChunks(filename, filesInfo=filesInfo)
+
+  def upload_fileobj(self, fileobj: BinaryIO, filename: str, overwrite: bool = False, progress: Optional[ProgressCallback] = None, frameSize: int = DEFAULT_FRAME_SIZE, filesInfo: Optional[List[FileInfo]] = None) -> None:
+    """
+    Upload the contents of a readable binary stream to the server. See `bitbox.lib.upload_fileobj`.
+
+    :param filesInfo: A listing of the user's files, if the caller already has one. See `upload`.
+    """
+    # Hash the stream. Streams that can't be rewound are spooled to a temporary file
+    fileobj, blobHash, length = hashFileobj(fileobj)
+
+    # Tell the server we want to add this file before encrypting anything. The length of the
+    # encrypted blob is known in advance
+    prepared = self.prepareUpload(filename, framedLength(length, frameSize), blobHash, overwrite)
+    if prepared is None:
+      return
+    fileId, uploadURL, fileKey, replaced = prepared
+
+    # Encrypt and upload the stream one frame at a time
+    self.putBlob(uploadURL, EncryptingReader(fileobj, fileKey, length, frameSize, progress))
+
+    # Tell the server we're done uploading. A file that was in delta mode no longer needs its chunks
+    self.store(fileId)
+    if replaced and filesInfo is not None:
+      self.deleteChunks(filename, filesInfo=filesInfo)
+
+  def upload_file(self, path: str, filename: Optional[str] = None, overwrite: bool = False, progress: Optional[ProgressCallback] = None, filesInfo: Optional[List[FileInfo]] = None) -> None:
+    """
+    Upload a local file to the server. See `bitbox.lib.upload_file`.
+
+    :param filesInfo: A listing of the user's files, if the caller already has one. See `upload`.
+    """
+    with open(path, "rb") as f:
+      self.upload_fileobj(f, filename or os.path.basename(path), overwrite, progress, filesInfo=filesInfo)
+
+  def update(self, blob: bytes, filename: str, filesInfo: Optional[List[FileInfo]] = None) -> bool:
+    """
+    Replace the contents of one of the user's files. See `bitbox.lib.update`.
+
+    :param filesInfo: A listing of the user's files, if the caller already has one. See `upload`.
+    """
+    return self.update_fileobj(io.BytesIO(blob), filename, filesInfo=filesInfo)
+
+  def update_fileobj(self, fileobj: BinaryIO, filename: str, progress: Optional[ProgressCallback] = None, frameSize: int = DEFAULT_FRAME_SIZE, filesInfo: Optional[List[FileInfo]] = None) -> bool:
+    """
+    Replace the contents of one of the user's files with the contents of a readable binary stream.
+    See `bitbox.lib.update_fileobj`.
+
+    :param filesInfo: A listing of the user's files, if the caller already has one. See `upload`.
+    """
+    # Hash the stream. Streams that can't be rewound are spooled to a temporary file
+    fileobj, blobHash, length = hashFileobj(fileobj)
+
+    # Replace the contents under the file's existing key, unless it already has them
+    self.invalidate(filename, self.username)
+    prepared = self.prepareReplace(self.fileInfo(filename, self.username), framedLength(length, frameSize), blobHash)
+    if prepared is None:
+      return False
+    fileId, uploadURL, fileKey = prepared
+
+    # Encrypt and upload the stream one frame at a time
+    self.putBlob(uploadURL, EncryptingReader(fileobj, fileKey, length, frameSize, progress))
+
+    # Tell the server we're done uploading. A file that was in delta mode no longer needs its chunks
+    self.store(fileId)
+    if filesInfo is not None:
+      self.deleteChunks(filename, filesInfo=filesInfo)
+    return True
+
+  def upload_stream(self, fileobj: BinaryIO, filename: str, overwrite: bool = False, chunkSize: int = DEFAULT_STREAM_CHUNK_SIZE, filesInfo: Optional[List[FileInfo]] = None) -> None:
+    """
+    Upload a stream of unknown length to the server. See `bitbox.lib.upload_stream`.
+
+    :param filesInfo: A listing of the user's files, if the caller already has one. See `upload`.
+    """
+    # Make sure the name is free before uploading anything. An existing file is replaced in place,
+    # so its chunks are encrypted with its key and shared with everyone it is shared with
+    self.invalidate(filename, self.username)
+    try:
+      fileInfo = self.fileInfo(filename, self.username)
+    except FileNotFoundException:
+      fileInfo = None
+    if fileInfo is not None and not overwrite:
+      raise FileExistsException(filename)
+    if fileInfo is None:
+      fileKey = Fernet.generate_key()
+      publicKeys = {}
+    else:
+      fileKey = rsaDecrypt(binascii.unhexlify(fileInfo.encryptedKey), self.getPrivateKey())
+      publicKeys = { recipient: self.userPublicKey(recipient) for recipient in fileInfo.sharedWith if recipient != fileInfo.owner }
+
+    # Gather the chunks into segments as they are read, and upload each segment once it is full,
+    # keeping only a few in memory
+    hasher = hashlib.sha256()
+    segments: List[DeltaSegment] = []
+    chunks: List[DeltaChunk] = []
+    stored: Dict[str, DeltaChunk] = {}
+    batch: List[bytes] = []
+    batchSize = 0
+    with ThreadPoolExecutor(max_workers=DEFAULT_SEGMENT_JOBS) as executor:
+      futures = []
+      while True:
+        contents = fileobj.read(chunkSize)
+        if len(batch) > 0 and (not contents or batchSize + fernetTokenLength(len(contents)) > DELTA_SEGMENT_SIZE):
+          futures.append(executor.submit(self.storeSegment, filename, fileKey, batch, publicKeys))
+          batch, batchSize = [], 0
+
+          # Wait for the oldest uploads before reading more
+          while len(futures) >= DEFAULT_SEGMENT_JOBS:
+            segments.append(futures.pop(0).result())
+        if not contents:
+          break
+
+        # Chunks that appear more than once are only stored once
+        hasher.update(contents)
+        chunkHash = hashlib.sha256(contents).hexdigest()
+        if chunkHash not in stored:
+          stored[chunkHash] = DeltaChunk(hash=chunkHash, length=len(contents), segment=len(segments) + len(futures), offset=batchSize)
+          batch.append(contents)
+          batchSize += fernetTokenLength(len(contents))
+        chunks.append(stored[chunkHash])
+      for future in futures:
+        segments.append(future.result())
+
+    # Upload the manifest, now that the hash of the whole stream is known
+    manifest = DeltaManifest(owner=self.username, hash=hasher.hexdigest(), size=sum(chunk.length for chunk in chunks), segments=segments, chunks=chunks)
+    encryptedManifest = Fernet(fileKey).encrypt(buildManifest(manifest))
+    if fileInfo is None:
+      prepareStoreResponse = self.prepareStore(filename, len(encryptedManifest), manifest.hash, fileKey)
+      fileId, uploadURL = prepareStoreResponse.fileId, prepareStoreResponse.uploadURL
+    else:
+      self.invalidate(filename, self.username)
+      fileId, uploadURL = fileInfo.fileId, self.prepareUpdate(fileInfo.fileId, len(encryptedManifest), manifest.hash).uploadURL
+    self.putBlob(uploadURL, encryptedManifest)
+    self.store(fileId)
+
+    # Delete the segments of whatever the file held before, which the caller's listing has
+    if fileInfo is not None and filesInfo is not None:
+      self.deleteChunks(filename, set(segment.name for segment in segments), filesInfo)
+
+  def download(self, filename: str, owner: str) -> bytes:
+    """
+    Download a blob from the server. See `bitbox.lib.download`.
+    """
+    # Get a download link for the encrypted blob, along with the current hash of its contents
+    saveResponse = self.save(filename, owner)
+
+    # Use the cached contents if we already have them
+    blob = self.blobCache.get(saveResponse.hash)
+    if blob is not None:
+      return blob
+
+    # Download and decrypt the file
+    blob, _ = self.fetch(saveResponse)
+    return blob
+
+  def download_fileobj(self, filename: str, owner: str, fileobj: BinaryIO, progress: Optional[ProgressCallback] = None) -> None:
+    """
+    Download a blob from the server into a writable binary stream. See `bitbox.lib.download_fileobj`.
+    """
+    self.downloadInto(filename, owner, fileobj, progress)
+
+  def downloadInto(self, filename: str, owner: str, fileobj: BinaryIO, progress: Optional[ProgressCallback] = None) -> str:
+    """
+    Download a blob from the server into a writable binary stream.
+
+    :returns: The hash of the blob.
+    """
+    # Get a download link for the encrypted blob, along with the current hash of its contents
+    saveResponse = self.save(filename, owner)
+
+    # Use the cached contents if we already have them, and otherwise decrypt the blob into the
+    # stream as it arrives
+    if not self.blobCache.getInto(saveResponse.hash, fileobj):
+      self.fetchInto(saveResponse, fileobj, progress)
+    return saveResponse.hash
+
+  def download_file(self, filename: str, owner: str, path: str, progress: Optional[ProgressCallback] = None) -> None:
+    """
+    Download a blob from the server into a local file. See `bitbox.lib.download_file`.
+    """
+    # Download next to the destination, and only move the file into place once it has been verified
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=".bitbox-", delete=False) as f:
+      tempPath = f.name
+      try:
+        blobHash = self.downloadInto(filename, owner, f, progress)
+      except BaseException:
+        f.close()
+        os.unlink(tempPath)
+        raise
+
+    # Keep a copy of the verified contents in the cache
+    self.blobCache.putFile(blobHash, tempPath)
+    os.replace(tempPath, path)
+
+  def read_range(self, filename: str, owner: str, offset: int, length: int) -> bytes:
+    """
+    Read part of a file from the server. See `bitbox.lib.read_range`.
+    """
+    if length < 0:
+      raise ValueError("The length of a range can't be negative.")
+
+    # Get a download link for the encrypted blob, along with the current hash of its contents
+    saveResponse = self.save(filename, owner)
+
+    # Use the cached contents if we already have them
+    blob = self.blobCache.get(saveResponse.hash)
+    if blob is not None:
+      start = rangeStart(offset, len(blob))
+      return blob[start:start + length]
+    return self.fetchRange(saveResponse, offset, length)
+
+  def size(self, filename: str, owner: str) -> int:
+    """
+    Get the size of the decrypted contents of a file. The file info only has the size of the
+    encrypted blob, so this reads as little of the blob as its layout allows. See `fetchSize`.
+
+    :raises FileNotFoundException: If the file doesn't exist.
+    :raises UserNotFoundException: If the owner doesn't exist.
+    :raises FileNotReadyException: If the file is not ready to be downloaded.
+    :raises DownloadException: If the download failed or the file has been tampered with.
+    """
+    # Get a download link for the encrypted blob, along with the current hash of its contents
+    saveResponse = self.save(filename, owner)
+
+    # Use the cached contents if we already have them
+    blob = self.blobCache.get(saveResponse.hash)
+    if blob is not None:
+      return len(blob)
+    return self.fetchSize(saveResponse)
+
+  def share(self, filename: str, recipients: List[str], filesInfo: Optional[List[FileInfo]] = None) -> None:
+    """
+    Share a file with other users. See `bitbox.lib.share`.
+
+    :param filesInfo: A listing of the user's files, if the caller already has one.
+    """
+    # Get the file info from a listing, which also has the chunks of the file if it is in delta mode
+    filesInfo = self.filesInfo() if filesInfo is None else filesInfo
+    fileInfo = next((fileInfo for fileInfo in filesInfo if fileInfo.owner == self.username and fileInfo.name == filename), None)
+    if fileInfo is None:
+      raise FileNotFoundException(filename)
+
+    # Get the public keys of the recipients
+    publicKeys = { recipient: self.userPublicKey(recipient) for recipient in recipients }
+
+    # Decrypt the file key
+    fileKey = rsaDecrypt(binascii.unhexlify(fileInfo.encryptedKey), self.getPrivateKey())
+
+    # Share the file with the recipients, along with its chunks if it is in delta mode
+    try:
+      self.shareKey(fileInfo.fileId, fileKey, publicKeys)
+    except FileNotFoundException:
+      raise FileNotFoundException(fileInfo.name)
+    finally:
+      self.invalidate(filename, self.username)
+    self.shareChunks(filename, fileKey, publicKeys, filesInfo)
+
+  def backup(self, otc: str) -> None:
+    """
+    Backup your private key to the server. See `bitbox.lib.backup`.
+    """
+    encryptedPrivateKey = cryptocode.encrypt(self.authInfo.keyInfo.privateKey, otc)
+
+    try:
+      server.pushEncryptedKey(encryptedPrivateKey, self.authInfo, self.connection)
+    except Exception as e:
+      raise BitboxException(e)
+
+  #
+  # Delta mode
+  #
+
+  def storeDelta(self, blob: bytes, filename: str, filesInfo: Optional[List[FileInfo]] = None) -> Tuple[str, str]:
+    """
+    Upload a blob as a new file in delta mode. The blob is split into content-defined chunks that
+    are uploaded in a few segments, and the file itself holds a manifest of the chunks, so that later
+    updates only need to upload the chunks that changed.
+
+    :param filesInfo: A listing of the user's files to check the upload against with `precheck`, if
+      the caller already has one.
+
+    :raises FileExistsException: If a file with the same name already exists.
+    :raises FileTooLargeException: If the file is too large to upload.
+    :raises UploadException: If the upload failed.
+
+    :returns: A tuple of the new file ID and the hash of the blob.
+    """
+    # Make sure the name is free before uploading any chunks, and that they fit if the caller has a
+    # listing to check against
+    if filesInfo is not None:
+      self.precheck(filename, fernetTokenLength(len(blob)), hashlib.sha256(blob).hexdigest(), filesInfo)
+    else:
+      try:
+        self.fileInfo(filename, self.username)
+        raise FileExistsException(filename)
+      except FileNotFoundException:
+        pass
+
+    # Upload the chunks, encrypted with a random key
+    fileKey = Fernet.generate_key()
+    manifest, _ = self.uploadChunks(filename, fileKey, blob)
+
+    # Upload the manifest
+    encryptedManifest = Fernet(fileKey).encrypt(buildManifest(manifest))
+    prepareStoreResponse = self.prepareStore(filename, len(encryptedManifest), manifest.hash, fileKey)
+    self.putBlob(prepareStoreResponse.uploadURL, encryptedManifest)
+    self.store(prepareStoreResponse.fileId)
+    return prepareStoreResponse.fileId, manifest.hash
+
+  def updateDelta(self, fileInfo: FileInfo, fileKey: bytes, blob: bytes, previous: Optional[DeltaManifest]) -> None:
+    """
+    Replace the contents of a file, storing them in delta mode. Only the chunks that the previous
+    version of the file did not have are uploaded, and segments that are no longer used are deleted.
+    A file that is not in delta mode yet is converted to it.
+
+    :param previous: Manifest of the previous version of the file, or None if it was not in delta
+      mode.
+
+    :raises FileNotFoundException: If the file doesn't exist.
+    :raises FileTooLargeException: If the file is too large to upload.
+    :raises FileNotReadyException: If the file is being modified elsewhere.
+    :raises UploadException: If the upload failed.
+    """
+    # Upload the new chunks, and share them with everyone the file is shared with
+    recipients = [recipient for recipient in fileInfo.sharedWith if recipient != fileInfo.owner]
+    manifest, dropped = self.uploadChunks(fileInfo.name, fileKey, blob, previous, recipients)
+
+    # Upload the new manifest
+    encryptedManifest = Fernet(fileKey).encrypt(buildManifest(manifest))
+    prepareUpdateResponse = self.prepareUpdate(fileInfo.fileId, len(encryptedManifest), manifest.hash)
+    self.putBlob(prepareUpdateResponse.uploadURL, encryptedManifest)
+    self.store(fileInfo.fileId)
+
+    # Delete the segments that only older versions used
+    self.deleteSegments(dropped)
+
+  def uploadChunks(self, filename: str, fileKey: bytes, blob: bytes, previous: Optional[DeltaManifest] = None, recipients: List[str] = []) -> Tuple[DeltaManifest, List[DeltaSegment]]:
+    """
+    Split a blob into content-defined chunks, and upload the chunks that the previous version of the
+    file doesn't have, gathered into new segments that are uploaded a few at a time.
+
+    :param previous: Manifest of the previous version of the file, if it was in delta mode.
+    :param recipients: Users to share the new segments with.
+
+    :returns: A tuple of the manifest of the blob, and the segments of the previous version that it
+      no longer uses.
+    """
+    # Split the blob into chunks
+    spans = chunkBoundaries(blob)
+    hashes = [hashlib.sha256(blob[offset:offset + length]).hexdigest() for offset, length in spans]
+
+    # Keep the segments of the previous version that are still mostly in use, and the chunks in them
+    segments: List[DeltaSegment] = []
+    dropped: List[DeltaSegment] = []
+    stored: Dict[str, DeltaChunk] = {}
+    if previous is not None:
+      kept = sorted(keptSegments(previous, set(hashes)))
+      renumbered = { old: new for new, old in enumerate(kept) }
+      segments = [previous.segments[i] for i in kept]
+      dropped = [segment for i, segment in enumerate(previous.segments) if i not in renumbered]
+      for chunk in previous.chunks:
+        if chunk.segment in renumbered:
+          stored[chunk.hash] = DeltaChunk(hash=chunk.hash, length=chunk.length, segment=renumbered[chunk.segment], offset=chunk.offset)
+
+    # Gather the other chunks into new segments
+    batches: List[List[Tuple[int, int]]] = []
+    batchSize = DELTA_SEGMENT_SIZE
+    for (offset, length), chunkHash in zip(spans, hashes):
+      if chunkHash in stored:
+        continue
+      if batchSize + fernetTokenLength(length) > DELTA_SEGMENT_SIZE:
+        batches.append([])
+        batchSize = 0
+      stored[chunkHash] = DeltaChunk(hash=chunkHash, length=length, segment=len(segments) + len(batches) - 1, offset=batchSize)
+      batches[-1].append((offset, length))
+      batchSize += fernetTokenLength(length)
+    publicKeys = { recipient: self.userPublicKey(recipient) for recipient in recipients }
+
+    # Upload the new segments
+    def storeBatch(batch: List[Tuple[int, int]]) -> DeltaSegment:
+      return self.storeSegment(filename, fileKey, [blob[offset:offset + length] for offset, length in batch], publicKeys)
+    with ThreadPoolExecutor(max_workers=DEFAULT_SEGMENT_JOBS) as executor:
+      segments += executor.map(storeBatch, batches)
+    manifest = DeltaManifest(owner=self.username, hash=hashlib.sha256(blob).hexdigest(), size=len(blob), segments=segments, chunks=[stored[chunkHash] for chunkHash in hashes])
+    return manifest, dropped
+
+  def storeSegment(self, filename: str, fileKey: bytes, chunks: List[bytes], publicKeys: Dict[str, RSA.RsaKey] = {}) -> DeltaSegment:
+    """
+    Upload chunks of a file in delta mode as a new segment, and share it with the given users.
+    """
+    # Segments are always new files, encrypted with the key of their file one chunk at a time
+    encryptedSegment = b"".join(Fernet(fileKey).encrypt(chunk) for chunk in chunks)
+    name = segmentName(filename)
+    prepareStoreResponse = self.prepareStore(name, len(encryptedSegment), hashlib.sha256(encryptedSegment).hexdigest(), fileKey)
+    self.putBlob(prepareStoreResponse.uploadURL, encryptedSegment)
+    self.store(prepareStoreResponse.fileId)
+    if len(publicKeys) > 0:
+      self.shareKey(prepareStoreResponse.fileId, fileKey, publicKeys)
+    return DeltaSegment(name=name, fileId=prepareStoreResponse.fileId, size=len(encryptedSegment))
+
+  def fetchManifest(self, fileId: str) -> Tuple[Optional[DeltaManifest], bytes]:
+    """
+    Download the manifest of a file in delta mode, without downloading its chunks.
+
+    :raises FileNotFoundException: If the file doesn't exist.
+    :raises FileNotReadyException: If the file is being modified elsewhere.
+    :raises DownloadException: If the download failed.
+
+    :returns: A tuple of the manifest, or None if the file is not in delta mode, and the file key.
+    """
+    saveResponse = self.saveById(fileId)
+    fileKey = rsaDecrypt(binascii.unhexlify(saveResponse.encryptedKey), self.getPrivateKey())
+    try:
+      blob = decryptContents(self.getBlob(saveResponse.downloadURL), fileKey)
+      return (readManifest(blob) if isDelta(blob) else None), fileKey
+    except (FrameException, InvalidToken, DeltaException):
+      raise DownloadException()
+
+  def assembleDelta(self, manifestBlob: bytes, fileKey: bytes, local: bytes = b"", operation: str = "download") -> bytes:
+    """
+    Put together the contents of a file in delta mode from its chunks. See `assembleDeltaInto`.
+    """
+    fileobj = io.BytesIO()
+    self.assembleDeltaInto(manifestBlob, fileKey, fileobj, local, operation)
+    return fileobj.getvalue()
+
+  def assembleDeltaInto(self, manifestBlob: bytes, fileKey: bytes, fileobj: BinaryIO, local: bytes = b"", operation: str = "download") -> str:
+    """
+    Put together the contents of a file in delta mode from its chunks, writing them into a writable
+    binary stream. Chunks that a local copy of the file already has are taken from it, and the rest
+    are downloaded with `fetchChunks`, a window of the file at a time.
+
+    :param manifestBlob: The decrypted manifest.
+    :param local: An older version of the file, whose chunks can be reused.
+    :param operation: Name of the operation, used to label hash mismatches in the metrics.
+
+    :raises DownloadException: If the manifest is not valid, a chunk could not be downloaded, or a
+      chunk does not match its hash.
+
+    :returns: The hash of the contents.
+    """
+    try:
+      manifest = readManifest(manifestBlob)
+    except DeltaException:
+      raise DownloadException()
+    localChunks = chunkHashes(local) if len(local) > 0 else {}
+
+    # Write the chunks in order, downloading the ones the local copy doesn't have a window at a time
+    hasher = hashlib.sha256()
+    window: List[DeltaChunk] = []
+    windowSize = 0
+    for i, chunk in enumerate(manifest.chunks):
+      window.append(chunk)
+      windowSize += chunk.length
+      if windowSize < DEFAULT_ASSEMBLY_WINDOW and i < len(manifest.chunks) - 1:
+        continue
+      fetched = self.fetchChunks(manifest, [chunk for chunk in window if chunk.hash not in localChunks], fileKey, operation)
+      for chunk in window:
+        span = localChunks.get(chunk.hash)
+        contents = fetched[(chunk.segment, chunk.offset)] if span is None else local[span[0]:span[0] + span[1]]
+        hasher.update(contents)
+        fileobj.write(contents)
+      window, windowSize = [], 0
+    return hasher.hexdigest()
+
+  def fetchChunks(self, manifest: DeltaManifest, chunks: List[DeltaChunk], fileKey: bytes, operation: str = "download") -> Dict[Tuple[int, int], bytes]:
+    """
+    Download and decrypt chunks of a file in delta mode, checking each against its hash. Chunks
+    that lie next to each other in a segment are downloaded with one range request, and several
+    ranges are downloaded at a time.
+
+    :raises DownloadException: If a chunk could not be downloaded or does not match its hash.
+
+    :returns: A dictionary from the segment and offset of each chunk to its contents.
+    """
+    runs = chunkRuns(chunks)
+    used = sorted(set(run[0].segment for run in runs))
+
+    def getLink(segment: int) -> str:
+      try:
+        return self.saveById(manifest.segments[segment].fileId).downloadURL
+      except (FileNotFoundException, FileNotReadyException):
+        raise DownloadException()
+
+    def fetchRun(run: List[DeltaChunk]) -> Dict[Tuple[int, int], bytes]:
+      # Download the encrypted chunks of the run
+      start = run[0].offset
+      end = run[-1].offset + chunkTokenLength(run[-1])
+      received, receivedStart, _ = self.getBlobRange(links[run[0].segment], start, end - 1)
+      encryptedRun = received[start - receivedStart:end - receivedStart]
+      if start < receivedStart or len(encryptedRun) != end - start:
+        raise DownloadException()
+
+      # Decrypt each chunk and check it against its hash
+      try:
+        chunksContents = decryptRun(encryptedRun, run, fileKey)
+      except InvalidToken:
+        raise DownloadException()
+      fetched = {}
+      for chunk, contents in zip(run, chunksContents):
+        if hashlib.sha256(contents).hexdigest() != chunk.hash:
+          metrics.hashMismatches.inc(operation=operation)
+          raise DownloadException()
+        fetched[(chunk.segment, chunk.offset)] = contents
+      return fetched
+
+    # Get a download link for each segment involved, then download the runs
+    fetched: Dict[Tuple[int, int], bytes] = {}
+    with ThreadPoolExecutor(max_workers=DEFAULT_DELTA_JOBS) as executor:
+      links = dict(zip(used, executor.map(getLink, used)))
+      for contents in executor.map(fetchRun, runs):
+        fetched.update(contents)
+    return fetched
+
+  def shareChunks(self, filename: str, fileKey: bytes, publicKeys: Dict[str, RSA.RsaKey], filesInfo: Optional[List[FileInfo]] = None) -> None:
+    """
+    Share the segments of one of the user's files in delta mode, and its marker if it is a pack.
+    Files that are neither have nothing else to share.
+
+    :param filesInfo: A listing of the user's files to look in, if the caller already has one.
+    """
+    prefix = chunkPrefix(filename)
+    marker = packMarkerName(filename)
+    for fileInfo in self.filesInfo() if filesInfo is None else filesInfo:
+      if fileInfo.owner == self.username and (fileInfo.name.startswith(prefix) or fileInfo.name == marker):
+        self.shareKey(fileInfo.fileId, fileKey, publicKeys)
+
+  def hasChunks(self, fileInfo: FileInfo, filesInfo: Optional[List[FileInfo]] = None) -> bool:
+    """
+    Check whether a file is in delta mode by looking for its chunks, which are shared with everyone
+    the file is shared with. Unlike fetching the file, this works without downloading anything.
+
+    :param filesInfo: A listing of the user's files to look in, if the caller already has one.
+    """
+    prefix = chunkPrefix(fileInfo.name)
+    filesInfo = self.filesInfo() if filesInfo is None else filesInfo
+    return any(chunkInfo.owner == fileInfo.owner and chunkInfo.name.startswith(prefix) for chunkInfo in filesInfo)
+
+  def deleteChunks(self, filename: str, keep: Set[str] = set(), filesInfo: Optional[List[FileInfo]] = None) -> None:
+    """
+    Delete the segments of one of the user's files in delta mode, other than those in keep.
+
+    :param filesInfo: A listing of the user's files to look in, if the caller already has one.
+    """
+    prefix = chunkPrefix(filename)
+    for fileInfo in self.filesInfo() if filesInfo is None else filesInfo:
+      if fileInfo.owner == self.username and fileInfo.name.startswith(prefix) and fileInfo.name not in keep:
+        server.delete(fileInfo.fileId, self.authInfo, self.connection)
+        self.invalidate(fileInfo.name, self.username)
+
+  def deleteSegments(self, segments: List[DeltaSegment]) -> None:
+    """
+    Delete segments of one of the user's files in delta mode, by the IDs its manifest has for them.
+    """
+    for segment in segments:
+      server.delete(segment.fileId, self.authInfo, self.connection)
+      self.invalidate(segment.name, self.username)
+
+  #
+  # Packs
+  #
+
+  def markPack(self, filename: str) -> None:
+    """
+    Mark one of the user's files as a pack. See `bitbox.lib.pack.packMarkerName`.
+
+    :raises FileNotFoundException: If the file doesn't exist.
+    """
+    # The marker is encrypted with the key of the pack, so it can be shared along with it
+    fileInfo = self.fileInfo(filename, self.username)
+    fileKey = rsaDecrypt(binascii.unhexlify(fileInfo.encryptedKey), self.getPrivateKey())
+    prepared = self.prepareUpload(packMarkerName(filename), fernetTokenLength(0), hashlib.sha256(b"").hexdigest(), overwrite=True, fileKey=fileKey)
+    if prepared is not None:
+      fileId, uploadURL, _, _ = prepared
+      self.putBlob(uploadURL, Fernet(fileKey).encrypt(b""))
+      self.store(fileId)
+
+  def unmarkPack(self, filename: str, filesInfo: Optional[List[FileInfo]] = None) -> None:
+    """
+    Delete the marker of one of the user's files, if it is a pack.
+
+    :param filesInfo: A listing of the user's files to look in, if the caller already has one.
+    """
+    marker = packMarkerName(filename)
+    if filesInfo is not None:
+      fileInfo = next((fileInfo for fileInfo in filesInfo if fileInfo.owner == self.username and fileInfo.name == marker), None)
+      if fileInfo is None:
+        return
+    else:
+      try:
+        fileInfo = self.fileInfo(marker, self.username)
+      except FileNotFoundException:
+        return
+    server.delete(fileInfo.fileId, self.authInfo, self.connection)
+    self.invalidate(fileInfo.name, self.username)
+
+  def hasPackMarker(self, fileInfo: FileInfo, filesInfo: Optional[List[FileInfo]] = None) -> bool:
+    """
+    Check whether a file is a pack by looking for its marker.
+
+    :param filesInfo: A listing of the user's files to look in, if the caller already has one.
+      Otherwise, the marker is looked up on its own.
+    """
+    marker = packMarkerName(fileInfo.name)
+    if filesInfo is None:
+      try:
+        return self.fileInfo(marker, fileInfo.owner).owner == fileInfo.owner
+      except FileNotFoundException:
+        return False
+    return any(markerInfo.owner == fileInfo.owner and markerInfo.name == marker for markerInfo in filesInfo)
+
+  #
+  # Steps
+  #
+
+  def shareKey(self, fileId: str, fileKey: bytes, publicKeys: Dict[str, RSA.RsaKey]) -> None:
+    """
+    Share a file with other users, by wrapping its key with each of their public keys.
+
+    :raises FileNotFoundException: If the file doesn't exist.
+    """
+    # Re-encrypt the file key for each recipient
+    recipientEncryptedKeys = {}
+    for recipient, publicKey in publicKeys.items():
+      recipientEncryptedFileKey = rsaEncrypt(fileKey, publicKey)
+      recipientEncryptedFileKeyHex = binascii.hexlify(recipientEncryptedFileKey).decode("utf-8")
+      recipientEncryptedKeys[recipient] = recipientEncryptedFileKeyHex
+
+    # Share the file with the recipients
+    shareResponse = server.share(fileId, recipientEncryptedKeys, self.authInfo, self.connection)
+    if isinstance(shareResponse, server.Error):
+      if shareResponse == server.Error.FILE_NOT_FOUND:
+        raise FileNotFoundException(fileId)
+      else:
+        raise BitboxException(shareResponse)
+
+  def precheck(self, filename: str, bytes: int, blobHash: str, filesInfo: List[FileInfo], overwrite: bool = False) -> Optional[FileInfo]:
+    """
+    Check whether an upload can succeed from a listing of the user's files that the caller already
+    has, so that batches of uploads the server would reject are rejected before anything is
+    encrypted. Single uploads don't need this, since the server rejects them before anything is
+    encrypted anyway. An upload that replaces a file with the same contents always succeeds, since
+    nothing needs to be sent.
+
+    :param bytes: Length of the encrypted blob.
+    :param filesInfo: A listing of the user's files.
+
+    :raises FileExistsException: If overwrite = False and a file with the same name already exists.
+    :raises FileTooLargeException: If the blob would not fit in the user's remaining storage.
+
+    :returns: The file info of the existing file with the same name, if there is one.
+    """
+    owned = [fileInfo for fileInfo in filesInfo if fileInfo.owner == self.username]
+    existing = next((fileInfo for fileInfo in owned if fileInfo.name == filename), None)
+    if existing is not None and not overwrite:
+      raise FileExistsException(filename)
+    if existing is not None and existing.hash == blobHash:
+      return existing
+
+    # The new contents take the place of the existing ones
+    used = sum(fileInfo.bytes for fileInfo in owned if fileInfo is not existing)
+    if used + bytes > BITBOX_STORAGE_LIMIT:
+      raise FileTooLargeException()
+    return existing
+
+  def prepareStore(self, filename: str, bytes: int, blobHash: str, fileKey: bytes) -> server.PrepareStoreResponse:
+    """
+    Tell the server we want to add a file, wrapping the file key with the user's public key.
+
+    :raises FileTooLargeException: If the file is too large to upload.
+    :raises FileExistsException: If a file with the same name already exists.
+
+    :returns: The file ID and the URL to upload the encrypted blob to.
+    """
+    # Encrypt the file key with the user's public key
+    personalEncryptedKey = rsaEncrypt(fileKey, self.getPublicKey())
+    personalEncryptedKeyHex = binascii.hexlify(personalEncryptedKey).decode("utf-8")
+
+    # Whatever happens, cached information about this file is about to be stale
+    self.invalidate(filename, self.username)
+
+    prepareStoreResponse = server.prepareStore(filename, bytes, blobHash, personalEncryptedKeyHex, self.authInfo, self.connection)
+    if isinstance(prepareStoreResponse, server.Error):
+      if prepareStoreResponse == server.Error.FILE_EXISTS:
+        raise FileExistsException(filename)
+      elif prepareStoreResponse == server.Error.FILE_TOO_LARGE:
+        raise FileTooLargeException()
+      else:
+        raise BitboxException(prepareStoreResponse)
+    return prepareStoreResponse
+
+  def prepareUpload(self, filename: str, bytes: int, blobHash: str, overwrite: bool = False, fileKey: Optional[bytes] = None) -> Optional[Tuple[str, str, bytes, bool]]:
+    """
+    Tell the server we want to upload a file, before anything is encrypted. If overwrite = True and
+    the file already exists, its contents are replaced in place with `prepareReplace`, so it keeps
+    its ID, its key and everyone it is shared with.
+
+    :param fileKey: Key to encrypt the file with if it is new. Defaults to a random key.
+
+    :raises FileTooLargeException: If the file is too large to upload.
+    :raises FileExistsException: If overwrite = False and a file with the same name already exists.
+    :raises FileNotReadyException: If the existing file is being modified elsewhere.
+
+    :returns: A tuple of the file ID, the URL to upload the encrypted blob to, the key to encrypt it
+      with and whether an existing file is being replaced, or None if the existing file already has
+      these contents.
+    """
+    # Try to add the file first, which is a single request when it is new
+    fileKey = fileKey or Fernet.generate_key()
+    try:
+      prepareStoreResponse = self.prepareStore(filename, bytes, blobHash, fileKey)
+      return prepareStoreResponse.fileId, prepareStoreResponse.uploadURL, fileKey, False
+    except FileExistsException:
+      if not overwrite:
+        raise
+
+    # Otherwise, replace the contents of the existing file
+    prepared = self.prepareReplace(self.fileInfo(filename, self.username), bytes, blobHash)
+    return None if prepared is None else (*prepared, True)
+
+  def prepareReplace(self, fileInfo: FileInfo, bytes: int, blobHash: str) -> Optional[Tuple[str, str, bytes]]:
+    """
+    Tell the server we want to replace the contents of one of the user's files, keeping its key.
+
+    :raises FileNotFoundException: If the file doesn't exist.
+    :raises FileTooLargeException: If the file is too large to upload.
+    :raises FileNotReadyException: If the file is being modified elsewhere.
+
+    :returns: A tuple of the file ID, the URL to upload the encrypted blob to and the key to encrypt
+      it with, or None if the file already has these contents.
+    """
+    # Nothing needs to be uploaded if the file already has these contents
+    if fileInfo.hash == blobHash:
+      return None
+
+    # Decrypt the existing file key, so everyone the file is shared with can still read it
+    fileKey = rsaDecrypt(binascii.unhexlify(fileInfo.encryptedKey), self.getPrivateKey())
+    self.invalidate(fileInfo.name, self.username)
+    prepareUpdateResponse = self.prepareUpdate(fileInfo.fileId, bytes, blobHash)
+    return fileInfo.fileId, prepareUpdateResponse.uploadURL, fileKey
+
+  def prepareUpdate(self, fileId: str, bytes: int, blobHash: str) -> server.PrepareUpdateResponse:
+    """
+    Tell the server we want to replace the contents of a file. The file keeps its key, so the new
+    contents must be encrypted with the same key as the old ones.
+
+    :raises FileNotFoundException: If the file doesn't exist.
+    :raises FileTooLargeException: If the file is too large to upload.
+    :raises FileNotReadyException: If the file is being modified elsewhere.
+
+    :returns: The URL to upload the encrypted blob to.
+    """
+    prepareUpdateResponse = server.prepareUpdate(fileId, bytes, blobHash, self.authInfo, self.connection)
+    if isinstance(prepareUpdateResponse, server.Error):
+      if prepareUpdateResponse == server.Error.FILE_NOT_FOUND:
+        raise FileNotFoundException(fileId)
+      elif prepareUpdateResponse == server.Error.FILE_TOO_LARGE:
+        raise FileTooLargeException()
+      elif prepareUpdateResponse == server.Error.FILE_NOT_READY:
+        raise FileNotReadyException(fileId)
+      else:
+        raise BitboxException(prepareUpdateResponse)
+    return prepareUpdateResponse
+
+  def store(self, fileId: str) -> None:
+    """
+    Tell the server we're done uploading a file.
+    """
+    storeResponse = server.store(fileId, self.authInfo, self.connection)
+    if isinstance(storeResponse, server.Error):
+      raise BitboxException(storeResponse)
+
+  def save(self, filename: str, owner: Optional[str]) -> server.SaveResponse:
+    """
+    Get a download link and the encrypted file key for a file. If the cached file info is out of
+    date, the file may have been recreated under a new ID, so it is looked up again.
+
+    :raises FileNotFoundException: If the file doesn't exist.
+    :raises UserNotFoundException: If the owner doesn't exist.
+    :raises FileNotReadyException: If the file is not ready to be downloaded.
+    """
+    fileInfo = self.fileInfo(filename, owner)
+    saveResponse = server.save(fileInfo.fileId, self.authInfo, self.connection)
+    if saveResponse == server.Error.FILE_NOT_FOUND:
+      self.invalidate(filename, owner)
+      fileInfo = self.fileInfo(filename, owner)
+      saveResponse = server.save(fileInfo.fileId, self.authInfo, self.connection)
+    if isinstance(saveResponse, server.Error):
+      if saveResponse == server.Error.FILE_NOT_FOUND:
+        raise FileNotFoundException(fileInfo.name)
+      elif saveResponse == server.Error.FILE_NOT_READY:
+        raise FileNotReadyException(fileInfo.name)
+      else:
+        raise BitboxException(saveResponse)
+    return saveResponse
+
+  def saveById(self, fileId: str) -> server.SaveResponse:
+    """
+    Get a download link and the encrypted file key for a file, by its ID.
+
+    :raises FileNotFoundException: If the file doesn't exist.
+    :raises FileNotReadyException: If the file is not ready to be downloaded.
+    """
+    saveResponse = server.save(fileId, self.authInfo, self.connection)
+    if isinstance(saveResponse, server.Error):
+      if saveResponse == server.Error.FILE_NOT_FOUND:
+        raise FileNotFoundException(fileId)
+      elif saveResponse == server.Error.FILE_NOT_READY:
+        raise FileNotReadyException(fileId)
+      else:
+        raise BitboxException(saveResponse)
+    return saveResponse
+
+  def fetch(self, saveResponse: server.SaveResponse, operation: str = "download", local: bytes = b"") -> Tuple[bytes, bytes]:
+    """
+    Download and decrypt the blob behind a download link returned by `save`, checking it against
+    the hash on the server. See `fetchFile`.
+
+    :returns: A tuple of the decrypted blob and the file key.
+    """
+    blob, fileKey, _ = self.fetchFile(saveResponse, operation=operation, local=local)
+    return blob, fileKey
+
+  def fetchFile(self, saveResponse: server.SaveResponse, operation: str = "download", local: bytes = b"") -> Tuple[bytes, bytes, bool]:
+    """
+    Download and decrypt the blob behind a download link returned by `save`, checking it against
+    the hash on the server, and find out whether the file is in delta mode on the way.
+
+    :param operation: Name of the operation, used to label hash mismatches in the metrics.
+    :param local: Contents of a local copy of the file. If the file is in delta mode, the chunks
+      that the local copy already has are not downloaded.
+
+    :raises DownloadException: If the download failed or the blob does not match its hash.
+
+    :returns: A tuple of the decrypted blob, the file key, and whether the file is in delta mode.
+    """
+    # Download the file
+    encryptedBlob = self.getBlob(saveResponse.downloadURL)
+
+    # Decrypt the file
+    fileKey = rsaDecrypt(binascii.unhexlify(saveResponse.encryptedKey), self.getPrivateKey())
+    try:
+      blob = decryptContents(encryptedBlob, fileKey)
+    except (FrameException, InvalidToken):
+      raise DownloadException()
+
+    # Files in delta mode hold a manifest, and their contents are put together from their chunks
+    delta = isDelta(blob)
+    if delta:
+      blob = self.assembleDelta(blob, fileKey, local, operation=operation)
+
+    # As a security measure, check if the hash of the decrypted blob matches the hash of the blob on the server
+    if hashlib.sha256(blob).hexdigest() != saveResponse.hash:
+      metrics.hashMismatches.inc(operation=operation)
+      raise DownloadException()
+
+    # Keep a copy of the verified contents in the cache
+    self.blobCache.put(saveResponse.hash, blob)
+    return blob, fileKey, delta
+
+  def fetchInto(self, saveResponse: server.SaveResponse, fileobj: BinaryIO, progress: Optional[ProgressCallback] = None, operation: str = "download") -> None:
+    """
+    Download the blob behind a download link returned by `save`, decrypting it into a writable
+    binary stream as it arrives, and check it against the hash on the server. If the check fails,
+    the stream will already have been written to, so callers should write to a temporary file.
+
+    :param operation: Name of the operation, used to label hash mismatches in the metrics.
+
+    :raises DownloadException: If the download failed or the blob does not match its hash.
+    """
+    # Decrypt the file key
+    fileKey = rsaDecrypt(binascii.unhexlify(saveResponse.encryptedKey), self.getPrivateKey())
+
+    # Decrypt the blob into the stream as it arrives. Files in delta mode hold a manifest, which is
+    # kept aside to put their contents together from their chunks
+    sniffer = ManifestSniffer(fileobj)
+    writer = DecryptingWriter(sniffer, fileKey)
+    try:
+      self.getBlobInto(saveResponse.downloadURL, writer, progress)
+      blobHash = writer.finish()
+      sniffer.finish()
+    except (FrameException, InvalidToken):
+      raise DownloadException()
+    if sniffer.manifest is not None:
+      blobHash = self.assembleDeltaInto(bytes(sniffer.manifest), fileKey, fileobj, operation=operation)
+
+    # As a security measure, check if the hash of the decrypted blob matches the hash of the blob on the server
+    if blobHash != saveResponse.hash:
+      metrics.hashMismatches.inc(operation=operation)
+      raise DownloadException()
+
+  def fetchRange(self, saveResponse: server.SaveResponse, offset: int, length: int, fileKey: Optional[bytes] = None, operation: str = "read_range") -> bytes:
+    """
+    Read part of the blob behind a download link returned by `save`. Framed blobs are read frame by
+    frame, fetching only the frames that cover the range, and each frame is authenticated on its
+    own. Files in delta mode only fetch the chunks that cover the range, and each chunk is checked
+    against its hash. Legacy blobs are a single Fernet token, so they are downloaded and checked in
+    full.
+
+    :param offset: Offset of the first byte to read. Negative offsets count back from the end.
+    :param fileKey: The decrypted file key, if the caller already has it.
+    :param operation: Name of the operation, used to label hash mismatches in the metrics.
+
+    :raises DownloadException: If the download failed or the blob has been tampered with.
+    """
+    # Decrypt the file key
+    if fileKey is None:
+      fileKey = rsaDecrypt(binascii.unhexlify(saveResponse.encryptedKey), self.getPrivateKey())
+
+    try:
+      # Read the start of the blob to see how it is laid out
+      head, _, total = self.getBlobRange(saveResponse.downloadURL, 0, RANGE_HEADER_BYTES - 1)
+      if isFramed(head) and len(head) < total:
+        return self.fetchFrames(saveResponse.downloadURL, fileKey, head, total, offset, length)
+
+      # Otherwise, the blob has to be decrypted as a whole
+      encryptedBlob = head if len(head) == total else self.getBlob(saveResponse.downloadURL)
+      blob = decryptContents(encryptedBlob, fileKey)
+    except (FrameException, InvalidToken):
+      raise DownloadException()
+
+    # Files in delta mode hold a manifest, so only the chunks that cover the range are needed
+    if isDelta(blob):
+      return self.fetchDeltaRange(blob, fileKey, offset, length, operation)
+
+    # As a security measure, check if the hash of the decrypted blob matches the hash of the blob on the server
+    if hashlib.sha256(blob).hexdigest() != saveResponse.hash:
+      metrics.hashMismatches.inc(operation=operation)
+      raise DownloadException()
+
+    # Keep a copy of the verified contents in the cache
+    self.blobCache.put(saveResponse.hash, blob)
+    start = rangeStart(offset, len(blob))
+    return blob[start:start + length]
+
+  def fetchSize(self, saveResponse: server.SaveResponse, fileKey: Optional[bytes] = None, operation: str = "size") -> int:
+    """
+    Find the size of the decrypted contents of the blob behind a download link returned by `save`.
+    Only the final frame of a framed blob is downloaded, and only the manifest of a file in delta
+    mode. Legacy blobs are downloaded and checked in full, and kept in the cache.
+
+    :param fileKey: The decrypted file key, if the caller already has it.
+    :param operation: Name of the operation, used to label hash mismatches in the metrics.
+
+    :raises DownloadException: If the download failed or the blob has been tampered with.
+    """
+    # Decrypt the file key
+    if fileKey is None:
+      fileKey = rsaDecrypt(binascii.unhexlify(saveResponse.encryptedKey), self.getPrivateKey())
+
+    try:
+      # Read the start of the blob to see how it is laid out
+      head, _, total = self.getBlobRange(saveResponse.downloadURL, 0, RANGE_HEADER_BYTES - 1)
+      if isFramed(head) and len(head) < total:
+        # Every frame but the last is full, so only the last one needs to be read
+        header = parseFramedHeader(head)
+        if header is None:
+          raise FrameException()
+        frameSize, headerLength, blobId = header
+        count, _ = framedLayout(total, frameSize, headerLength)
+        lastOffset = (count - 1) * frameSize
+        return lastOffset + len(self.fetchFrames(saveResponse.downloadURL, fileKey, head, total, lastOffset, frameSize))
+
+      # Otherwise, the blob has to be decrypted as a whole
+      encryptedBlob = head if len(head) == total else self.getBlob(saveResponse.downloadURL)
+      blob = decryptContents(encryptedBlob, fileKey)
+    except (FrameException, InvalidToken):
+      raise DownloadException()
+
+    # The manifest of a file in delta mode has the size of the whole file
+    if isDelta(blob):
+      try:
+        return readManifest(blob).size
+      except DeltaException:
+        raise DownloadException()
+
+    # As a security measure, check if the hash of the decrypted blob matches the hash of the blob on the server
+    if hashlib.sha256(blob).hexdigest() != saveResponse.hash:
+      metrics.hashMismatches.inc(operation=operation)
+      raise DownloadException()
+
+    # Keep a copy of the verified contents in the cache
+    self.blobCache.put(saveResponse.hash, blob)
+    return len(blob)
+
+  def fetchFrames(self, downloadURL: str, fileKey: bytes, head: bytes, total: int, offset: int, length: int) -> bytes:
+    """
+    Read part of a framed blob, given its first bytes and its length, with one range request for
+    the frames that cover the range.
+
+    :raises FrameException: If a frame has been tampered with, reordered or dropped.
+    :raises DownloadException: If the download failed.
+    """
+    header = parseFramedHeader(head)
+    if header is None:
+      raise FrameException()
+    frameSize, headerLength, blobId = header
+    count, lastLength = framedLayout(total, frameSize, headerLength)
+    fullLength = frameLength(frameSize)
+    fernet = Fernet(fileKey)
+
+    def getFrames(first: int, last: int) -> bytes:
+      # Download the frames from first to last inclusive
+      start = headerLength + first * fullLength
+      end = headerLength + last * fullLength + (lastLength if last == count - 1 else fullLength)
+      data, dataStart, _ = self.getBlobRange(downloadURL, start, end - 1)
+      frames = data[start - dataStart:end - dataStart].split(b"\n")[:-1]
+      if len(frames) != last - first + 1:
+        raise FrameException()
+
+      # Authenticate each frame and check that it belongs to this blob, and that only the last frame
+      # of the blob is marked as final
+      contents = []
+      for index, frame in enumerate(frames, first):
+        data, final = decryptFrame(fernet, blobId, index, frame)
+        if final != (index == count - 1) or (not final and len(data) != frameSize):
+          raise FrameException()
+        contents.append(data)
+      return b"".join(contents)
+
+    # The exact size of the plaintext is only known from the final frame, which is needed to count
+    # back from the end
+    if offset < 0:
+      offset = rangeStart(offset, (count - 1) * frameSize + len(getFrames(count - 1, count - 1)))
+    if length == 0 or offset >= count * frameSize:
+      return b""
+
+    # Only download the frames that cover the range
+    first = offset // frameSize
+    last = min(count - 1, (offset + length - 1) // frameSize)
+    skip = offset - first * frameSize
+    return getFrames(first, last)[skip:skip + length]
+
+  def fetchDeltaRange(self, manifestBlob: bytes, fileKey: bytes, offset: int, length: int, operation: str = "read_range") -> bytes:
+    """
+    Read part of a file in delta mode, downloading only the chunks that cover the range.
+
+    :raises DownloadException: If the manifest is not valid, a chunk could not be downloaded, or a
+      chunk does not match its hash.
+    """
+    try:
+      manifest = readManifest(manifestBlob)
+    except DeltaException:
+      raise DownloadException()
+    start = rangeStart(offset, manifest.size)
+    end = min(manifest.size, start + length)
+
+    # Find the chunks that overlap the range
+    chunks = []
+    chunkStart = 0
+    for chunk in manifest.chunks:
+      if chunkStart < end and chunkStart + chunk.length > start:
+        chunks.append((chunk, chunkStart))
+      chunkStart += chunk.length
+    if len(chunks) == 0:
+      return b""
+
+    # Download them, with one range request per run of neighbouring chunks
+    fetched = self.fetchChunks(manifest, [chunk for chunk, _ in chunks], fileKey, operation)
+    contents = b"".join(fetched[(chunk.segment, chunk.offset)] for chunk, _ in chunks)
+    skip = start - chunks[0][1]
+    return contents[skip:skip + end - start]
+
+  #
+  # Transfers
+  #
+
+  def putBlob(self, uploadURL: str, encryptedBlob: Union[bytes, EncryptingReader]) -> None:
+    """
+    Upload an encrypted blob to a storage upload URL, as returned by `prepareStore` or
+    `prepareUpdate`. The blob may be given as bytes, or as a reader that encrypts it on the fly.
+
+    :raises UploadException: If the upload failed.
+    """
+    # Create a resumable session from the upload URL
+    resumableSession = self.connection.pool.post(uploadURL, "", headers={
+        "x-goog-resumable": "start",
+        "content-type": "text/plain",
+        "x-goog-content-length-range": f"0,{len(encryptedBlob)}"
+    })
+    if resumableSession.status_code != 201:
+      raise UploadException()
+
+    # Get the location to upload to
+    location = resumableSession.headers["location"]
+
+    # Upload to that location via a PUT request
+    body = encryptedBlob if self.throttle is None else ThrottledReader(encryptedBlob, self.throttle)
+    uploadResponse = self.connection.pool.put(location, data=body, headers={
+      "content-type": "text/plain",
+      "content-length": str(len(encryptedBlob))
+    })
+
+    # Check if the upload was successful
+    if uploadResponse.status_code != 200:
+      raise UploadException()
+    metrics.bytesUploaded.inc(len(encryptedBlob))
+
+  def getBlob(self, downloadURL: str) -> bytes:
+    """
+    Download an encrypted blob from a storage download URL, as returned by `save`.
+
+    :raises DownloadException: If the download failed.
+    """
+    with self.connection.pool.get(downloadURL, stream=self.throttle is not None) as downloadResponse:
+      if downloadResponse.status_code != 200:
+        raise DownloadException()
+      content = self.readContent(downloadResponse)
+    metrics.bytesDownloaded.inc(len(content))
+    return content
+
+  def readContent(self, response: requests.Response) -> bytes:
+    """
+    Read the body of a download, in bounded chunks while the throttle is limiting downloads.
+    """
+    if self.throttle is None:
+      return response.content
+    chunks = []
+    for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+      self.throttle.consume(len(chunk))
+      chunks.append(chunk)
+    return b"".join(chunks)
+
+  def getBlobRange(self, downloadURL: str, start: int, end: int) -> Tuple[bytes, int, int]:
+    """
+    Download the bytes from start to end inclusive of an encrypted blob with an HTTP range request.
+    Storage that doesn't support range requests sends the whole blob instead, so callers should
+    slice the result by the offset returned.
+
+    :raises DownloadException: If the download failed.
+
+    :returns: A tuple of the bytes received, the offset of the first of them in the blob, and the
+      length of the whole blob.
+    """
+    with self.connection.pool.get(downloadURL, headers={ "range": f"bytes={start}-{end}" }, stream=self.throttle is not None) as downloadResponse:
+      if downloadResponse.status_code == 206:
+        contentRange = re.fullmatch(r"bytes (\d+)-(\d+)/(\d+)", downloadResponse.headers.get("content-range", ""))
+        if contentRange is None:
+          raise DownloadException()
+        content = self.readContent(downloadResponse)
+        received = content, int(contentRange[1]), int(contentRange[3])
+      elif downloadResponse.status_code == 200:
+        content = self.readContent(downloadResponse)
+        received = content, 0, len(content)
+      else:
+        raise DownloadException()
+    metrics.bytesDownloaded.inc(len(content))
+    return received
+
+  def getBlobInto(self, downloadURL: str, writer: DecryptingWriter, progress: Optional[ProgressCallback] = None) -> None:
+    """
+    Download an encrypted blob from a storage download URL in bounded chunks, passing each chunk to
+    a writer as it arrives.
+
+    :raises DownloadException: If the download failed.
+    """
+    with self.connection.pool.get(downloadURL, stream=True) as downloadResponse:
+      if downloadResponse.status_code != 200:
+        raise DownloadException()
+      total = int(downloadResponse.headers.get("content-length", 0))
+      received = 0
+      for chunk in downloadResponse.iter_content(STREAM_CHUNK_SIZE):
+        if self.throttle is not None:
+          self.throttle.consume(len(chunk))
+        writer.write(chunk)
+        received += len(chunk)
+        metrics.bytesDownloaded.inc(len(chunk))
+        if progress is not None:
+          progress(received, max(total, received))
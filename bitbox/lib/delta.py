@@ -0,0 +1,270 @@
+from bitbox.common import *
+from bitbox.encryption import fernetTokenLength
+from cryptography.fernet import Fernet
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Set, Tuple
+import hashlib
+import json
+import secrets
+
+#
+# Parameters
+#
+
+DELTA_MAGIC = b"bitbox-delta/1\n"
+DELTA_CHUNK_PREFIX = "&delta/"
+
+# Chunks are cut after a byte when the DELTA_CHUNK_BITS bytes ending with it pass a random test,
+# which happens every 2 ** DELTA_CHUNK_BITS bytes on average, but never before DELTA_MIN_CHUNK_SIZE
+# bytes or after DELTA_MAX_CHUNK_SIZE bytes
+DELTA_MIN_CHUNK_SIZE = 256 * 1024
+DELTA_MAX_CHUNK_SIZE = 4 * 1024 * 1024
+DELTA_CHUNK_BITS = 20
+
+# Chunks are stored together in remote files of up to about this many encrypted bytes
+DELTA_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Bytes scanned for a cut at a time
+DELTA_SCAN_SIZE = 64 * 1024
+
+# Each byte value gets a random word, and a byte passes test j when bit j of its word is clear. A
+# chunk is cut after a byte when the byte j places back passes test j, for every j. The tests are
+# packed 8 to a translation table, with bit k of entry b set when byte b passes test 8 * i + k
+BOUNDARY_WORDS = [int.from_bytes(hashlib.sha256(b"bitbox-gear" + bytes([b])).digest()[:8], "big") for b in range(256)]
+BOUNDARY_TABLES = [
+  bytes(sum(1 << k for k in range(min(8, DELTA_CHUNK_BITS - i)) if not (BOUNDARY_WORDS[b] >> (i + k)) & 1) for b in range(256))
+  for i in range(0, DELTA_CHUNK_BITS, 8)
+]
+
+#
+# Types
+#
+
+@dataclass
+class DeltaSegment:
+  # Name and ID of the remote file holding the chunks
+  name: str
+  fileId: str
+  # Length of the remote file, which is the encrypted chunks one after another
+  size: int
+
+@dataclass
+class DeltaChunk:
+  # SHA-256 hash of the contents of the chunk
+  hash: str
+  length: int
+  # Index of the segment holding the chunk, and the offset of its encrypted contents in the segment
+  segment: int
+  offset: int
+
+@dataclass
+class DeltaManifest:
+  owner: str
+  # SHA-256 hash and size of the whole file
+  hash: str
+  size: int
+  segments: List[DeltaSegment]
+  chunks: List[DeltaChunk]
+
+#
+# Exceptions
+#
+
+class DeltaException(Exception):
+  def __init__(self, message: str):
+    self.message = message
+
+#
+# Chunking
+#
+# Chunk boundaries are picked by the contents around them rather than by their offsets, so inserting
+# or deleting bytes in a file only changes the chunks around the edit, and the rest of the file
+# splits into the same chunks as before.
+#
+
+def findChunkEnd(data: bytes, start: int) -> int:
+  end = min(len(data), start + DELTA_MAX_CHUNK_SIZE)
+  if end - start <= DELTA_MIN_CHUNK_SIZE:
+    return end
+
+  # Scan a block at a time, along with the bytes before it that the tests of its first bytes need
+  window = DELTA_CHUNK_BITS - 1
+  for blockStart in range(start + DELTA_MIN_CHUNK_SIZE, end, DELTA_SCAN_SIZE):
+    block = data[blockStart - window:min(end, blockStart + DELTA_SCAN_SIZE)]
+
+    # Treat the block as one big integer, with a byte of flags per byte. Shifting the flags of test
+    # j by 8 * j - k bits moves the flag of the byte j places back onto bit 0 of each byte, so after
+    # ANDing all the tests together, bit 0 is set after every byte where the chunk can be cut
+    cuts = int.from_bytes(b"\x01" * len(block), "little")
+    for i, table in enumerate(BOUNDARY_TABLES):
+      flags = int.from_bytes(block.translate(table), "little")
+      for k in range(min(8, DELTA_CHUNK_BITS - 8 * i)):
+        cuts &= flags << (8 * (8 * i + k) - k)
+    cut = cuts.to_bytes(len(block), "little").find(b"\x01", window)
+    if cut >= 0:
+      return blockStart - window + cut + 1
+  return end
+
+def chunkBoundaries(data: bytes) -> List[Tuple[int, int]]:
+  """
+  Split data into content-defined chunks.
+
+  :returns: The (offset, length) of each chunk.
+  """
+  chunks = []
+  offset = 0
+  while offset < len(data):
+    end = findChunkEnd(data, offset)
+    chunks.append((offset, end - offset))
+    offset = end
+  return chunks
+
+def chunkHashes(data: bytes) -> Dict[str, Tuple[int, int]]:
+  """
+  Split data into content-defined chunks, to find chunks of a new version of a file that are
+  already on disk.
+
+  :returns: A dictionary from the hash of each chunk to its (offset, length).
+  """
+  return { hashlib.sha256(data[offset:offset + length]).hexdigest(): (offset, length) for offset, length in chunkBoundaries(data) }
+
+def segmentName(filename: str) -> str:
+  """
+  Name a new remote file to hold chunks of a file. Segments are never overwritten, so each one gets
+  a random name.
+  """
+  return DELTA_CHUNK_PREFIX + filename + "/" + secrets.token_hex(20)
+
+def chunkPrefix(filename: str) -> str:
+  return DELTA_CHUNK_PREFIX + filename + "/"
+
+def isChunkName(filename: str) -> bool:
+  return filename.startswith(DELTA_CHUNK_PREFIX)
+
+#
+# Manifest format
+#
+# A file in delta mode is stored as a manifest listing its chunks. The chunks are encrypted with the
+# same key as the manifest, one Fernet token each, and stored one after another in a few remote
+# files called segments. The hash the server keeps for the manifest is the hash of the whole file,
+# so it can be compared with local files as usual.
+#
+
+def isDelta(blob: bytes) -> bool:
+  return blob.startswith(DELTA_MAGIC)
+
+def buildManifest(manifest: DeltaManifest) -> bytes:
+  manifestJSON = {
+    "owner": manifest.owner,
+    "hash": manifest.hash,
+    "size": manifest.size,
+    "segments": [segment.__dict__ for segment in manifest.segments],
+    "chunks": [chunk.__dict__ for chunk in manifest.chunks]
+  }
+  return DELTA_MAGIC + json.dumps(manifestJSON, separators=(",", ":")).encode("utf-8")
+
+def readManifest(blob: bytes) -> DeltaManifest:
+  """
+  :raises DeltaException: If the blob is not a valid manifest.
+  """
+  if not isDelta(blob):
+    raise DeltaException("The file is not in delta mode.")
+  try:
+    manifestJSON = json.loads(blob[len(DELTA_MAGIC):].decode("utf-8"))
+    segments = [DeltaSegment(name=segment["name"], fileId=segment["fileId"], size=segment["size"]) for segment in manifestJSON["segments"]]
+    chunks = [DeltaChunk(hash=chunk["hash"], length=chunk["length"], segment=chunk["segment"], offset=chunk["offset"]) for chunk in manifestJSON["chunks"]]
+    manifest = DeltaManifest(owner=manifestJSON["owner"], hash=manifestJSON["hash"], size=manifestJSON["size"], segments=segments, chunks=chunks)
+    valid = (
+      all(isChunkName(segment.name) for segment in segments) and
+      all(0 <= chunk.segment < len(segments) and 0 <= chunk.offset and chunk.offset + chunkTokenLength(chunk) <= segments[chunk.segment].size for chunk in chunks) and
+      sum(chunk.length for chunk in chunks) == manifest.size
+    )
+  except (ValueError, KeyError, TypeError):
+    raise DeltaException("The manifest of the file is corrupted.")
+  if not valid:
+    raise DeltaException("The manifest of the file is corrupted.")
+  return manifest
+
+def chunkTokenLength(chunk: DeltaChunk) -> int:
+  return fernetTokenLength(chunk.length)
+
+def keptSegments(previous: DeltaManifest, hashes: Set[str]) -> Set[int]:
+  """
+  Work out which segments of the previous version of a file a new version should keep using. A
+  segment is kept while at least half of its bytes are chunks that the new version has. Otherwise,
+  the chunks it still holds are stored again along with the new ones, so that the file doesn't end
+  up spread over segments that are mostly dead.
+
+  :param hashes: Hashes of the chunks of the new version.
+
+  :returns: The indices of the segments to keep.
+  """
+  live = [0] * len(previous.segments)
+  seen: Set[Tuple[int, int]] = set()
+  for chunk in previous.chunks:
+    if chunk.hash in hashes and (chunk.segment, chunk.offset) not in seen:
+      seen.add((chunk.segment, chunk.offset))
+      live[chunk.segment] += chunkTokenLength(chunk)
+  return set(i for i, segment in enumerate(previous.segments) if live[i] > 0 and 2 * live[i] >= segment.size)
+
+def chunkRuns(chunks: List[DeltaChunk]) -> List[List[DeltaChunk]]:
+  """
+  Group chunks into runs that lie next to each other in the same segment, so each run can be
+  downloaded with one range request. Chunks that appear more than once are only included once.
+  """
+  runs: List[List[DeltaChunk]] = []
+  unique = { (chunk.segment, chunk.offset): chunk for chunk in chunks }
+  for key in sorted(unique):
+    chunk = unique[key]
+    last = runs[-1][-1] if len(runs) > 0 else None
+    if last is not None and last.segment == chunk.segment and last.offset + chunkTokenLength(last) == chunk.offset:
+      runs[-1].append(chunk)
+    else:
+      runs.append([chunk])
+  return runs
+
+def decryptRun(encryptedRun: bytes, run: List[DeltaChunk], fileKey: bytes) -> List[bytes]:
+  """
+  Decrypt the chunks of a run, as grouped by `chunkRuns`, from the encrypted bytes of the whole run.
+
+  :raises InvalidToken: If a chunk has been tampered with.
+  """
+  start = run[0].offset
+  return [Fernet(fileKey).decrypt(encryptedRun[chunk.offset - start:chunk.offset - start + chunkTokenLength(chunk)]) for chunk in run]
+
+class ManifestSniffer:
+  """
+  A writable stream that passes data through to another stream, unless the data turns out to be a
+  manifest, in which case it is kept in memory instead. This lets a download be written straight to
+  its destination without knowing in advance whether the file is in delta mode.
+  """
+  manifest: Optional[bytearray]
+  __fileobj: BinaryIO
+  __buffer: Optional[bytearray]
+
+  def __init__(self, fileobj: BinaryIO):
+    self.manifest = None
+    self.__fileobj = fileobj
+    self.__buffer = bytearray()
+
+  def write(self, data: bytes) -> None:
+    if self.manifest is not None:
+      self.manifest += data
+    elif self.__buffer is None:
+      self.__fileobj.write(data)
+    else:
+      # Wait until there are enough bytes to tell whether this is a manifest
+      self.__buffer += data
+      if len(self.__buffer) >= len(DELTA_MAGIC):
+        self.__decide()
+
+  def finish(self) -> None:
+    if self.__buffer is not None:
+      self.__decide()
+
+  def __decide(self) -> None:
+    if isDelta(bytes(self.__buffer)):
+      self.manifest = self.__buffer
+    elif len(self.__buffer) > 0:
+      self.__fileobj.write(bytes(self.__buffer))
+    self.__buffer = None
@@ -1,11 +1,7 @@
 from bitbox.common import *
-from bitbox.encryption import *
-from bitbox.lib.exceptions import *
-import bitbox.server as server
-from cryptography.fernet import Fernet
-import binascii
-import requests
-import hashlib
+from bitbox.lib.client import Client
+from bitbox.lib.stream import ProgressCallback
+from typing import BinaryIO
 
 def download(filename: str, owner: str, authInfo: AuthInfo) -> bytes:
   """
@@ -26,45 +22,67 @@ def download(filename: str, owner: str, authInfo: AuthInfo) -> bytes:
 
   :returns: The decrypted blob.
   """
+  return Client(authInfo).download(filename, owner)
 
-  # Get the file info
-  fileInfo = server.fileInfo(filename, owner, authInfo)
-  if isinstance(fileInfo, server.Error):
-    if fileInfo == server.Error.FILE_NOT_FOUND:
-      raise FileNotFoundException(fileInfo.name)
-    elif fileInfo == server.Error.USER_NOT_FOUND:
-      raise UserNotFoundException(owner)
-    else:
-      raise BitboxException(fileInfo)
-  
-  # Grab the file ID and hash of the blob
-  fileId = fileInfo.fileId
-  blobHash = fileInfo.hash
+def download_fileobj(filename: str, owner: str, fileobj: BinaryIO, authInfo: AuthInfo, progress: Optional[ProgressCallback] = None):
+  """
+  Download a blob from the server into a writable binary stream. The blob is downloaded, decrypted
+  and written in bounded chunks. The hash of the contents can only be checked once the whole blob
+  has been written, so if this raises, the data already written to the stream should be discarded.
+
+  :param filename: Remote filename for the blob.
+  :param owner: Owner of the file. Should be just the username and not `"@" + username`.
+  :param fileobj: Writable binary stream to write the decrypted blob to.
+  :param authInfo: Authentication information.
+  :param progress: Called with the number of bytes received so far and the total number of bytes to receive.
+
+  :raises FileNotFoundException: If the file doesn't exist.
+  :raises UserNotFoundException: If the owner doesn't exist.
+  :raises FileNotReadyException: If the file is not ready to be downloaded.
+  :raises DownloadException: If the download failed or the contents don't match the hash on the server.
+  :raises DecryptionException: If the password to decrypt the private key is incorrect.
+  :raises AuthenticationException: If login failed with the server.
+  :raises InvalidVersionException: If the server no longer supports the current version of Bitbox.
+  :raises BitboxException: Any other exception indicating an bug in Bitbox.
+  """
+  Client(authInfo).download_fileobj(filename, owner, fileobj, progress)
+
+def download_file(filename: str, owner: str, path: str, authInfo: AuthInfo, progress: Optional[ProgressCallback] = None):
+  """
+  Download a blob from the server into a local file. The file is only created or replaced once
+  the download has been verified. See `download_fileobj`.
+
+  :param filename: Remote filename for the blob.
+  :param owner: Owner of the file. Should be just the username and not `"@" + username`.
+  :param path: Path of the local file to write.
+  :param authInfo: Authentication information.
+  :param progress: Called with the number of bytes received so far and the total number of bytes to receive.
+  """
+  Client(authInfo).download_file(filename, owner, path, progress)
 
-  # Grab the download link for the encrypted blob
-  saveResponse = server.save(fileId, authInfo)
-  if isinstance(saveResponse, server.Error):
-    if saveResponse == server.Error.FILE_NOT_FOUND:
-      raise FileNotFoundException(fileInfo.name)
-    elif saveResponse == server.Error.FILE_NOT_READY:
-      raise FileNotReadyException(fileInfo.name)
-    else:
-      raise BitboxException(saveResponse)
-  
-  # Download the file
-  downloadResponse = requests.get(saveResponse.downloadURL)
-  if downloadResponse.status_code != 200:
-    raise DownloadException()
-  
-  # Decrypt the file
-  encryptedBlobStr = downloadResponse.text
-  privateKey = authInfo.getPrivateKey()
-  fileKey = rsaDecrypt(binascii.unhexlify(saveResponse.encryptedKey), privateKey)
-  blob = Fernet(fileKey).decrypt(encryptedBlobStr)
+def read_range(filename: str, owner: str, offset: int, length: int, authInfo: AuthInfo) -> bytes:
+  """
+  Read part of a file from the server without downloading all of it. Files uploaded with
+  `upload_fileobj` or `upload_file` are encrypted in frames, so only the frames that cover the range
+  are downloaded, and each of them is authenticated on its own. Since the hash on the server covers
+  the whole file, it can't be checked for a partial read. Files encrypted as a single token are
+  downloaded and checked in full.
 
-  # As a security measure, check if the hash of the decrypted blob matches the hash of the blob on the server
-  if hashlib.sha256(blob).hexdigest() != blobHash:
-    raise DownloadException()
+  :param filename: Remote filename for the blob.
+  :param owner: Owner of the file. Should be just the username and not `"@" + username`.
+  :param offset: Offset of the first byte to read. Negative offsets count back from the end of the file.
+  :param length: Number of bytes to read. Fewer bytes are returned if the range runs past the end of the file.
+  :param authInfo: Authentication information.
 
-  # Return the decrypted blob
-  return blob
\ No newline at end of file
+  :raises FileNotFoundException: If the file doesn't exist.
+  :raises UserNotFoundException: If the owner doesn't exist.
+  :raises FileNotReadyException: If the file is not ready to be downloaded.
+  :raises DownloadException: If the download failed or the file has been tampered with.
+  :raises DecryptionException: If the password to decrypt the private key is incorrect.
+  :raises AuthenticationException: If login failed with the server.
+  :raises InvalidVersionException: If the server no longer supports the current version of Bitbox.
+  :raises BitboxException: Any other exception indicating an bug in Bitbox.
+
+  :returns: The decrypted bytes in the range.
+  """
+  return Client(authInfo).read_range(filename, owner, offset, length)
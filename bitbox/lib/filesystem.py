@@ -0,0 +1,341 @@
+from bitbox.common import *
+from bitbox.lib.client import Client, TTLCache, DEFAULT_CACHE_TTL
+from bitbox.lib.delta import isChunkName
+from bitbox.lib.pack import isPackMarker
+from bitbox.lib.exceptions import *
+from bitbox.lib.login import login
+from bitbox.encryption import DEFAULT_FRAME_SIZE, rsaDecrypt
+import bitbox.server as server
+from fsspec.spec import AbstractFileSystem, AbstractBufferedFile
+from datetime import datetime, timezone
+from typing import Callable, Dict, Tuple, Any
+import tempfile
+import binascii
+import json
+import os
+
+#
+# Parameters
+#
+
+# Reads are cached in blocks of whole frames, so that each block is a single range request
+DEFAULT_BLOCK_SIZE = 4 * DEFAULT_FRAME_SIZE
+
+# Written files are kept in memory up to this size, and on disk beyond it, until they are uploaded
+SPOOL_MAX_MEMORY = 16 * 1024 ** 2
+
+#
+# Utility functions
+#
+
+def loadAuthInfo(configFolder: Optional[str] = None, password: Optional[str] = None) -> AuthInfo:
+  """
+  Log in with the key file and session that `bitbox setup` saved in a config folder.
+
+  :param configFolder: The config folder. If None, the folder in the `BITBOX_CONFIG_FOLDER`
+    environment variable is used, or `~/.bitbox`.
+  :param password: The password to decrypt the private key with, prompted for if needed and None.
+
+  :raises FileNotFoundError: If bitbox has not been set up in the config folder.
+  """
+  configFolder = configFolder or os.environ.get("BITBOX_CONFIG_FOLDER") or os.path.join(os.path.expanduser("~"), ".bitbox")
+  with open(os.path.join(configFolder, "keyfile.json"), "r") as f:
+    keyInfo = KeyInfo(**json.load(f))
+  sessionPath = os.path.join(configFolder, "session.str")
+  session = None
+  if os.path.exists(sessionPath):
+    with open(sessionPath, "r") as f:
+      session = f.read()
+  return login(keyInfo, password, session)
+
+#
+# File system
+#
+
+class BitboxFileSystem(AbstractFileSystem):
+  """
+  An fsspec file system backed by bitbox, so that `bitbox://@owner/name` paths can be used with
+  pandas, dask and anything else that takes fsspec URLs. Paths without an owner are the user's own
+  files, and slashes in remote filenames are treated as directories.
+
+  Listings come from a single request for every file visible to the user, and are cached for
+  `listings_expiry_time` seconds. The file info only has the size of the encrypted blob, so `ls`
+  reports the size of files as None, and `info` works it out from the end of the blob and keeps it
+  in the listing. Reads are cached in blocks, and each block is fetched with a ranged read of only
+  the frames it covers. Writes are buffered to a temporary file and uploaded when the file is
+  closed, since the server needs the hash of a file before it can be uploaded.
+  """
+  protocol = "bitbox"
+  root_marker = ""
+  client: Client
+  __listingCache: TTLCache
+
+  def __init__(self, authInfo: Optional[AuthInfo] = None, configFolder: Optional[str] = None, password: Optional[str] = None, listings_expiry_time: float = DEFAULT_CACHE_TTL, **kwargs):
+    """
+    :param authInfo: Authentication information, as returned by `login`. If None, the user is
+      logged in with the config folder that `bitbox setup` saved.
+    :param configFolder: The config folder to log in with. See `loadAuthInfo`.
+    :param password: The password to decrypt the private key with. See `loadAuthInfo`.
+    :param listings_expiry_time: Number of seconds that listings are cached for.
+    """
+    super().__init__(listings_expiry_time=listings_expiry_time, **kwargs)
+    self.client = Client(authInfo or loadAuthInfo(configFolder, password), cacheTTL=listings_expiry_time)
+    self.__listingCache = TTLCache("listing", listings_expiry_time)
+
+  @classmethod
+  def _strip_protocol(cls, path: str) -> str:
+    if path.startswith("bitbox://"):
+      path = path[len("bitbox://"):]
+    return path.strip("/")
+
+  def canonical(self, path: str) -> str:
+    """
+    :returns: The path in the form '@owner/name', or '@owner' or '' for directories above files.
+    """
+    path = self._strip_protocol(path)
+    if path == "" or path.startswith("@"):
+      return path
+    return f"@{self.client.username}/{path}"
+
+  def split(self, path: str) -> Tuple[str, str]:
+    """
+    :returns: A tuple of the owner and the remote filename of a path.
+
+    :raises FileNotFoundError: If the path is not a file.
+    """
+    path = self.canonical(path)
+    if "/" not in path:
+      raise FileNotFoundError(path)
+    owner, filename = path.split("/", 1)
+    return owner[1:], filename
+
+  #
+  # Listings
+  #
+
+  def refresh(self) -> None:
+    """
+    List every file visible to the user with a single request, and rebuild the listing of every
+    directory from it.
+    """
+    filesInfo = self.client.filesInfo()
+    listings: Dict[str, Dict[str, Dict[str, Any]]] = { "": {} }
+    for fileInfo in filesInfo:
+      # Chunks of files in delta mode and pack markers are listed as part of their files
+      if isChunkName(fileInfo.name) or isPackMarker(fileInfo.name):
+        continue
+
+      # Add every directory above the file
+      parent = "@" + fileInfo.owner
+      listings[""][parent] = { "name": parent, "size": 0, "type": "directory" }
+      parts = fileInfo.name.split("/")
+      for part in parts[:-1]:
+        directory = parent + "/" + part
+        listings.setdefault(parent, {})[directory] = { "name": directory, "size": 0, "type": "directory" }
+        parent = directory
+
+      # Add the file itself
+      path = parent + "/" + parts[-1]
+      listings.setdefault(parent, {})[path] = {
+        "name": path,
+        "size": None,
+        "type": "file",
+        "encrypted_size": fileInfo.bytes,
+        "hash": fileInfo.hash,
+        "owner": fileInfo.owner,
+        "mtime": fileInfo.lastModified / 1000,
+        "shared_with": fileInfo.sharedWith
+      }
+
+    self.dircache.clear()
+    for directory, entries in listings.items():
+      self.dircache[directory] = list(entries.values())
+    self.__listingCache.set("", filesInfo)
+
+  def listing(self) -> List[FileInfo]:
+    """
+    :returns: The file info of every file visible to the user, including chunks and pack markers,
+      from the last listing if it hasn't expired.
+    """
+    filesInfo = self.__listingCache.get("")
+    if filesInfo is None:
+      self.refresh()
+      filesInfo = self.__listingCache.get("")
+    return filesInfo
+
+  def ls(self, path: str, detail: bool = True, refresh: bool = False, **kwargs):
+    path = self.canonical(path)
+    if refresh or (path not in self.dircache and self._parent(path) not in self.dircache):
+      self.refresh()
+    entries = self.dircache.get(path)
+
+    # Listing a file gives just that file
+    if entries is None:
+      parent = self._parent(path)
+      entries = [entry for entry in self.dircache.get(parent, []) if entry["name"] == path and entry["type"] == "file"]
+      if len(entries) == 0:
+        raise FileNotFoundError(path)
+    return entries if detail else [entry["name"] for entry in entries]
+
+  def info(self, path: str, **kwargs) -> Dict[str, Any]:
+    path = self.canonical(path)
+    if path == "":
+      return { "name": "", "size": 0, "type": "directory" }
+    entry = super().info(path, **kwargs)
+
+    # Work out the size of the contents the first time it is needed, and keep it in the listing
+    if entry["type"] == "file" and entry["size"] is None:
+      owner, filename = self.split(path)
+      entry["size"] = self.call(lambda: self.client.size(filename, owner), path)
+    return entry
+
+  def invalidate_cache(self, path: Optional[str] = None) -> None:
+    self.dircache.clear()
+    self.__listingCache.discard("")
+
+  def checksum(self, path: str) -> int:
+    return int(self.info(path)["hash"][:16], 16)
+
+  def ukey(self, path: str) -> str:
+    return self.info(path)["hash"]
+
+  def modified(self, path: str) -> datetime:
+    return datetime.fromtimestamp(self.info(path)["mtime"], tz=timezone.utc)
+
+  #
+  # Files
+  #
+
+  def _open(self, path: str, mode: str = "rb", block_size: Optional[int] = None, autocommit: bool = True, cache_options: Optional[Dict[str, Any]] = None, **kwargs):
+    return BitboxFile(self, self.canonical(path), mode, block_size or DEFAULT_BLOCK_SIZE, autocommit, cache_options=cache_options, **kwargs)
+
+  def cat_file(self, path: str, start: Optional[int] = None, end: Optional[int] = None, **kwargs) -> bytes:
+    owner, filename = self.split(path)
+
+    # Whole files are downloaded and checked against their hash
+    if start is None and end is None:
+      return self.call(lambda: self.client.download(filename, owner), path)
+
+    # Ranges from the end of the file, or up to it, don't need the size of the file
+    start = start or 0
+    if end is None:
+      length = -start if start < 0 else self.info(path)["size"] - start
+    elif (start < 0) == (end < 0):
+      length = end - start
+    else:
+      return super().cat_file(path, start, end, **kwargs)
+    return self.call(lambda: self.client.read_range(filename, owner, start, max(0, length)), path)
+
+  def get_file(self, rpath: str, lpath: str, callback: Any = None, outfile: Any = None, **kwargs) -> None:
+    owner, filename = self.split(rpath)
+    if outfile is not None:
+      self.call(lambda: self.client.download_fileobj(filename, owner, outfile), rpath)
+    elif os.path.isdir(lpath):
+      os.makedirs(lpath, exist_ok=True)
+    else:
+      self.call(lambda: self.client.download_file(filename, owner, lpath), rpath)
+
+  def put_file(self, lpath: str, rpath: str, callback: Any = None, **kwargs) -> None:
+    if os.path.isdir(lpath):
+      return
+    owner, filename = self.split(rpath)
+    if owner != self.client.username:
+      raise PermissionError(f"Files owned by @{owner} can't be written to.")
+    self.client.upload_file(lpath, filename, overwrite=True, filesInfo=self.listing())
+    self.invalidate_cache()
+
+  def rm_file(self, path: str) -> None:
+    owner, filename = self.split(path)
+    if owner != self.client.username:
+      raise PermissionError(f"Files owned by @{owner} can't be deleted.")
+    filesInfo = self.listing()
+    fileInfo = next((fileInfo for fileInfo in filesInfo if fileInfo.owner == owner and fileInfo.name == filename), None)
+    if fileInfo is None:
+      raise FileNotFoundError(path)
+    deleteResponse = server.delete(fileInfo.fileId, self.client.authInfo, self.client.connection)
+    if isinstance(deleteResponse, server.Error):
+      raise BitboxException(deleteResponse)
+    self.client.deleteChunks(filename, filesInfo=filesInfo)
+    self.client.unmarkPack(filename, filesInfo)
+    self.client.invalidate(filename, owner)
+    self.invalidate_cache()
+
+  def _rm(self, path: str) -> None:
+    self.rm_file(path)
+
+  def mkdir(self, path: str, create_parents: bool = True, **kwargs) -> None:
+    # Directories only exist as parts of filenames, so there is nothing to create
+    pass
+
+  def makedirs(self, path: str, exist_ok: bool = False) -> None:
+    pass
+
+  def rmdir(self, path: str) -> None:
+    pass
+
+  def call(self, operation: Callable[[], Any], path: str) -> Any:
+    """
+    Run a client operation, turning the exceptions for missing files into the ones fsspec expects.
+    """
+    try:
+      return operation()
+    except (FileNotFoundException, UserNotFoundException):
+      raise FileNotFoundError(path)
+    except FileNotReadyException:
+      raise OSError(f"Remote file '{path}' is being modified elsewhere. Please try again later.")
+    except DownloadException:
+      raise OSError(f"An error occurred downloading remote file '{path}', or it does not match its hash. This file may have been tampered with.")
+
+class BitboxFile(AbstractBufferedFile):
+  """
+  A file in a `BitboxFileSystem`. Reading fetches only the frames that cover each block, and
+  writing spools the contents until the file is closed, then uploads them in one go.
+  """
+  fs: BitboxFileSystem
+  __blob: Optional[bytes]
+  __saveResponse: Optional[server.SaveResponse]
+  __fileKey: Optional[bytes]
+  __spool: Any
+
+  def __init__(self, fs: BitboxFileSystem, path: str, mode: str = "rb", block_size: int = DEFAULT_BLOCK_SIZE, autocommit: bool = True, cache_type: str = "blockcache", **kwargs):
+    if mode not in ["rb", "wb"]:
+      raise NotImplementedError(f"File mode '{mode}' is not supported. Bitbox files can only be read or overwritten.")
+    self.__blob = None
+    self.__saveResponse = None
+    self.__fileKey = None
+    self.__spool = None
+    super().__init__(fs, path, mode, block_size, autocommit, cache_type=cache_type, **kwargs)
+
+  def _fetch_range(self, start: int, end: int) -> bytes:
+    owner, filename = self.fs.split(self.path)
+
+    # Use the cached contents if we already have them
+    if self.__blob is None and self.__saveResponse is None:
+      self.__blob = self.fs.client.blobCache.get(self.details["hash"])
+    if self.__blob is not None:
+      return self.__blob[start:end]
+
+    # Otherwise, get a download link and the file key once, and reuse them for every block
+    if self.__saveResponse is None:
+      self.__saveResponse = self.fs.call(lambda: self.fs.client.save(filename, owner), self.path)
+      self.__fileKey = rsaDecrypt(binascii.unhexlify(self.__saveResponse.encryptedKey), self.fs.client.getPrivateKey())
+    return self.fs.call(lambda: self.fs.client.fetchRange(self.__saveResponse, start, end - start, self.__fileKey), self.path)
+
+  def _initiate_upload(self) -> None:
+    owner, _ = self.fs.split(self.path)
+    if owner != self.fs.client.username:
+      raise PermissionError(f"Files owned by @{owner} can't be written to.")
+    self.__spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+
+  def _upload_chunk(self, final: bool = False) -> bool:
+    self.__spool.write(self.buffer.getvalue())
+    if final:
+      # Upload the whole file once it is complete
+      _, filename = self.fs.split(self.path)
+      self.__spool.seek(0)
+      try:
+        self.fs.client.upload_fileobj(self.__spool, filename, overwrite=True, filesInfo=self.fs.listing())
+      finally:
+        self.__spool.close()
+      self.fs.invalidate_cache()
+    return True
@@ -0,0 +1,165 @@
+from bitbox.common import *
+from dataclasses import dataclass
+from typing import Dict, Tuple
+import posixpath
+import hashlib
+import json
+
+#
+# Parameters
+#
+
+PACK_MAGIC = b"bitbox-pack/1\n"
+PACK_INDEX_LENGTH_BYTES = 8
+
+# Packs are marked by an empty remote file named with this prefix and the name of the pack
+PACK_MARKER_PREFIX = "&pack/"
+
+#
+# Types
+#
+
+@dataclass
+class PackMember:
+  name: str
+  offset: int
+  length: int
+  hash: str
+
+#
+# Exceptions
+#
+
+class PackException(Exception):
+  def __init__(self, message: str):
+    self.message = message
+
+#
+# Pack format
+#
+# A pack holds many small files in a single blob, so that they can be stored and encrypted as one
+# remote file. It starts with PACK_MAGIC, then the length of the index as an 8-byte big-endian
+# integer, then the index as JSON, then the contents of every member back to back. Offsets in the
+# index are relative to the end of the index.
+#
+
+def isPack(blob: bytes) -> bool:
+  return blob.startswith(PACK_MAGIC)
+
+#
+# Pack markers
+#
+# Any file can start with PACK_MAGIC, so a remote file is only treated as a pack if it has a
+# marker next to it. The marker is encrypted with the same key as the pack, and is shared and
+# deleted along with it like the chunks of a file in delta mode.
+#
+
+def packMarkerName(filename: str) -> str:
+  return PACK_MARKER_PREFIX + filename
+
+def isPackMarker(filename: str) -> bool:
+  return filename.startswith(PACK_MARKER_PREFIX)
+
+def isSafeMemberName(name: str) -> bool:
+  """
+  Member names are relative paths using '/' as the separator. Names that would escape the directory
+  a pack is extracted into are rejected, since packs can be shared by other users.
+  """
+  if name == "" or name.startswith("/") or "\\" in name or "\0" in name:
+    return False
+  normalized = posixpath.normpath(name)
+  return normalized == name and normalized != "." and not normalized.startswith("../") and normalized != ".."
+
+def buildPack(members: List[Tuple[str, bytes]]) -> bytes:
+  """
+  Build a pack from a list of (name, contents) pairs.
+
+  :raises PackException: If a member name is invalid or appears more than once.
+  """
+  index = []
+  offset = 0
+  names = set()
+  for name, contents in members:
+    if not isSafeMemberName(name):
+      raise PackException(f"Invalid pack member name '{name}'.")
+    if name in names:
+      raise PackException(f"Pack member '{name}' appears more than once.")
+    names.add(name)
+    index.append({
+      "name": name,
+      "offset": offset,
+      "length": len(contents),
+      "hash": hashlib.sha256(contents).hexdigest()
+    })
+    offset += len(contents)
+
+  indexBytes = json.dumps({ "members": index }).encode("utf-8")
+  return b"".join([PACK_MAGIC, len(indexBytes).to_bytes(PACK_INDEX_LENGTH_BYTES, "big"), indexBytes] + [contents for _, contents in members])
+
+def readPackHeader(blob: bytes) -> Tuple[List[PackMember], int]:
+  """
+  Parse the index at the start of a pack.
+
+  :raises PackException: If the blob is not a valid pack.
+
+  :returns: A tuple of the members of the pack and the offset at which their contents start.
+  """
+  if not isPack(blob):
+    raise PackException("Blob is not a pack.")
+  indexStart = len(PACK_MAGIC) + PACK_INDEX_LENGTH_BYTES
+  indexLength = int.from_bytes(blob[len(PACK_MAGIC):indexStart], "big")
+  if indexStart + indexLength > len(blob):
+    raise PackException("Pack index is truncated.")
+  try:
+    index = json.loads(blob[indexStart:indexStart + indexLength].decode("utf-8"))
+    members = [PackMember(**member) for member in index["members"]]
+  except Exception as e:
+    raise PackException(f"Pack index is invalid: {e}")
+
+  dataStart = indexStart + indexLength
+  for member in members:
+    if not isSafeMemberName(member.name):
+      raise PackException(f"Invalid pack member name '{member.name}'.")
+    if member.offset < 0 or member.length < 0 or dataStart + member.offset + member.length > len(blob):
+      raise PackException(f"Pack member '{member.name}' is out of bounds.")
+  return members, dataStart
+
+def readPackIndex(blob: bytes) -> Dict[str, PackMember]:
+  """
+  Get the members of a pack by name.
+
+  :raises PackException: If the blob is not a valid pack.
+  """
+  members, _ = readPackHeader(blob)
+  return { member.name: member for member in members }
+
+def extractMember(blob: bytes, member: PackMember) -> bytes:
+  """
+  Get the contents of a member of a pack, checking them against the hash in the index.
+
+  :raises PackException: If the member's contents don't match its hash.
+  """
+  if not isPack(blob):
+    raise PackException("Blob is not a pack.")
+  indexStart = len(PACK_MAGIC) + PACK_INDEX_LENGTH_BYTES
+  dataStart = indexStart + int.from_bytes(blob[len(PACK_MAGIC):indexStart], "big")
+  return memberContents(blob, dataStart, member)
+
+def memberContents(blob: bytes, dataStart: int, member: PackMember) -> bytes:
+  contents = blob[dataStart + member.offset:dataStart + member.offset + member.length]
+  if hashlib.sha256(contents).hexdigest() != member.hash:
+    raise PackException(f"Pack member '{member.name}' does not match its hash.")
+  return contents
+
+def replaceMembers(blob: bytes, updates: Dict[str, bytes]) -> bytes:
+  """
+  Build a new pack with the contents of some members replaced, and the rest kept as they are.
+
+  :raises PackException: If the blob is not a valid pack, or a member to replace is not in it.
+  """
+  members, dataStart = readPackHeader(blob)
+  names = set(member.name for member in members)
+  for name in updates:
+    if name not in names:
+      raise PackException(f"Pack member '{name}' does not exist.")
+  return buildPack([(member.name, updates[member.name] if member.name in updates else memberContents(blob, dataStart, member)) for member in members])
@@ -0,0 +1,70 @@
+from bitbox.common import *
+from bitbox.lib.delta import chunkPrefix
+from dataclasses import dataclass
+from typing import Any
+
+#
+# Types
+#
+
+@dataclass
+class PlanItem:
+  # Whatever the caller uses to identify the transfer
+  key: Any
+  # Name of the remote file that the transfer creates or replaces
+  remote: str
+  # Projected size of the remote file once the transfer is done, as stored on the server
+  bytes: int
+  # Items with a higher priority are planned first
+  priority: int = 0
+
+@dataclass
+class Plan:
+  # Items that fit in the user's storage, in the order they should run
+  accepted: List[PlanItem]
+  # Items that would take the user over their storage limit
+  rejected: List[PlanItem]
+  # Storage used before the transfers, and projected to be used once the accepted ones are done
+  used: int
+  projected: int
+
+#
+# Planning
+#
+# Batches of uploads are planned against the user's storage limit from a single listing of their
+# files and the sizes of the local files, so that uploads which can't fit are rejected before
+# anything is read, encrypted or sent, instead of failing partway through the batch. Projections
+# are estimates, and the server has the final say on each upload.
+#
+
+def planTransfers(items: List[PlanItem], filesInfo: List[FileInfo], username: str, limit: int = BITBOX_STORAGE_LIMIT) -> Plan:
+  """
+  Plan a batch of uploads against the user's storage limit. Items that replace an existing file,
+  along with its chunks if it is in delta mode, only count the difference in size. Items are
+  planned by priority, then by how much storage they add, smallest first, so that as many of them
+  fit as possible.
+
+  :param filesInfo: A listing of every file visible to the user.
+  :param limit: The user's storage limit.
+
+  :returns: The plan.
+  """
+  # Work out how much storage each item adds
+  owned = [fileInfo for fileInfo in filesInfo if fileInfo.owner == username]
+  used = sum(fileInfo.bytes for fileInfo in owned)
+  def existingBytes(remote: str) -> int:
+    prefix = chunkPrefix(remote)
+    return sum(fileInfo.bytes for fileInfo in owned if fileInfo.name == remote or fileInfo.name.startswith(prefix))
+  growth = { id(item): item.bytes - existingBytes(item.remote) for item in items }
+
+  # Accept items in order for as long as they fit
+  accepted = []
+  rejected = []
+  projected = used
+  for item in sorted(items, key=lambda item: (-item.priority, growth[id(item)])):
+    if projected + growth[id(item)] <= limit:
+      accepted.append(item)
+      projected += growth[id(item)]
+    else:
+      rejected.append(item)
+  return Plan(accepted=accepted, rejected=rejected, used=used, projected=projected)
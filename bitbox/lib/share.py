@@ -1,9 +1,6 @@
 from bitbox.common import *
-from bitbox.encryption import *
-from bitbox.lib.exceptions import *
-import bitbox.server as server
+from bitbox.lib.client import Client
 from typing import List
-import binascii
 
 def share(filename: str, recipients: List[str], authInfo: AuthInfo):
   """
@@ -20,40 +17,4 @@ def share(filename: str, recipients: List[str], authInfo: AuthInfo):
   :raises InvalidVersionException: If the server no longer supports the current version of Bitbox.
   :raises BitboxException: Any other exception indicating an bug in Bitbox.
   """
-
-  # Get the file info
-  fileInfo = server.fileInfo(filename, authInfo.keyInfo.username, authInfo)
-  if isinstance(fileInfo, server.Error):
-    if fileInfo == server.Error.FILE_NOT_FOUND:
-      raise FileNotFoundException(fileInfo.name)
-    else:
-      raise BitboxException(fileInfo)
-  fileId = fileInfo.fileId
-  encryptedKey = fileInfo.encryptedKey
-
-  # Get the public keys of the recipients
-  publicKeys = {}
-  for recipient in recipients:
-    userInfoResponse = server.userInfo(recipient)
-    if isinstance(userInfoResponse, server.Error):
-      raise UserNotFoundException(recipient)
-    publicKeys[recipient] = RSA.import_key(userInfoResponse.publicKey)
-  
-  # Decrypt the file key
-  privateKey = authInfo.getPrivateKey()
-  fileKey = rsaDecrypt(binascii.unhexlify(encryptedKey), privateKey)
-
-  # Re-encrypt the file key for each recipient
-  recipientEncryptedKeys = {}
-  for recipient, publicKey in publicKeys.items():
-    recipientEncryptedFileKey = rsaEncrypt(fileKey, publicKey)
-    recipientEncryptedFileKeyHex = binascii.hexlify(recipientEncryptedFileKey).decode("utf-8")
-    recipientEncryptedKeys[recipient] = recipientEncryptedFileKeyHex
-  
-  # Share the file with the recipients
-  shareResponse = server.share(fileId, recipientEncryptedKeys, authInfo)
-  if isinstance(shareResponse, server.Error):
-    if shareResponse == server.Error.FILE_NOT_FOUND:
-      raise FileNotFoundException(fileInfo.name)
-    else:
-      raise BitboxException(shareResponse)
+  Client(authInfo).share(filename, recipients)
@@ -0,0 +1,159 @@
+from bitbox.common import *
+from bitbox.encryption import *
+from typing import BinaryIO, Tuple, Callable
+import tempfile
+import hashlib
+import shutil
+
+#
+# Parameters
+#
+
+STREAM_CHUNK_SIZE = 64 * 1024
+SPOOL_MAX_MEMORY = 8 * 1024 ** 2
+
+#
+# Types
+#
+
+# Called with the number of bytes transferred so far and the total number of bytes to transfer
+ProgressCallback = Callable[[int, int], None]
+
+#
+# Utility functions
+#
+
+def isSeekable(fileobj: BinaryIO) -> bool:
+  try:
+    return fileobj.seekable()
+  except Exception:
+    return False
+
+def hashFileobj(fileobj: BinaryIO) -> Tuple[BinaryIO, str, int]:
+  """
+  Hash a stream and measure its length, reading it in bounded chunks. Seekable streams are
+  rewound to where they started; other streams are spooled to a temporary file (kept in memory if
+  small), which is returned in their place.
+
+  :returns: A tuple of a stream positioned at the start of the data, the SHA-256 hash of the data
+    and its length in bytes.
+  """
+  hasher = hashlib.sha256()
+  length = 0
+  if isSeekable(fileobj):
+    start = fileobj.tell()
+    while True:
+      chunk = fileobj.read(STREAM_CHUNK_SIZE)
+      if not chunk:
+        break
+      hasher.update(chunk)
+      length += len(chunk)
+    fileobj.seek(start)
+    return fileobj, hasher.hexdigest(), length
+  else:
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    while True:
+      chunk = fileobj.read(STREAM_CHUNK_SIZE)
+      if not chunk:
+        break
+      hasher.update(chunk)
+      length += len(chunk)
+      spool.write(chunk)
+    spool.seek(0)
+    return spool, hasher.hexdigest(), length
+
+#
+# Readers
+#
+
+class EncryptingReader:
+  """
+  A file-like object that reads plaintext from a stream and yields its framed encryption, one
+  frame at a time. Its length is known in advance, so it can be used as the body of an upload
+  request without holding the whole encrypted blob in memory.
+  """
+  __fileobj: BinaryIO
+  __encryptor: FrameEncryptor
+  __length: int
+  __buffer: bytearray
+  __sent: int
+  __done: bool
+  __progress: Optional[ProgressCallback]
+
+  def __init__(self, fileobj: BinaryIO, fileKey: bytes, plaintextLength: int, frameSize: int = DEFAULT_FRAME_SIZE, progress: Optional[ProgressCallback] = None):
+    self.__fileobj = fileobj
+    self.__encryptor = FrameEncryptor(fileKey, frameSize)
+    self.__length = framedLength(plaintextLength, frameSize)
+    self.__buffer = bytearray()
+    self.__sent = 0
+    self.__done = False
+    self.__progress = progress
+
+  def __len__(self) -> int:
+    return self.__length
+
+  def read(self, size: int = -1) -> bytes:
+    # Encrypt more of the stream until there is enough to return
+    while not self.__done and (size < 0 or len(self.__buffer) < size):
+      chunk = self.__fileobj.read(self.__encryptor.frameSize)
+      if chunk:
+        self.__buffer += self.__encryptor.update(chunk)
+      else:
+        self.__buffer += self.__encryptor.finish()
+        self.__done = True
+
+    if size < 0:
+      size = len(self.__buffer)
+    data = bytes(self.__buffer[:size])
+    del self.__buffer[:size]
+    self.__sent += len(data)
+    if self.__progress is not None and len(data) > 0:
+      self.__progress(self.__sent, self.__length)
+    return data
+
+class DecryptingWriter:
+  """
+  Decrypts an encrypted blob as it arrives and writes the plaintext to a stream, hashing it on the
+  way. Framed blobs are decrypted frame by frame; legacy blobs, which are a single Fernet token,
+  have to be buffered until the end.
+  """
+  __fileobj: BinaryIO
+  __fileKey: bytes
+  __decryptor: Optional[FrameDecryptor]
+  __buffer: bytearray
+  __hasher: "hashlib._Hash"
+
+  def __init__(self, fileobj: BinaryIO, fileKey: bytes):
+    self.__fileobj = fileobj
+    self.__fileKey = fileKey
+    self.__decryptor = None
+    self.__buffer = bytearray()
+    self.__hasher = hashlib.sha256()
+
+  def __output(self, data: bytes) -> None:
+    if data:
+      self.__hasher.update(data)
+      self.__fileobj.write(data)
+
+  def write(self, data: bytes) -> None:
+    if self.__decryptor is not None:
+      self.__output(self.__decryptor.update(data))
+      return
+
+    # Wait until there are enough bytes to tell which format the blob is in
+    self.__buffer += data
+    if len(self.__buffer) >= len(FRAMED_MAGIC) and isFramed(bytes(self.__buffer)):
+      self.__decryptor = FrameDecryptor(self.__fileKey)
+      self.__output(self.__decryptor.update(bytes(self.__buffer)))
+      self.__buffer = bytearray()
+
+  def finish(self) -> str:
+    """
+    Finish decrypting, and return the SHA-256 hash of the plaintext.
+    """
+    if self.__decryptor is not None:
+      self.__decryptor.finish()
+    else:
+      self.__output(decryptContents(bytes(self.__buffer), self.__fileKey))
+      self.__buffer = bytearray()
+    return self.__hasher.hexdigest()
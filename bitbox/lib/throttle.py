@@ -0,0 +1,246 @@
+from bitbox.common import *
+from typing import BinaryIO, Union, List, Tuple
+from datetime import datetime
+import threading
+import asyncio
+import time
+import io
+import os
+import re
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+#
+# Parameters
+#
+
+RATE_UNITS = { "": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3 }
+UNLIMITED_RATES = ["unlimited", "none", "off"]
+
+# Transfers take their turn in pieces of this many bytes, so transfers that share a bucket take
+# turns at a fine grain however large their reads and writes are
+THROTTLE_QUANTUM = 64 * 1024
+
+#
+# Rate schedule
+#
+
+class RateSchedule:
+  """
+  The rate that transfers are limited to at each time of day. Each window covers the minutes from
+  its start up to its end, wrapping around midnight if it ends before it starts, and the first
+  window that covers a time sets the rate then. Outside of every window, the default rate applies.
+  A rate of None means that transfers aren't limited.
+  """
+  windows: List[Tuple[int, int, Optional[float]]]
+  default: Optional[float]
+
+  def __init__(self, windows: List[Tuple[int, int, Optional[float]]], default: Optional[float]):
+    self.windows = windows
+    self.default = default
+
+  def rateAt(self, when: datetime) -> Optional[float]:
+    minute = when.hour * 60 + when.minute
+    for start, end, rate in self.windows:
+      if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+        return rate
+    return self.default
+
+  def scaled(self, factor: float) -> "RateSchedule":
+    """
+    :returns: The same schedule with every rate multiplied by the factor.
+    """
+    scale = lambda rate: None if rate is None else max(1, rate * factor)
+    return RateSchedule([(start, end, scale(rate)) for start, end, rate in self.windows], scale(self.default))
+
+  def __str__(self) -> str:
+    # Render the schedule in the syntax that `parseSchedule` reads
+    renderRate = lambda rate: "unlimited" if rate is None else str(int(rate))
+    renderMinute = lambda minute: f"{minute // 60:02d}:{minute % 60:02d}"
+    entries = [f"{renderMinute(start)}-{renderMinute(end)}={renderRate(rate)}" for start, end, rate in self.windows]
+    if self.default is not None or len(entries) == 0:
+      entries.append(renderRate(self.default))
+    return ",".join(entries)
+
+#
+# Token bucket
+#
+
+class TokenBucket:
+  """
+  Limits the rate of transfers to a number of bytes per second, following a schedule. Every transfer
+  reserves its turn to send or receive each piece of data, waiting until then, and turns are handed
+  out in the order they are asked for, so transfers that share a bucket share its rate fairly. Time
+  that the bucket is idle builds up to a second's worth of data that can be sent at once. It is
+  thread-safe, and can be shared by threads and coroutines alike. A bucket kept in a file is shared
+  by every process that opens it with the same file as well.
+  """
+  schedule: RateSchedule
+  path: Optional[str]
+  __next: float
+  __lock: threading.Lock
+
+  def __init__(self, rate: Union[float, RateSchedule], path: Optional[str] = None):
+    """
+    :param rate: Bytes per second, or a schedule of them.
+    :param path: File to keep the turns in, so that other processes can share the bucket, or None to
+      keep them in memory. Files can only be shared where `fcntl` is available.
+    """
+    self.schedule = rate if isinstance(rate, RateSchedule) else RateSchedule([], rate)
+    self.path = path if fcntl is not None else None
+    self.__next = time.monotonic()
+    self.__lock = threading.Lock()
+
+  def reserve(self, count: int) -> float:
+    """
+    Reserve a turn for a number of bytes.
+
+    :returns: The number of seconds to wait before sending or receiving them.
+    """
+    rate = self.schedule.rateAt(datetime.now())
+    if rate is None:
+      return 0.0
+    with self.__lock:
+      if self.path is not None:
+        return self.__reserveShared(count, rate)
+      now = time.monotonic()
+      self.__next = max(self.__next, now - 1.0) + count / rate
+      return max(0.0, self.__next - now)
+
+  def __reserveShared(self, count: int, rate: float) -> float:
+    # The file holds when the next turn starts on the wall clock, which every process agrees on, and
+    # is locked while it is moved along
+    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      try:
+        last = float(os.read(fd, 64).decode("ascii") or 0)
+      except ValueError:
+        last = 0.0
+      now = time.time()
+      turn = max(last, now - 1.0) + count / rate
+      os.ftruncate(fd, 0)
+      os.pwrite(fd, repr(turn).encode("ascii"), 0)
+    finally:
+      # Closing the file releases the lock
+      os.close(fd)
+    return max(0.0, turn - now)
+
+  def consume(self, count: int) -> None:
+    """
+    Wait for turns for a number of bytes.
+    """
+    for offset in range(0, count, THROTTLE_QUANTUM):
+      delay = self.reserve(min(THROTTLE_QUANTUM, count - offset))
+      if delay > 0:
+        time.sleep(delay)
+
+  async def consumeAsync(self, count: int) -> None:
+    """
+    Wait for turns for a number of bytes, without blocking the event loop. See `consume`.
+    """
+    for offset in range(0, count, THROTTLE_QUANTUM):
+      delay = self.reserve(min(THROTTLE_QUANTUM, count - offset))
+      if delay > 0:
+        await asyncio.sleep(delay)
+
+class ThrottledReader:
+  """
+  A file-like object that reads from a blob or another file-like object of known length, taking
+  tokens from a bucket for every byte read, so it can be used as the body of an upload request.
+  """
+  __fileobj: BinaryIO
+  __length: int
+  __bucket: TokenBucket
+
+  def __init__(self, blob: Union[bytes, BinaryIO], bucket: TokenBucket):
+    self.__fileobj = io.BytesIO(blob) if isinstance(blob, bytes) else blob
+    self.__length = len(blob)
+    self.__bucket = bucket
+
+  def __len__(self) -> int:
+    return self.__length
+
+  def read(self, size: int = -1) -> bytes:
+    data = self.__fileobj.read(size)
+    self.__bucket.consume(len(data))
+    return data
+
+async def throttledChunks(blob: bytes, bucket: TokenBucket):
+  """
+  Yield a blob in pieces, waiting for a turn for each, so it can be used as the body of an upload
+  request made with aiohttp.
+  """
+  for offset in range(0, len(blob), THROTTLE_QUANTUM):
+    chunk = blob[offset:offset + THROTTLE_QUANTUM]
+    await bucket.consumeAsync(len(chunk))
+    yield chunk
+
+#
+# Utility functions
+#
+
+def parseRate(rate: str) -> Optional[int]:
+  """
+  Parse a rate in bytes per second, optionally with a suffix of 'k', 'M' or 'G' for KiB, MiB or GiB.
+
+  :returns: The rate, or None for 'unlimited'.
+  :raises ValueError: If the rate is not valid.
+  """
+  if rate.strip().lower() in UNLIMITED_RATES:
+    return None
+  match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmg]?)(?:i?b)?(?:/s)?\s*", rate, re.IGNORECASE)
+  if match is None or float(match[1]) <= 0:
+    raise ValueError(f"Invalid rate '{rate}'.")
+  return max(1, int(float(match[1]) * RATE_UNITS[match[2].lower()]))
+
+def parseSchedule(schedule: str) -> RateSchedule:
+  """
+  Parse a schedule of rates, as a comma-separated list of rates for windows of the day, like
+  '09:00-18:00=512k', and optionally a rate for the rest of the day, like '09:00-18:00=512k,4M'.
+  A single rate applies all day.
+
+  :raises ValueError: If the schedule is not valid.
+  """
+  windows = []
+  default = None
+  for entry in schedule.split(","):
+    match = re.fullmatch(r"\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=(.*)", entry)
+    if match is None:
+      default = parseRate(entry)
+      continue
+    startHour, startMinute, endHour, endMinute = [int(part) for part in match.groups()[:4]]
+    if startMinute > 59 or endMinute > 59 or startHour * 60 + startMinute > 24 * 60 or endHour * 60 + endMinute > 24 * 60:
+      raise ValueError(f"Invalid time window in '{entry}'.")
+    windows.append((startHour * 60 + startMinute, endHour * 60 + endMinute, parseRate(match[5])))
+  return RateSchedule(windows, default)
+
+__defaultThrottle: Optional[TokenBucket] = None
+__defaultThrottleLoaded = False
+__defaultThrottleLock = threading.Lock()
+
+def defaultThrottle() -> Optional[TokenBucket]:
+  """
+  :returns: The bucket shared by every transfer in the process, which follows the schedule in
+    `BITBOX_LIMIT_RATE`, kept in `BITBOX_LIMIT_RATE_FILE` if it is set, unless another has been set
+    with `setDefaultThrottle`, or None if transfers are not limited.
+  """
+  global __defaultThrottle, __defaultThrottleLoaded
+  with __defaultThrottleLock:
+    if not __defaultThrottleLoaded and BITBOX_LIMIT_RATE:
+      __defaultThrottle = TokenBucket(parseSchedule(BITBOX_LIMIT_RATE), BITBOX_LIMIT_RATE_FILE)
+    __defaultThrottleLoaded = True
+    return __defaultThrottle
+
+def setDefaultThrottle(throttle: Optional[TokenBucket]) -> None:
+  """
+  Set the bucket shared by every transfer in the process. Clients that have already been created
+  keep the bucket they started with.
+  """
+  global __defaultThrottle, __defaultThrottleLoaded
+  with __defaultThrottleLock:
+    __defaultThrottle = throttle
+    __defaultThrottleLoaded = True
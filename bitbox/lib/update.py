@@ -0,0 +1,41 @@
+from bitbox.common import *
+from bitbox.lib.client import Client
+from bitbox.lib.stream import ProgressCallback
+from typing import BinaryIO
+
+def update(blob: bytes, filename: str, authInfo: AuthInfo) -> bool:
+  """
+  Replace the contents of one of the user's files in place. See `update_fileobj`.
+
+  :param blob: The new contents of the file.
+  :param filename: Remote filename of the file.
+  :param authInfo: Authentication information.
+
+  :returns: Whether the contents were uploaded, which they aren't if the file already has them.
+  """
+  return Client(authInfo).update(blob, filename)
+
+def update_fileobj(fileobj: BinaryIO, filename: str, authInfo: AuthInfo, progress: Optional[ProgressCallback] = None) -> bool:
+  """
+  Replace the contents of one of the user's files in place with the contents of a readable binary
+  stream. Unlike uploading with `overwrite = True`, the file keeps its ID and its key, so it stays
+  shared with everyone it was shared with. If the file already has these contents, nothing is
+  uploaded.
+
+  :param fileobj: Readable binary stream to upload, from its current position to the end.
+  :param filename: Remote filename of the file.
+  :param authInfo: Authentication information.
+  :param progress: Called with the number of bytes sent so far and the total number of bytes to send.
+
+  :raises FileNotFoundException: If the file doesn't exist.
+  :raises FileTooLargeException: If the new contents are too large to upload.
+  :raises FileNotReadyException: If the file is being modified elsewhere.
+  :raises UploadException: If the upload failed.
+  :raises DecryptionException: If the password to decrypt the private key is incorrect.
+  :raises AuthenticationException: If login failed with the server.
+  :raises InvalidVersionException: If the server no longer supports the current version of Bitbox.
+  :raises BitboxException: Any other exception indicating an bug in Bitbox.
+
+  :returns: Whether the contents were uploaded, which they aren't if the file already has them.
+  """
+  return Client(authInfo).update_fileobj(fileobj, filename, progress)
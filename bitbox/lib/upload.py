@@ -1,19 +1,18 @@
 from bitbox.common import *
-from bitbox.encryption import getPublicKey, rsaEncrypt
-from bitbox.lib.exceptions import *
-import bitbox.server as server
-from cryptography.fernet import Fernet
-import binascii
-import requests
-import hashlib
+from bitbox.lib.client import Client
+from bitbox.lib.stream import ProgressCallback
+from typing import BinaryIO
 
 def upload(blob: bytes, filename: str, authInfo: AuthInfo, overwrite: bool = False):
   """
-  Upload a blob to the server.
+  Upload a blob to the server. With overwrite = True, an existing file with the same name has its
+  contents replaced in place, so it keeps its key and stays shared with everyone it was shared
+  with, and nothing is uploaded if it already has these contents.
 
   :param blob: Contents of the blob to upload.
   :param filename: Remote filename for the blob.
   :param authInfo: Authentication information.
+  :param overwrite: Whether to replace an existing file with the same name.
 
   :raises FileTooLargeException: If the file is too large to upload.
   :raises FileExistsException: If overwrite = False and a file with the same name already exists.
@@ -23,76 +22,63 @@ def upload(blob: bytes, filename: str, authInfo: AuthInfo, overwrite: bool = Fal
   :raises InvalidVersionException: If the server no longer supports the current version of Bitbox.
   :raises BitboxException: Any other exception indicating an bug in Bitbox.
   """
+  Client(authInfo).upload(blob, filename, overwrite)
 
-  # Create a hash of the blob
-  blobHash = hashlib.sha256(blob).hexdigest()
+def upload_fileobj(fileobj: BinaryIO, filename: str, authInfo: AuthInfo, overwrite: bool = False, progress: Optional[ProgressCallback] = None):
+  """
+  Upload the contents of a readable binary stream to the server. The stream is read, encrypted and
+  sent in bounded chunks, so it is never held in memory as a whole. Streams that can't be rewound,
+  such as pipes and sockets, are spooled to a temporary file first, since the server needs the hash
+  of the contents before the upload starts.
 
-  # Encrypt the blob with a random key
-  fileKey = Fernet.generate_key()
-  encryptedBlob = Fernet(fileKey).encrypt(blob)
+  :param fileobj: Readable binary stream to upload, from its current position to the end.
+  :param filename: Remote filename for the blob.
+  :param authInfo: Authentication information.
+  :param overwrite: Whether to replace an existing file with the same name, in place. See `upload`.
+  :param progress: Called with the number of bytes sent so far and the total number of bytes to send.
 
-  # Get the user's public key
-  publicKey = getPublicKey(authInfo.keyInfo)
+  :raises FileTooLargeException: If the file is too large to upload.
+  :raises FileExistsException: If overwrite = False and a file with the same name already exists.
+  :raises UploadException: If the upload failed.
+  :raises DecryptionException: If the password to decrypt the private key is incorrect.
+  :raises AuthenticationException: If login failed with the server.
+  :raises InvalidVersionException: If the server no longer supports the current version of Bitbox.
+  :raises BitboxException: Any other exception indicating an bug in Bitbox.
+  """
+  Client(authInfo).upload_fileobj(fileobj, filename, overwrite, progress)
 
-  # Encrypt the file key with the user's public key
-  personalEncryptedKey = rsaEncrypt(fileKey, publicKey)
-  personalEncryptedKeyHex = binascii.hexlify(personalEncryptedKey).decode("utf-8")
+def upload_file(path: str, authInfo: AuthInfo, filename: Optional[str] = None, overwrite: bool = False, progress: Optional[ProgressCallback] = None):
+  """
+  Upload a local file to the server, streaming it in bounded chunks. See `upload_fileobj`.
 
-  # Tell the server we want to add this file, and get the file ID and URL to upload to
-  prepareStoreResponse = server.prepareStore(filename, len(encryptedBlob), blobHash, personalEncryptedKeyHex, authInfo)
-  if isinstance(prepareStoreResponse, server.Error):
-    # Check if this is a FILE_EXISTS error
-    if prepareStoreResponse == server.Error.FILE_EXISTS:
-      if overwrite:
-        # If the file already exists and overwrite = True, delete the file and try again
-        fileInfo = server.fileInfo(filename, authInfo.keyInfo.username, authInfo)
-        if isinstance(fileInfo, server.Error):
-          raise BitboxException(fileInfo)
-        fileId = fileInfo.fileId
-        deleteResponse = server.delete(fileId, authInfo)
-        if isinstance(deleteResponse, server.Error):
-          raise BitboxException(deleteResponse)
-        prepareStoreResponse = server.prepareStore(filename, len(encryptedBlob), blobHash, personalEncryptedKeyHex, authInfo)
+  :param path: Path of the local file to upload.
+  :param authInfo: Authentication information.
+  :param filename: Remote filename for the blob. Defaults to the name of the local file.
+  :param overwrite: Whether to replace an existing file with the same name.
+  :param progress: Called with the number of bytes sent so far and the total number of bytes to send.
+  """
+  Client(authInfo).upload_file(path, filename, overwrite, progress)
 
-        # If that still fails, throw an error
-        if isinstance(prepareStoreResponse, server.Error):
-          raise BitboxException(prepareStoreResponse)
-      else:
-        # Otherwise, raise an error
-        raise FileExistsException(filename)
-    elif prepareStoreResponse == server.Error.FILE_TOO_LARGE:
-      # If it's any other error, raise the appropriate error
-      raise FileTooLargeException()
-    else:
-      raise BitboxException(prepareStoreResponse)
-  
-  # Grab parameters from the prepareStore response
-  fileId = prepareStoreResponse.fileId
-  uploadURL = prepareStoreResponse.uploadURL
-  
-  # Create a resumable session from the prepareStore response
-  resumableSession = requests.post(uploadURL, "", headers={
-      "x-goog-resumable": "start",
-      "content-type": "text/plain",
-      "x-goog-content-length-range": f"0,{len(encryptedBlob)}"
-  })
-  if resumableSession.status_code != 201:
-    raise UploadException()
+def upload_stream(fileobj: BinaryIO, filename: str, authInfo: AuthInfo, overwrite: bool = False):
+  """
+  Upload a stream of unknown length to the server, such as a pipe, starting the upload before the
+  stream ends. The stream is read in segments, each of which is encrypted and uploaded as soon as
+  it has been read, while the next segments are read, and the file is stored in delta mode as a
+  manifest of the segments, which is uploaded once the stream ends. Only a few segments are ever
+  held in memory. Downloads of the file write each segment as soon as it arrives.
 
-  # Get the location to upload to
-  location = resumableSession.headers["location"]
+  :param fileobj: Readable binary stream to upload, from its current position to the end.
+  :param filename: Remote filename for the blob.
+  :param authInfo: Authentication information.
+  :param overwrite: Whether to replace an existing file with the same name, in place, keeping its
+    key and sharing the new segments with everyone it is shared with.
 
-  # Upload to that location via a PUT request
-  uploadResponse = requests.put(location, data=encryptedBlob, headers={
-    "content-type": "text/plain",
-    "content-length": str(len(encryptedBlob))
-  })
-  
-  # Check if the upload was successful
-  if uploadResponse.status_code != 200:
-    raise UploadException()
-  
-  # Tell the server we're done uploading
-  storeResponse = server.store(fileId, authInfo)
-  if isinstance(storeResponse, server.Error):
-    raise BitboxException(storeResponse)
+  :raises FileTooLargeException: If the file is too large to upload.
+  :raises FileExistsException: If overwrite = False and a file with the same name already exists.
+  :raises UploadException: If the upload failed.
+  :raises DecryptionException: If the password to decrypt the private key is incorrect.
+  :raises AuthenticationException: If login failed with the server.
+  :raises InvalidVersionException: If the server no longer supports the current version of Bitbox.
+  :raises BitboxException: Any other exception indicating an bug in Bitbox.
+  """
+  Client(authInfo).upload_stream(fileobj, filename, overwrite)
@@ -0,0 +1,232 @@
+from bitbox.parameters import *
+from typing import Dict, List, Tuple, Optional
+import threading
+import atexit
+import json
+import time
+import os
+
+#
+# Parameters
+#
+
+DEFAULT_LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+#
+# Types
+#
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def toLabels(labels: Dict[str, str]) -> Labels:
+  return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def renderLabels(labels: Labels, extra: Dict[str, str] = {}) -> str:
+  pairs = list(labels) + list(extra.items())
+  if len(pairs) == 0:
+    return ""
+  escaped = [(key, value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for key, value in pairs]
+  return "{" + ",".join(f"{key}=\"{value}\"" for key, value in escaped) + "}"
+
+#
+# Metrics
+#
+
+class Counter:
+  name: str
+  help: str
+  __values: Dict[Labels, float]
+  __lock: threading.Lock
+
+  def __init__(self, name: str, help: str):
+    self.name = name
+    self.help = help
+    self.__values = {}
+    self.__lock = threading.Lock()
+
+  def inc(self, amount: float = 1, **labels: str) -> None:
+    key = toLabels(labels)
+    with self.__lock:
+      self.__values[key] = self.__values.get(key, 0) + amount
+
+  def get(self, **labels: str) -> float:
+    with self.__lock:
+      return self.__values.get(toLabels(labels), 0)
+
+  def samples(self) -> List[Tuple[Labels, float]]:
+    with self.__lock:
+      return list(self.__values.items())
+
+  def toPrometheus(self) -> List[str]:
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+    for labels, value in self.samples():
+      lines.append(f"{self.name}{renderLabels(labels)} {value}")
+    return lines
+
+  def toJSON(self) -> dict:
+    return {
+      "type": "counter",
+      "help": self.help,
+      "samples": [{ "labels": dict(labels), "value": value } for labels, value in self.samples()]
+    }
+
+class Histogram:
+  name: str
+  help: str
+  buckets: List[float]
+  __values: Dict[Labels, Tuple[List[int], float, int]]
+  __lock: threading.Lock
+
+  def __init__(self, name: str, help: str, buckets: List[float] = DEFAULT_LATENCY_BUCKETS):
+    self.name = name
+    self.help = help
+    self.buckets = sorted(buckets)
+    self.__values = {}
+    self.__lock = threading.Lock()
+
+  def observe(self, value: float, **labels: str) -> None:
+    key = toLabels(labels)
+    with self.__lock:
+      counts, total, count = self.__values.get(key, ([0] * len(self.buckets), 0.0, 0))
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          counts[i] += 1
+      self.__values[key] = (counts, total + value, count + 1)
+
+  def time(self, **labels: str) -> "Timer":
+    return Timer(self, labels)
+
+  def samples(self) -> List[Tuple[Labels, List[int], float, int]]:
+    with self.__lock:
+      return [(labels, list(counts), total, count) for labels, (counts, total, count) in self.__values.items()]
+
+  def toPrometheus(self) -> List[str]:
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+    for labels, counts, total, count in self.samples():
+      for bound, bucketCount in zip(self.buckets, counts):
+        lines.append(f"{self.name}_bucket{renderLabels(labels, { 'le': repr(bound) })} {bucketCount}")
+      lines.append(f"{self.name}_bucket{renderLabels(labels, { 'le': '+Inf' })} {count}")
+      lines.append(f"{self.name}_sum{renderLabels(labels)} {total}")
+      lines.append(f"{self.name}_count{renderLabels(labels)} {count}")
+    return lines
+
+  def toJSON(self) -> dict:
+    return {
+      "type": "histogram",
+      "help": self.help,
+      "buckets": self.buckets,
+      "samples": [
+        { "labels": dict(labels), "counts": counts, "sum": total, "count": count }
+        for labels, counts, total, count in self.samples()
+      ]
+    }
+
+class Timer:
+  __histogram: Histogram
+  __labels: Dict[str, str]
+  __start: float
+
+  def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+    self.__histogram = histogram
+    self.__labels = labels
+
+  def __enter__(self) -> "Timer":
+    self.__start = time.monotonic()
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.__histogram.observe(time.monotonic() - self.__start, **self.__labels)
+
+#
+# Registry
+#
+
+class Registry:
+  __metrics: Dict[str, object]
+  __lock: threading.Lock
+
+  def __init__(self):
+    self.__metrics = {}
+    self.__lock = threading.Lock()
+
+  def counter(self, name: str, help: str) -> Counter:
+    with self.__lock:
+      if name not in self.__metrics:
+        self.__metrics[name] = Counter(name, help)
+      return self.__metrics[name]
+
+  def histogram(self, name: str, help: str, buckets: List[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+    with self.__lock:
+      if name not in self.__metrics:
+        self.__metrics[name] = Histogram(name, help, buckets)
+      return self.__metrics[name]
+
+  def toPrometheus(self) -> str:
+    """
+    Render every metric in the Prometheus text exposition format, as read by the node_exporter
+    textfile collector.
+    """
+    with self.__lock:
+      metrics = list(self.__metrics.values())
+    lines = []
+    for metric in metrics:
+      lines += metric.toPrometheus()
+    return "\n".join(lines) + "\n"
+
+  def toJSON(self) -> str:
+    with self.__lock:
+      metrics = dict(self.__metrics)
+    return json.dumps({ name: metric.toJSON() for name, metric in metrics.items() }, indent=2)
+
+  def dump(self, path: str, format: Optional[str] = None) -> None:
+    """
+    Write all metrics to a file. The file is written atomically so that a scraper never sees a
+    partially written file.
+
+    :param path: Path of the file to write.
+    :param format: Either "prometheus" or "json". If None, the format is inferred from the file
+      extension, defaulting to Prometheus.
+    """
+    if format is None:
+      format = "json" if path.endswith(".json") else "prometheus"
+    contents = self.toJSON() if format == "json" else self.toPrometheus()
+    tempPath = f"{path}.{os.getpid()}.tmp"
+    with open(tempPath, "w") as f:
+      f.write(contents)
+    os.replace(tempPath, path)
+
+#
+# Global registry
+#
+
+registry = Registry()
+
+bytesUploaded = registry.counter("bitbox_bytes_uploaded_total",
+  "Encrypted bytes sent to the storage backend.")
+bytesDownloaded = registry.counter("bitbox_bytes_downloaded_total",
+  "Encrypted bytes received from the storage backend.")
+rpcLatency = registry.histogram("bitbox_rpc_latency_seconds",
+  "Latency of calls to the Bitbox API, by endpoint.")
+rpcErrors = registry.counter("bitbox_rpc_errors_total",
+  "Calls to the Bitbox API that did not return a successful status, by endpoint.")
+reauthentications = registry.counter("bitbox_reauthentications_total",
+  "Sessions re-established after the server rejected an expired session.")
+hashMismatches = registry.counter("bitbox_hash_mismatches_total",
+  "Transfers aborted because the decrypted content did not match the expected hash.")
+cacheRequests = registry.counter("bitbox_cache_requests_total",
+  "Cache lookups, by cache and result (hit or miss).")
+localCopies = registry.counter("bitbox_local_copies_total",
+  "Local copies of files that were already on disk, by method (reflink, copy_file_range, sendfile or userspace).")
+
+def recordCacheLookup(cache: str, hit: bool) -> None:
+  cacheRequests.inc(cache=cache, result="hit" if hit else "miss")
+
+def dumpAtExit() -> None:
+  try:
+    registry.dump(BITBOX_METRICS_FILE)
+  except Exception:
+    # Metrics should never cause the program to fail
+    pass
+
+if BITBOX_METRICS_FILE:
+  atexit.register(dumpAtExit)
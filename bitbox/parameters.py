@@ -7,3 +7,24 @@ BITBOX_STATUS_OK = 200
 
 # A unique hex string for each time the program is run, used for logging
 CURRENT_CONTEXT = hex(round(time.time() * 1000))[2:]
+
+# If set, metrics are written to this file when the program exits (JSON if it ends in .json,
+# otherwise the Prometheus text format)
+BITBOX_METRICS_FILE = os.environ.get("BITBOX_METRICS_FILE")
+
+# Local cache of downloaded files, keyed by the hash of their contents. Setting the size to 0
+# disables the cache
+BITBOX_CACHE_FOLDER = os.environ.get("BITBOX_CACHE_FOLDER") or os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "bitbox")
+BITBOX_CACHE_MAX_SIZE = int(os.environ.get("BITBOX_CACHE_MAX_SIZE") or 512 * 1024 ** 2)
+
+# Storage each user has on the server. Uploads that clearly can't fit are rejected before anything
+# is encrypted, although the server has the final say
+BITBOX_STORAGE_LIMIT = int(os.environ.get("BITBOX_STORAGE_LIMIT") or 1024 ** 3)
+
+# If set, uploads and downloads in each process are limited to this many bytes per second, with an
+# optional suffix of k, M or G
+BITBOX_LIMIT_RATE = os.environ.get("BITBOX_LIMIT_RATE")
+
+# If set, the limit is shared with every other process that sets this to the same file, instead of
+# applying to each process on its own
+BITBOX_LIMIT_RATE_FILE = os.environ.get("BITBOX_LIMIT_RATE_FILE")
@@ -0,0 +1,395 @@
+from bitbox.parameters import *
+from bitbox.common import *
+from bitbox.server.api import \
+  Error, \
+  BitboxException, \
+  InvalidVersionException, \
+  AuthenticationException, \
+  UserNotFoundException, \
+  UserInfoResponse, \
+  PrepareStoreResponse, \
+  PrepareUpdateResponse, \
+  SaveResponse, \
+  FileInfoResponse, \
+  FilesInfoResponse
+import bitbox.encryption as encryption
+import bitbox.metrics as metrics
+import aiohttp
+import asyncio
+from multidict import CIMultiDict
+from dataclasses import dataclass
+from typing import Dict, Union, Any, Mapping
+import binascii
+import json
+
+#
+# Parameters
+#
+
+DEFAULT_MAX_CONCURRENCY = 32
+
+#
+# Connection
+#
+
+class AsyncConnection:
+  """
+  An asyncio connection to a Bitbox server. Requests share one pool of HTTP connections, and at
+  most `maxConcurrency` requests (API calls and storage transfers together) are in flight at once.
+  Must be used from a single event loop, and closed with `close()` or `async with`.
+  """
+  host: str
+  maxConcurrency: int
+  semaphore: asyncio.Semaphore
+  sessionLock: asyncio.Lock
+  __pool: Optional[aiohttp.ClientSession]
+
+  def __init__(self, host: str = BITBOX_HOST, maxConcurrency: int = DEFAULT_MAX_CONCURRENCY):
+    self.host = host
+    self.maxConcurrency = maxConcurrency
+    self.semaphore = asyncio.Semaphore(maxConcurrency)
+    self.sessionLock = asyncio.Lock()
+    self.__pool = None
+
+  @property
+  def pool(self) -> aiohttp.ClientSession:
+    if self.__pool is None:
+      # Sessions are passed explicitly, so cookies set by the server should not be remembered
+      self.__pool = aiohttp.ClientSession(
+        cookie_jar=aiohttp.DummyCookieJar(),
+        connector=aiohttp.TCPConnector(limit=self.maxConcurrency))
+    return self.__pool
+
+  def url(self, path: str) -> str:
+    return f"http://{self.host}{path}"
+
+  async def close(self) -> None:
+    if self.__pool is not None:
+      await self.__pool.close()
+      self.__pool = None
+
+  async def __aenter__(self) -> "AsyncConnection":
+    return self
+
+  async def __aexit__(self, *args) -> None:
+    await self.close()
+
+@dataclass
+class AsyncResponse:
+  status_code: int
+  text: str
+  headers: Mapping[str, str]
+  content: bytes
+
+  def json(self) -> Any:
+    return json.loads(self.text)
+
+async def fetch(connection: AsyncConnection, method: str, url: str, **kwargs) -> AsyncResponse:
+  """
+  Make a request through the connection's pool, respecting its concurrency limit, and read the
+  whole response.
+  """
+  async with connection.semaphore:
+    async with connection.pool.request(method, url, **kwargs) as response:
+      content = await response.read()
+      return AsyncResponse(
+        status_code=response.status,
+        text=content.decode("utf-8", errors="replace"),
+        headers=CIMultiDict(response.headers),
+        content=content)
+
+#
+# Helper Functions
+#
+
+async def sendRequest(method: str, path: str, connection: AsyncConnection, **kwargs) -> AsyncResponse:
+  # Time the request and record it under the endpoint's path
+  with metrics.rpcLatency.time(endpoint=path):
+    response = await fetch(connection, method, connection.url(path), **kwargs)
+  if response.status_code != BITBOX_STATUS_OK:
+    metrics.rpcErrors.inc(endpoint=path)
+  return response
+
+async def requestWithSession(method: str, path: str, body: Any, authInfo: AuthInfo, connection: AsyncConnection) -> Union[AsyncResponse, Error]:
+  staleSession = authInfo.session
+  response = await sendRequest(method, path, connection, json=body, headers={"Cookie": staleSession})
+  if (response.status_code != BITBOX_STATUS_OK):
+    if response.text == Error.AUTHENTICATION_FAILED.value:
+      # Only one task re-establishes the session; the others reuse the session it creates
+      async with connection.sessionLock:
+        if authInfo.session == staleSession:
+          metrics.reauthentications.inc()
+          # Getting the private key can decrypt it or prompt for a password, so keep it off the event loop
+          privateKey = await asyncio.get_running_loop().run_in_executor(None, authInfo.getPrivateKey)
+          try:
+            authInfo.session = await establishSession(authInfo.keyInfo.username, privateKey, connection)
+          except Exception as e:
+            if e.args == (Error.AUTHENTICATION_FAILED,):
+              raise AuthenticationException()
+            else:
+              raise e
+
+      response = await sendRequest(method, path, connection, json=body, headers={"Cookie": authInfo.session})
+      if response.status_code == BITBOX_STATUS_OK:
+        return response
+      elif response.text == Error.AUTHENTICATION_FAILED.value:
+        raise AuthenticationException()
+      else:
+        return Error(response.text)
+    else:
+      return Error(response.text)
+  return response
+
+async def establishSession(username: str, privateKey: RSA.RsaKey, connection: AsyncConnection) -> str:
+  challengeStr = await challenge(username, connection)
+  if isinstance(challengeStr, Error):
+    raise AuthenticationException()
+
+  challengeBytes = bytearray.fromhex(challengeStr)
+  try:
+    loop = asyncio.get_running_loop()
+    answerBytes = await loop.run_in_executor(None, encryption.rsaDecrypt, challengeBytes, privateKey)
+  except:
+    raise AuthenticationException()
+  answer = binascii.hexlify(answerBytes).decode("utf-8")
+
+  session = await login(username, answer, connection)
+  if isinstance(session, Error):
+    if session == Error.AUTHENTICATION_FAILED:
+      raise AuthenticationException()
+    elif session == Error.USER_NOT_FOUND:
+      raise UserNotFoundException(username)
+    else:
+      raise BitboxException(session)
+  else:
+    return session
+
+#
+# Get User Info
+#
+
+async def userInfo(username: str, connection: AsyncConnection) -> Union[UserInfoResponse, Error]:
+  response = await sendRequest("POST", "/api/info/user", connection, json={ "username" : username })
+  if response.status_code == BITBOX_STATUS_OK:
+    return UserInfoResponse(**response.json())
+  elif response.text == Error.SERVER_SIDE_ERROR.value:
+    raise BitboxException(response.text)
+  else:
+    return Error(response.text)
+
+#
+# Challenge
+#
+
+async def challenge(username: str, connection: AsyncConnection) -> Union[str, Error]:
+  challengeBody = {
+    "username": username
+  }
+  response = await sendRequest("POST", "/api/auth/login/challenge", connection, json=challengeBody)
+  if response.status_code == BITBOX_STATUS_OK:
+    return response.text
+  elif response.text == Error.SERVER_SIDE_ERROR.value:
+    raise BitboxException(response.text)
+  else:
+    return Error(response.text)
+
+#
+# Login
+#
+
+async def login(username: str, challengeResponse: str, connection: AsyncConnection) -> Union[Session, Error]:
+  loginBody = {
+    "username": username,
+    "challengeResponse": challengeResponse,
+    "version": BITBOX_VERSION
+  }
+  response = await sendRequest("POST", "/api/auth/login/login", connection, json=loginBody)
+  if response.status_code == BITBOX_STATUS_OK:
+    return response.headers["Set-Cookie"]
+  elif response.text == Error.INVALID_VERSION.value:
+    raise InvalidVersionException()
+  elif response.text == Error.SERVER_SIDE_ERROR.value:
+    raise BitboxException(response.text)
+  else:
+    return Error(response.text)
+
+#
+# Prepare Store
+#
+
+async def prepareStore(filename: str, bytes: int, hash: str, personalEncryptedKey: str, authInfo: AuthInfo, connection: AsyncConnection) -> Union[PrepareStoreResponse, Error]:
+  prepareStoreBody = {
+    "filename": filename,
+    "bytes": bytes,
+    "hash": hash,
+    "personalEncryptedKey": personalEncryptedKey
+  }
+  response = await requestWithSession("POST",
+    "/api/storage/prepare-store",
+    prepareStoreBody,
+    authInfo,
+    connection)
+  if isinstance(response, Error):
+    if response == Error.SERVER_SIDE_ERROR:
+      raise BitboxException(response)
+    else:
+      return response
+  else:
+    return PrepareStoreResponse(**response.json())
+
+#
+# Prepare Update
+#
+
+async def prepareUpdate(fileId: str, bytes: int, hash: str, authInfo: AuthInfo, connection: AsyncConnection) -> Union[PrepareUpdateResponse, Error]:
+  prepareUpdateBody = {
+    "fileId": fileId,
+    "bytes": bytes,
+    "hash": hash
+  }
+  response = await requestWithSession("POST",
+    "/api/storage/prepare-update",
+    prepareUpdateBody,
+    authInfo,
+    connection)
+  if isinstance(response, Error):
+    if response == Error.SERVER_SIDE_ERROR:
+      raise BitboxException(response)
+    else:
+      return response
+  else:
+    return PrepareUpdateResponse(**response.json())
+
+#
+# Store
+#
+
+async def store(fileId: str, authInfo: AuthInfo, connection: AsyncConnection) -> Union[None, Error]:
+  storeBody = {
+    "fileId": fileId
+  }
+  response = await requestWithSession("POST",
+    "/api/storage/store",
+    storeBody,
+    authInfo,
+    connection)
+  if isinstance(response, Error):
+    if response == Error.SERVER_SIDE_ERROR:
+      raise BitboxException(response)
+    else:
+      return response
+
+#
+# Share
+#
+
+async def share(fileId: str, recipientEncryptedKeys: Dict[str, str], authInfo: AuthInfo, connection: AsyncConnection) -> Union[None, Error]:
+  shareBody = {
+    "fileId": fileId,
+    "recipientEncryptedKeys": recipientEncryptedKeys
+  }
+  response = await requestWithSession("POST",
+    "/api/storage/share",
+    shareBody,
+    authInfo,
+    connection)
+  if isinstance(response, Error):
+    if response == Error.SERVER_SIDE_ERROR:
+      raise BitboxException(response)
+    else:
+      return response
+
+#
+# Save
+#
+
+async def save(fileId: str, authInfo: AuthInfo, connection: AsyncConnection) -> Union[SaveResponse, Error]:
+  saveBody = {
+    "fileId": fileId
+  }
+  response = await requestWithSession("POST",
+    "/api/storage/save",
+    saveBody,
+    authInfo,
+    connection)
+  if isinstance(response, Error):
+    if response == Error.SERVER_SIDE_ERROR:
+      raise BitboxException(response)
+    else:
+      return response
+  else:
+    return SaveResponse(**response.json())
+
+#
+# Delete
+#
+
+async def delete(fileId: str, authInfo: AuthInfo, connection: AsyncConnection) -> Union[None, Error]:
+  deleteBody = {
+    "fileId": fileId
+  }
+  response = await requestWithSession("POST",
+    "/api/storage/delete",
+    deleteBody,
+    authInfo,
+    connection)
+  if isinstance(response, Error):
+    if response == Error.SERVER_SIDE_ERROR:
+      raise BitboxException(response)
+    else:
+      return response
+
+#
+# File Info
+#
+
+async def fileInfo(filename: str, owner: Optional[str], authInfo: AuthInfo, connection: AsyncConnection) -> Union[FileInfoResponse, Error]:
+  fileInfoBody = {
+    "filename": filename
+  }
+  if owner is not None:
+    fileInfoBody["owner"] = owner
+  response = await requestWithSession("POST",
+    "/api/info/file",
+    fileInfoBody,
+    authInfo,
+    connection)
+  if isinstance(response, Error):
+    if response == Error.SERVER_SIDE_ERROR:
+      raise BitboxException(response)
+    else:
+      return response
+  else:
+    return FileInfoResponse(**response.json())
+
+async def fileInfoById(fileId: str, authInfo: AuthInfo, connection: AsyncConnection) -> Union[FileInfoResponse, Error]:
+  fileInfoBody = {
+    "fileId": fileId
+  }
+  response = await requestWithSession("POST",
+    "/api/info/file",
+    fileInfoBody,
+    authInfo,
+    connection)
+  if isinstance(response, Error):
+    if response == Error.SERVER_SIDE_ERROR:
+      raise BitboxException(response)
+    else:
+      return response
+  else:
+    return FileInfoResponse(**response.json())
+
+#
+# Files Info
+#
+
+async def filesInfo(authInfo: AuthInfo, connection: AsyncConnection) -> FilesInfoResponse:
+  response = await requestWithSession("GET",
+    "/api/info/files",
+    None,
+    authInfo,
+    connection)
+  if isinstance(response, Error):
+    raise BitboxException(response)
+  else:
+    return [FileInfoResponse(**fileInfo) for fileInfo in response.json()]
@@ -1,9 +1,12 @@
 from bitbox.parameters import *
 from bitbox.common import *
 import bitbox.encryption as encryption
+import bitbox.metrics as metrics
 import requests
 from dataclasses import dataclass
 from typing import Dict, Union, List, Literal, Any
+import http.cookiejar
+import threading
 import enum
 import binascii
 
@@ -46,24 +49,67 @@ class Error(enum.Enum):
   INVALID_VERSION = "invalid-version"
   SERVER_SIDE_ERROR = "server-side-error"
 
+#
+# Connection
+#
+
+class Connection:
+  """
+  A connection to a Bitbox server. Keeps a pool of HTTP connections that is reused across requests,
+  both for API calls and for transfers to and from storage. Safe to share between threads.
+  """
+  host: str
+  pool: requests.Session
+  sessionLock: threading.Lock
+
+  def __init__(self, host: str = BITBOX_HOST):
+    self.host = host
+    self.pool = requests.Session()
+    self.sessionLock = threading.Lock()
+
+    # Sessions are passed explicitly, so cookies set by the server should not be remembered
+    self.pool.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+  def url(self, path: str) -> str:
+    return f"http://{self.host}{path}"
+
+# The connection used when none is specified
+defaultConnection = Connection()
+
 #
 # Helper Functions
 #
 
-def requestWithSession(method: str, url: str, body: Any, authInfo: AuthInfo) -> Union[requests.Response, Error]:
-  response = requests.request(method, url, json=body, headers={"Cookie": authInfo.session})
+def sendRequest(method: str, path: str, connection: Optional[Connection], **kwargs) -> requests.Response:
+  connection = connection or defaultConnection
+
+  # Time the request and record it under the endpoint's path
+  with metrics.rpcLatency.time(endpoint=path):
+    response = connection.pool.request(method, connection.url(path), **kwargs)
+  if response.status_code != BITBOX_STATUS_OK:
+    metrics.rpcErrors.inc(endpoint=path)
+  return response
+
+def requestWithSession(method: str, path: str, body: Any, authInfo: AuthInfo, connection: Optional[Connection] = None) -> Union[requests.Response, Error]:
+  connection = connection or defaultConnection
+  staleSession = authInfo.session
+  response = sendRequest(method, path, connection, json=body, headers={"Cookie": staleSession})
   if (response.status_code != BITBOX_STATUS_OK):
     if response.text == Error.AUTHENTICATION_FAILED.value:
-      privateKey = authInfo.getPrivateKey()
-      try:
-        authInfo.session = establishSession(authInfo.keyInfo.username, privateKey)
-      except Exception as e:
-        if e.args == (Error.AUTHENTICATION_FAILED,):
-          raise AuthenticationException()
-        else:
-          raise e
-
-      response = requests.request(method, url, json=body, headers={"Cookie": authInfo.session})
+      # Only one thread re-establishes the session; the others reuse the session it creates
+      with connection.sessionLock:
+        if authInfo.session == staleSession:
+          metrics.reauthentications.inc()
+          privateKey = authInfo.getPrivateKey()
+          try:
+            authInfo.session = establishSession(authInfo.keyInfo.username, privateKey, connection)
+          except Exception as e:
+            if e.args == (Error.AUTHENTICATION_FAILED,):
+              raise AuthenticationException()
+            else:
+              raise e
+
+      response = sendRequest(method, path, connection, json=body, headers={"Cookie": authInfo.session})
       if response.status_code == BITBOX_STATUS_OK:
         return response
       elif response.text == Error.AUTHENTICATION_FAILED.value:
@@ -74,8 +120,8 @@ def requestWithSession(method: str, url: str, body: Any, authInfo: AuthInfo) ->
       return Error(response.text)
   return response
 
-def establishSession(username: str, privateKey: RSA.RsaKey) -> str:
-  challengeStr = challenge(username)
+def establishSession(username: str, privateKey: RSA.RsaKey, connection: Optional[Connection] = None) -> str:
+  challengeStr = challenge(username, connection)
   if isinstance(challengeStr, Error):
     raise AuthenticationException()
   
@@ -86,7 +132,7 @@ def establishSession(username: str, privateKey: RSA.RsaKey) -> str:
     raise AuthenticationException()
   answer = binascii.hexlify(answerBytes).decode("utf-8")
 
-  session = login(username, answer)
+  session = login(username, answer, connection)
   if isinstance(session, Error):
     if session == Error.AUTHENTICATION_FAILED:
       raise AuthenticationException()
@@ -107,8 +153,8 @@ class UserInfoResponse:
 
 UserInfoError = Literal[Error.USER_NOT_FOUND]
 
-def userInfo(username: str) -> Union[UserInfoResponse, UserInfoError]:
-  response = requests.post(f"http://{BITBOX_HOST}/api/info/user", json={ "username" : username })
+def userInfo(username: str, connection: Optional[Connection] = None) -> Union[UserInfoResponse, UserInfoError]:
+  response = sendRequest("POST", "/api/info/user", connection, json={ "username" : username })
   if response.status_code == BITBOX_STATUS_OK:
     return UserInfoResponse(**response.json())
   elif response.text == Error.SERVER_SIDE_ERROR.value:
@@ -126,13 +172,13 @@ RegisterUserError = Union[
   Literal[Error.INVALID_PUBLIC_KEY]
 ]
 
-def registerUser(username: str, publicKey: str) -> Union[None, RegisterUserError]:
+def registerUser(username: str, publicKey: str, connection: Optional[Connection] = None) -> Union[None, RegisterUserError]:
   registerUserBody = {
     "username": username,
     "publicKey": publicKey,
     "version": BITBOX_VERSION,
   }
-  response = requests.post(f"http://{BITBOX_HOST}/api/auth/register/user", json=registerUserBody)
+  response = sendRequest("POST", "/api/auth/register/user", connection, json=registerUserBody)
   if response.status_code == BITBOX_STATUS_OK:
     return None
   elif response.text == Error.INVALID_VERSION.value:
@@ -148,15 +194,16 @@ def registerUser(username: str, publicKey: str) -> Union[None, RegisterUserError
 
 PushEncryptedKeyError = Literal[Error.USER_NOT_FOUND]
 
-def pushEncryptedKey(encryptedPrivateKey: str, authInfo: AuthInfo) -> Union[None, PushEncryptedKeyError]:
+def pushEncryptedKey(encryptedPrivateKey: str, authInfo: AuthInfo, connection: Optional[Connection] = None) -> Union[None, PushEncryptedKeyError]:
   pushEncryptedKeyBody = {
     "encryptedPrivateKey": encryptedPrivateKey,
     "version": BITBOX_VERSION
   }
   response = requestWithSession("POST",
-    f"http://{BITBOX_HOST}/api/auth/recover/push-encrypted-key",
+    "/api/auth/recover/push-encrypted-key",
     pushEncryptedKeyBody,
-    authInfo)
+    authInfo,
+    connection)
   if response.status_code == BITBOX_STATUS_OK:
     return None
   elif response.text == Error.INVALID_VERSION.value:
@@ -175,12 +222,12 @@ RecoverKeysError = Union[
   Literal[Error.RECOVERY_NOT_READY]
 ]
 
-def recoverKeys(username: str) -> Union[str, RecoverKeysError]:
+def recoverKeys(username: str, connection: Optional[Connection] = None) -> Union[str, RecoverKeysError]:
   recoverKeysBody = {
     "username": username,
     "version": BITBOX_VERSION
   }
-  response = requests.post(f"http://{BITBOX_HOST}/api/auth/recover/recover-keys", json=recoverKeysBody)
+  response = sendRequest("POST", "/api/auth/recover/recover-keys", connection, json=recoverKeysBody)
   if response.status_code == BITBOX_STATUS_OK:
     return response.text
   elif response.text == Error.INVALID_VERSION.value:
@@ -198,11 +245,11 @@ ChallengeResponse = str
 
 ChallengeError = Literal[Error.USER_NOT_FOUND]
 
-def challenge(username: str) -> Union[ChallengeResponse, ChallengeError]:
+def challenge(username: str, connection: Optional[Connection] = None) -> Union[ChallengeResponse, ChallengeError]:
   challengeBody = {
     "username": username
   }
-  response = requests.post(f"http://{BITBOX_HOST}/api/auth/login/challenge", json=challengeBody)
+  response = sendRequest("POST", "/api/auth/login/challenge", connection, json=challengeBody)
   if response.status_code == BITBOX_STATUS_OK:
     return response.text
   elif response.text == Error.SERVER_SIDE_ERROR.value:
@@ -219,13 +266,13 @@ LoginError = Union[
   Literal[Error.AUTHENTICATION_FAILED]
 ]
 
-def login(username: str, challengeResponse: str) -> Union[Session, LoginError]:
+def login(username: str, challengeResponse: str, connection: Optional[Connection] = None) -> Union[Session, LoginError]:
   loginBody = {
     "username": username,
     "challengeResponse": challengeResponse,
     "version": BITBOX_VERSION
   }
-  response = requests.post(f"http://{BITBOX_HOST}/api/auth/login/login", json=loginBody)
+  response = sendRequest("POST", "/api/auth/login/login", connection, json=loginBody)
   if response.status_code == BITBOX_STATUS_OK:
     return response.headers["set-cookie"]
   elif response.text == Error.INVALID_VERSION.value:
@@ -250,7 +297,7 @@ PrepareStoreError = Union[
   Literal[Error.FILE_EXISTS]
 ]
 
-def prepareStore(filename: str, bytes: int, hash: str, personalEncryptedKey: str, authInfo: AuthInfo) -> Union[PrepareStoreResponse, PrepareStoreError]:
+def prepareStore(filename: str, bytes: int, hash: str, personalEncryptedKey: str, authInfo: AuthInfo, connection: Optional[Connection] = None) -> Union[PrepareStoreResponse, PrepareStoreError]:
   prepareStoreBody = {
     "filename": filename,
     "bytes": bytes,
@@ -258,9 +305,10 @@ def prepareStore(filename: str, bytes: int, hash: str, personalEncryptedKey: str
     "personalEncryptedKey": personalEncryptedKey
   }
   response = requestWithSession("POST",
-    f"http://{BITBOX_HOST}/api/storage/prepare-store",
+    "/api/storage/prepare-store",
     prepareStoreBody,
-    authInfo)
+    authInfo,
+    connection)
   if isinstance(response, Error):
     if response == Error.SERVER_SIDE_ERROR:
       raise BitboxException(response.text)
@@ -284,16 +332,17 @@ PrepareUpdateError = Union[
   Literal[Error.FILE_NOT_FOUND]
 ]
 
-def prepareUpdate(fileId: str, bytes: int, hash: str, authInfo: AuthInfo) -> Union[PrepareUpdateResponse, PrepareUpdateError]:
+def prepareUpdate(fileId: str, bytes: int, hash: str, authInfo: AuthInfo, connection: Optional[Connection] = None) -> Union[PrepareUpdateResponse, PrepareUpdateError]:
   prepareUpdateBody = {
     "fileId": fileId,
     "bytes": bytes,
     "hash": hash
   }
   response = requestWithSession("POST",
-    f"http://{BITBOX_HOST}/api/storage/prepare-update",
+    "/api/storage/prepare-update",
     prepareUpdateBody,
-    authInfo)
+    authInfo,
+    connection)
   if isinstance(response, Error):
     if response == Error.SERVER_SIDE_ERROR:
       raise BitboxException(response.text)
@@ -311,14 +360,15 @@ StoreError = Union[
   Literal[Error.ACCESS_DENIED]
 ]
 
-def store(fileId: str, authInfo: AuthInfo) -> Union[None, StoreError]:
+def store(fileId: str, authInfo: AuthInfo, connection: Optional[Connection] = None) -> Union[None, StoreError]:
   storeBody = {
     "fileId": fileId
   }
   response = requestWithSession("POST",
-    f"http://{BITBOX_HOST}/api/storage/store",
+    "/api/storage/store",
     storeBody,
-    authInfo)
+    authInfo,
+    connection)
   if isinstance(response, Error):
     if response == Error.SERVER_SIDE_ERROR:
       raise BitboxException(response.text)
@@ -334,15 +384,16 @@ ShareError = Union[
   Literal[Error.USER_NOT_FOUND]
 ]
 
-def share(fileId: str, recipientEncryptedKeys: Dict[str, str], authInfo: AuthInfo) -> Union[None, ShareError]:
+def share(fileId: str, recipientEncryptedKeys: Dict[str, str], authInfo: AuthInfo, connection: Optional[Connection] = None) -> Union[None, ShareError]:
   shareBody = {
     "fileId": fileId,
     "recipientEncryptedKeys": recipientEncryptedKeys
   }
   response = requestWithSession("POST",
-    f"http://{BITBOX_HOST}/api/storage/share",
+    "/api/storage/share",
     shareBody,
-    authInfo)
+    authInfo,
+    connection)
   if isinstance(response, Error):
     if response == Error.SERVER_SIDE_ERROR:
       raise BitboxException(response.text)
@@ -364,14 +415,15 @@ SaveError = Union[
   Literal[Error.FILE_NOT_READY]
 ]
 
-def save(fileId: str, authInfo: AuthInfo) -> Union[SaveResponse, SaveError]:
+def save(fileId: str, authInfo: AuthInfo, connection: Optional[Connection] = None) -> Union[SaveResponse, SaveError]:
   saveBody = {
     "fileId": fileId
   }
   response = requestWithSession("POST",
-    f"http://{BITBOX_HOST}/api/storage/save",
+    "/api/storage/save",
     saveBody,
-    authInfo)
+    authInfo,
+    connection)
   if isinstance(response, Error):
     if response == Error.SERVER_SIDE_ERROR:
       raise BitboxException(response.text)
@@ -389,14 +441,15 @@ DeleteError = Union[
   Literal[Error.FILE_NOT_READY]
 ]
 
-def delete(fileId: str, authInfo: AuthInfo) -> Union[None, DeleteError]:
+def delete(fileId: str, authInfo: AuthInfo, connection: Optional[Connection] = None) -> Union[None, DeleteError]:
   deleteBody = {
     "fileId": fileId
   }
   response = requestWithSession("POST",
-    f"http://{BITBOX_HOST}/api/storage/delete",
+    "/api/storage/delete",
     deleteBody,
-    authInfo)
+    authInfo,
+    connection)
   if isinstance(response, Error):
     if response == Error.SERVER_SIDE_ERROR:
       raise BitboxException(response.text)
@@ -415,16 +468,17 @@ FileInfoError = Union[
   Literal[Error.FILENAME_NOT_SPECIFIC]
 ]
 
-def fileInfo(filename: str, owner: Optional[str], authInfo: AuthInfo) -> Union[FileInfoResponse, FileInfoError]:
+def fileInfo(filename: str, owner: Optional[str], authInfo: AuthInfo, connection: Optional[Connection] = None) -> Union[FileInfoResponse, FileInfoError]:
   fileInfoBody = {
     "filename": filename
   }
   if owner is not None:
     fileInfoBody["owner"] = owner
   response = requestWithSession("POST",
-    f"http://{BITBOX_HOST}/api/info/file",
+    "/api/info/file",
     fileInfoBody,
-    authInfo)
+    authInfo,
+    connection)
   if isinstance(response, Error):
     if response == Error.SERVER_SIDE_ERROR:
       raise BitboxException(response.text)
@@ -433,14 +487,15 @@ def fileInfo(filename: str, owner: Optional[str], authInfo: AuthInfo) -> Union[F
   else:
     return FileInfoResponse(**response.json())
 
-def fileInfoById(fileId: str, authInfo: AuthInfo) -> Union[FileInfoResponse, FileInfoError]:
+def fileInfoById(fileId: str, authInfo: AuthInfo, connection: Optional[Connection] = None) -> Union[FileInfoResponse, FileInfoError]:
   fileInfoBody = {
     "fileId": fileId
   }
   response = requestWithSession("POST",
-    f"http://{BITBOX_HOST}/api/info/file",
+    "/api/info/file",
     fileInfoBody,
-    authInfo)
+    authInfo,
+    connection)
   if isinstance(response, Error):
     if response == Error.SERVER_SIDE_ERROR:
       raise BitboxException(response.text)
@@ -455,11 +510,12 @@ def fileInfoById(fileId: str, authInfo: AuthInfo) -> Union[FileInfoResponse, Fil
 
 FilesInfoResponse = List[FileInfo]
 
-def filesInfo(authInfo: AuthInfo) -> FilesInfoResponse:
+def filesInfo(authInfo: AuthInfo, connection: Optional[Connection] = None) -> FilesInfoResponse:
   response = requestWithSession("GET",
-    f"http://{BITBOX_HOST}/api/info/files",
+    "/api/info/files",
     None,
-    authInfo)
+    authInfo,
+    connection)
   if isinstance(response, Error):
     raise BitboxException(response.text)
   else:
@@ -469,13 +525,13 @@ def filesInfo(authInfo: AuthInfo) -> FilesInfoResponse:
 # Log Command
 #
 
-def logCommand(data: str, username: str) -> None:
+def logCommand(data: str, username: str, connection: Optional[Connection] = None) -> None:
   logCommandBody = {
     "data": data,
     "username": username,
     "context": CURRENT_CONTEXT
   }
-  response = requests.post(f"http://{BITBOX_HOST}/api/log/command", json=logCommandBody)
+  response = sendRequest("POST", "/api/log/command", connection, json=logCommandBody)
   if response.status_code != BITBOX_STATUS_OK:
     raise BitboxException(response.text)
 
@@ -483,12 +539,12 @@ def logCommand(data: str, username: str) -> None:
 # Log Error
 #
 
-def logError(data: str, username: str) -> None:
+def logError(data: str, username: str, connection: Optional[Connection] = None) -> None:
   logErrorBody = {
     "data": data,
     "username": username,
     "context": CURRENT_CONTEXT
   }
-  response = requests.post(f"http://{BITBOX_HOST}/api/log/error", json=logErrorBody)
+  response = sendRequest("POST", "/api/log/error", connection, json=logErrorBody)
   if response.status_code != BITBOX_STATUS_OK:
     raise BitboxException(response.text)
@@ -17,10 +17,15 @@ setup(
   entry_points={
     "console_scripts": [
       "bitbox = bitbox.cli.bitbox.main:run",
+      "bitboxd = bitbox.cli.bitbox.daemon:run",
       "bb = bitbox.cli.bb.main:run"
     ],
+    "fsspec.specs": [
+      "bitbox = bitbox.lib.filesystem:BitboxFileSystem"
+    ],
   },
   install_requires=[
+    "aiohttp>=3.8.0",
     "cryptocode>=0.1",
     "cryptography>=38.0.4",
     "mypy>=0.991",
@@ -31,4 +36,7 @@ setup(
     "typer>=0.7.0",
     "random-username>=1.0.2"
   ],
+  extras_require={
+    "fsspec": ["fsspec>=2022.1.0"]
+  },
 )
@@ -0,0 +1,148 @@
+from bitbox.lib.delta import *
+import random
+import pytest
+
+#
+# Utility functions
+#
+
+def randomBytes(length: int, seed: int = 0) -> bytes:
+  return random.Random(seed).randbytes(length)
+
+def sampleManifest() -> DeltaManifest:
+  chunks = [
+    DeltaChunk(hash="a" * 64, length=100, segment=0, offset=0),
+    DeltaChunk(hash="b" * 64, length=50, segment=0, offset=fernetTokenLength(100)),
+    DeltaChunk(hash="a" * 64, length=100, segment=1, offset=0)
+  ]
+  segments = [
+    DeltaSegment(name=segmentName("notes.txt"), fileId="file-1", size=fernetTokenLength(100) + fernetTokenLength(50)),
+    DeltaSegment(name=segmentName("notes.txt"), fileId="file-2", size=fernetTokenLength(100))
+  ]
+  return DeltaManifest(owner="alice", hash="c" * 64, size=250, segments=segments, chunks=chunks)
+
+#
+# Chunking
+#
+
+def testChunksCoverData():
+  data = randomBytes(12 * 1024 ** 2)
+  offset = 0
+  for chunkOffset, length in chunkBoundaries(data):
+    assert chunkOffset == offset
+    assert length <= DELTA_MAX_CHUNK_SIZE
+    offset += length
+  assert offset == len(data)
+
+def testChunksRespectSizeLimits():
+  data = randomBytes(12 * 1024 ** 2)
+  chunks = chunkBoundaries(data)
+  assert len(chunks) > 1
+  for _, length in chunks[:-1]:
+    assert DELTA_MIN_CHUNK_SIZE < length <= DELTA_MAX_CHUNK_SIZE
+
+def testSmallDataIsOneChunk():
+  assert chunkBoundaries(b"") == []
+  assert chunkBoundaries(b"x" * DELTA_MIN_CHUNK_SIZE) == [(0, DELTA_MIN_CHUNK_SIZE)]
+
+def testUniformDataIsCutAtMaxSize():
+  data = bytes(3 * DELTA_MAX_CHUNK_SIZE)
+  assert [length for _, length in chunkBoundaries(data)] == [DELTA_MAX_CHUNK_SIZE] * 3
+
+def testBoundariesAreStable():
+  # The same data always splits the same way, whatever it is passed as
+  data = randomBytes(8 * 1024 ** 2)
+  assert chunkBoundaries(data) == chunkBoundaries(bytearray(data))
+  assert chunkBoundaries(data) == chunkBoundaries(memoryview(data).tobytes())
+
+def testInsertionOnlyChangesNearbyChunks():
+  data = randomBytes(16 * 1024 ** 2)
+  edited = data[:8 * 1024 ** 2] + b"inserted" + data[8 * 1024 ** 2:]
+  before = chunkHashes(data)
+  after = chunkHashes(edited)
+
+  # Every chunk away from the edit is still there, and only a couple of chunks are new
+  assert len(set(after) - set(before)) <= 2
+  assert len(set(before) - set(after)) <= 2
+  assert len(set(before) & set(after)) >= len(before) - 2
+
+def testChunkHashesMatchContents():
+  data = randomBytes(4 * 1024 ** 2)
+  for chunkHash, (offset, length) in chunkHashes(data).items():
+    assert hashlib.sha256(data[offset:offset + length]).hexdigest() == chunkHash
+
+#
+# Manifest format
+#
+
+def testManifestRoundTrip():
+  manifest = sampleManifest()
+  blob = buildManifest(manifest)
+  assert isDelta(blob)
+  assert readManifest(blob) == manifest
+
+def testEmptyManifestRoundTrip():
+  manifest = DeltaManifest(owner="alice", hash=hashlib.sha256(b"").hexdigest(), size=0, segments=[], chunks=[])
+  assert readManifest(buildManifest(manifest)) == manifest
+
+def testManifestWithoutMagicIsRejected():
+  blob = buildManifest(sampleManifest())
+  assert not isDelta(blob[1:])
+  with pytest.raises(DeltaException):
+    readManifest(blob[1:])
+
+def testTruncatedManifestIsRejected():
+  blob = buildManifest(sampleManifest())
+  with pytest.raises(DeltaException):
+    readManifest(blob[:-1])
+
+@pytest.mark.parametrize("tamper", [
+  lambda manifest: setattr(manifest.chunks[0], "segment", 2),
+  lambda manifest: setattr(manifest.chunks[0], "segment", -1),
+  lambda manifest: setattr(manifest.chunks[1], "offset", manifest.segments[0].size),
+  lambda manifest: setattr(manifest.chunks[1], "offset", -1),
+  lambda manifest: setattr(manifest.chunks[2], "length", 200),
+  lambda manifest: setattr(manifest, "size", 251),
+  lambda manifest: setattr(manifest.segments[1], "name", "notes.txt"),
+  lambda manifest: setattr(manifest.segments[0], "size", fernetTokenLength(100))
+])
+def testTamperedManifestIsRejected(tamper):
+  manifest = sampleManifest()
+  tamper(manifest)
+  with pytest.raises(DeltaException):
+    readManifest(buildManifest(manifest))
+
+def testManifestWithMissingFieldsIsRejected():
+  blob = buildManifest(sampleManifest()).replace(b'"fileId"', b'"fileID"')
+  with pytest.raises(DeltaException):
+    readManifest(blob)
+
+#
+# Segments
+#
+
+def testSegmentNamesAreUnique():
+  assert segmentName("notes.txt") != segmentName("notes.txt")
+  assert segmentName("notes.txt").startswith(chunkPrefix("notes.txt"))
+  assert isChunkName(segmentName("notes.txt"))
+
+def testKeptSegments():
+  manifest = sampleManifest()
+  # Both segments are mostly chunk "a", which the new version still has
+  assert keptSegments(manifest, { "a" * 64 }) == { 0, 1 }
+  # Chunk "b" alone is less than half of the first segment
+  assert keptSegments(manifest, { "b" * 64 }) == set()
+
+def testChunkRunsAndDecryption():
+  fileKey = Fernet.generate_key()
+  contents = [b"x" * 100, b"y" * 50]
+  segment = b"".join(Fernet(fileKey).encrypt(content) for content in contents)
+  chunks = [
+    DeltaChunk(hash=hashlib.sha256(contents[0]).hexdigest(), length=100, segment=0, offset=0),
+    DeltaChunk(hash=hashlib.sha256(contents[1]).hexdigest(), length=50, segment=0, offset=fernetTokenLength(100))
+  ]
+
+  # Neighbouring chunks make up a single run, and chunks that repeat are only fetched once
+  runs = chunkRuns(chunks + chunks[:1])
+  assert runs == [chunks]
+  assert decryptRun(segment, runs[0], fileKey) == contents
@@ -0,0 +1,90 @@
+from bitbox.lib.pack import *
+import pytest
+
+#
+# Utility functions
+#
+
+def sampleMembers() -> List[Tuple[str, bytes]]:
+  return [("a.txt", b"first"), ("sub/b.txt", b"second"), ("empty", b"")]
+
+def withIndex(blob: bytes, edit) -> bytes:
+  # Rewrite the index of a pack, keeping the contents of its members
+  indexStart = len(PACK_MAGIC) + PACK_INDEX_LENGTH_BYTES
+  indexLength = int.from_bytes(blob[len(PACK_MAGIC):indexStart], "big")
+  index = json.loads(blob[indexStart:indexStart + indexLength])
+  edit(index)
+  indexBytes = json.dumps(index).encode("utf-8")
+  return PACK_MAGIC + len(indexBytes).to_bytes(PACK_INDEX_LENGTH_BYTES, "big") + indexBytes + blob[indexStart + indexLength:]
+
+#
+# Pack format
+#
+
+def testPackRoundTrip():
+  blob = buildPack(sampleMembers())
+  assert isPack(blob)
+  members = readPackIndex(blob)
+  assert list(members) == [name for name, _ in sampleMembers()]
+  for name, contents in sampleMembers():
+    assert members[name].hash == hashlib.sha256(contents).hexdigest()
+    assert extractMember(blob, members[name]) == contents
+
+def testEmptyPackRoundTrip():
+  assert readPackIndex(buildPack([])) == {}
+
+def testReplaceMembers():
+  blob = replaceMembers(buildPack(sampleMembers()), { "sub/b.txt": b"changed" })
+  members = readPackIndex(blob)
+  assert extractMember(blob, members["a.txt"]) == b"first"
+  assert extractMember(blob, members["sub/b.txt"]) == b"changed"
+  with pytest.raises(PackException):
+    replaceMembers(blob, { "missing.txt": b"" })
+
+@pytest.mark.parametrize("name", ["", "/etc/passwd", "../escape", "sub/../../escape", "a\\b", "a//b", "./a", ".", "..", "a\0b"])
+def testUnsafeNamesAreRejected(name):
+  with pytest.raises(PackException):
+    buildPack([(name, b"contents")])
+
+def testDuplicateNamesAreRejected():
+  with pytest.raises(PackException):
+    buildPack([("a.txt", b"one"), ("a.txt", b"two")])
+
+#
+# Tampering
+#
+
+def testBlobWithoutMagicIsRejected():
+  blob = buildPack(sampleMembers())
+  with pytest.raises(PackException):
+    readPackIndex(blob[1:])
+
+def testTruncatedIndexIsRejected():
+  blob = buildPack(sampleMembers())
+  with pytest.raises(PackException):
+    readPackIndex(blob[:len(PACK_MAGIC) + PACK_INDEX_LENGTH_BYTES + 10])
+
+def testTruncatedContentsAreRejected():
+  blob = buildPack(sampleMembers())
+  with pytest.raises(PackException):
+    readPackIndex(blob[:-1])
+
+def testCorruptedIndexIsRejected():
+  blob = withIndex(buildPack(sampleMembers()), lambda index: index["members"][0].pop("hash"))
+  with pytest.raises(PackException):
+    readPackIndex(blob)
+
+@pytest.mark.parametrize("field, value", [("offset", -1), ("length", -1), ("length", 1000), ("name", "../escape")])
+def testTamperedIndexIsRejected(field, value):
+  blob = withIndex(buildPack(sampleMembers()), lambda index: index["members"][0].update({ field: value }))
+  with pytest.raises(PackException):
+    readPackIndex(blob)
+
+def testTamperedContentsAreRejected():
+  blob = buildPack(sampleMembers())
+  members = readPackIndex(blob)
+  tampered = blob.replace(b"first", b"FIRST")
+  with pytest.raises(PackException):
+    extractMember(tampered, members["a.txt"])
+  with pytest.raises(PackException):
+    replaceMembers(tampered, { "sub/b.txt": b"changed" })